@@ -0,0 +1,293 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent index of the UID relationships in a local DICOM archive
+
+Usage:
+    python archive_index.py <index.sqlite> <archive_directory> [plan_sop_instance_uid]
+
+The archive is scanned once, reading only headers (in parallel), into a SQLite database of
+SOP Instance UID, kind of object, Series, Frames of Reference and referenced SOP Instance UIDs.
+Later updates only read files that are new or changed (by modification time and size) and
+drop files that are gone, so questions such as "all SROs registering to this plan's Frame of
+Reference" are indexed queries instead of a pass over the archive.
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+from dicom_files import iter_file_entries
+from uid_index import KIND_PLAN, KIND_SRO, HeaderSummary, dicom_header_summary
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sop_instance_uid TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    sop_instance_uid TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    sop_class_uid TEXT NOT NULL,
+    series_instance_uid TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS frames_of_reference (
+    sop_instance_uid TEXT NOT NULL,
+    frame_of_reference_uid TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS object_references (
+    sop_instance_uid TEXT NOT NULL,
+    referenced_sop_instance_uid TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_by_uid ON frames_of_reference (frame_of_reference_uid);
+CREATE INDEX IF NOT EXISTS frames_by_object ON frames_of_reference (sop_instance_uid);
+CREATE INDEX IF NOT EXISTS references_by_uid ON object_references (referenced_sop_instance_uid);
+CREATE INDEX IF NOT EXISTS references_by_object ON object_references (sop_instance_uid);
+CREATE INDEX IF NOT EXISTS files_by_object ON files (sop_instance_uid);
+"""
+
+DEFAULT_CHUNK_SIZE = 64
+
+
+def _read_summary(path: str) -> HeaderSummary | None:
+    """Header summary of a file, None when it is not DICOM"""
+    try:
+        return dicom_header_summary(path)
+    except Exception:
+        return None
+
+
+def walk_files(directory: str) -> Iterable[Tuple[str, int, int]]:
+    """(path, mtime ns, size) of every file below directory
+
+    A subdirectory that cannot be listed, or a file removed before its size is read, is skipped with a warning
+    (see dicom_files.iter_file_entries), so its files count as removed until the next update that can read them.
+    """
+    for entry in iter_file_entries(directory):
+        try:
+            stat = entry.stat()
+        except OSError as e:
+            logging.warning("Skipping %s: %s", entry.path, e)
+            continue
+        yield entry.path, stat.st_mtime_ns, stat.st_size
+
+
+class ArchiveIndex:
+    """SQLite backed index of SOP Instance UIDs, Frames of Reference and references"""
+
+    def __init__(self, database_path: str):
+        """
+        Args:
+            database_path (str): the SQLite file, created if it does not exist (":memory:" for a transient index)
+        """
+        self.connection = sqlite3.connect(database_path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "ArchiveIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def update(self, directory: str, workers: int | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict[str, int]:
+        """Bring the index up to date with the files below directory
+
+        Args:
+            directory (str): the archive (or part of it) to scan
+            workers (int | None): processes reading headers, None for os.cpu_count(), 1 reads in this process
+            chunk_size (int): files per task sent to a worker
+
+        Returns:
+            Dict[str, int]: the number of files "read", "unchanged" and "removed"
+        """
+        directory = os.path.abspath(directory)
+        indexed = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self.connection.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE path LIKE ? ESCAPE '\\'",
+                (directory.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%",),
+            )
+        }
+        changed = []
+        unchanged = 0
+        for path, mtime_ns, size in walk_files(directory):
+            if indexed.pop(path, None) == (mtime_ns, size):
+                unchanged += 1
+            else:
+                changed.append((path, mtime_ns, size))
+
+        self.remove_files(indexed)
+        self.add_files(changed, workers=workers, chunk_size=chunk_size)
+        return {"read": len(changed), "unchanged": unchanged, "removed": len(indexed)}
+
+    def add_files(
+        self, files: List[Tuple[str, int, int]], workers: int | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> None:
+        """Read the headers of (path, mtime ns, size) files and (re)index them"""
+        paths = [path for path, _, _ in files]
+        if workers == 1 or len(paths) <= chunk_size:
+            summaries = [_read_summary(path) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                summaries = list(executor.map(_read_summary, paths, chunksize=chunk_size))
+
+        with self.connection:
+            self._remove(paths)
+            self.connection.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                [
+                    (path, mtime_ns, size, summary.sop_instance_uid if summary is not None else None)
+                    for (path, mtime_ns, size), summary in zip(files, summaries)
+                ],
+            )
+            for summary in summaries:
+                if summary is not None and summary.sop_instance_uid:
+                    self._insert(summary)
+
+    def add_summary(self, summary: HeaderSummary) -> None:
+        """Index an object that is not (or not only) known from a file scan, e.g. one received over the network"""
+        with self.connection:
+            self._insert(summary)
+
+    def remove_files(self, paths: Iterable[str]) -> None:
+        """Forget files, and the objects read from them that no other indexed file holds"""
+        with self.connection:
+            self._remove(list(paths))
+
+    def _remove(self, paths: List[str]) -> None:
+        """Delete the files rows, and the objects read from them unless another file still holds the same instance"""
+        for path in paths:
+            sop_instance_uids = [
+                sop_instance_uid
+                for (sop_instance_uid,) in self.connection.execute(
+                    "SELECT sop_instance_uid FROM files WHERE path = ? AND sop_instance_uid IS NOT NULL", (path,)
+                )
+            ]
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+            for sop_instance_uid in sop_instance_uids:
+                other_file = self.connection.execute(
+                    "SELECT path FROM files WHERE sop_instance_uid = ? LIMIT 1", (sop_instance_uid,)
+                ).fetchone()
+                if other_file is None:
+                    self._delete_object(sop_instance_uid)
+                else:
+                    self.connection.execute(
+                        "UPDATE objects SET path = ? WHERE sop_instance_uid = ? AND path = ?",
+                        (other_file[0], sop_instance_uid, path),
+                    )
+
+    def _delete_object(self, sop_instance_uid: str) -> None:
+        self.connection.execute("DELETE FROM objects WHERE sop_instance_uid = ?", (sop_instance_uid,))
+        self.connection.execute("DELETE FROM frames_of_reference WHERE sop_instance_uid = ?", (sop_instance_uid,))
+        self.connection.execute("DELETE FROM object_references WHERE sop_instance_uid = ?", (sop_instance_uid,))
+
+    def _insert(self, summary: HeaderSummary) -> None:
+        self._delete_object(summary.sop_instance_uid)
+        self.connection.execute(
+            "INSERT INTO objects VALUES (?, ?, ?, ?, ?)",
+            (summary.sop_instance_uid, summary.path, summary.kind, summary.sop_class_uid, summary.series_instance_uid),
+        )
+        self.connection.executemany(
+            "INSERT INTO frames_of_reference VALUES (?, ?, ?)",
+            [(summary.sop_instance_uid, uid, position) for position, uid in enumerate(summary.frames_of_reference)],
+        )
+        self.connection.executemany(
+            "INSERT INTO object_references VALUES (?, ?, ?)",
+            [(summary.sop_instance_uid, uid, position) for position, uid in enumerate(summary.referenced_sop_instance_uids)],
+        )
+
+    def _summaries(self, sop_instance_uids: Iterable[str]) -> List[HeaderSummary]:
+        summaries = []
+        for sop_instance_uid in sop_instance_uids:
+            row = self.connection.execute(
+                "SELECT path, kind, sop_class_uid, series_instance_uid FROM objects WHERE sop_instance_uid = ?",
+                (sop_instance_uid,),
+            ).fetchone()
+            if row is None:
+                continue
+            frames = self.connection.execute(
+                "SELECT frame_of_reference_uid FROM frames_of_reference WHERE sop_instance_uid = ? ORDER BY position",
+                (sop_instance_uid,),
+            ).fetchall()
+            references = self.connection.execute(
+                "SELECT referenced_sop_instance_uid FROM object_references WHERE sop_instance_uid = ? ORDER BY position",
+                (sop_instance_uid,),
+            ).fetchall()
+            summaries.append(
+                HeaderSummary(
+                    path=row[0],
+                    kind=row[1],
+                    sop_class_uid=row[2],
+                    sop_instance_uid=sop_instance_uid,
+                    series_instance_uid=row[3],
+                    frames_of_reference=tuple(uid for (uid,) in frames),
+                    referenced_sop_instance_uids=tuple(uid for (uid,) in references),
+                )
+            )
+        return summaries
+
+    def get(self, sop_instance_uid: str) -> HeaderSummary | None:
+        """The indexed object with this SOP Instance UID"""
+        summaries = self._summaries([sop_instance_uid])
+        return summaries[0] if summaries else None
+
+    def on_frame_of_reference(self, frame_of_reference_uid: str, kind: str | None = None) -> List[HeaderSummary]:
+        """The objects (of one kind, e.g. uid_index.KIND_SRO) on, referencing or registering a Frame of Reference"""
+        query = (
+            "SELECT DISTINCT objects.sop_instance_uid FROM frames_of_reference"
+            " JOIN objects ON objects.sop_instance_uid = frames_of_reference.sop_instance_uid"
+            " WHERE frame_of_reference_uid = ?"
+        )
+        parameters: Tuple[str, ...] = (frame_of_reference_uid,)
+        if kind is not None:
+            query += " AND kind = ?"
+            parameters += (kind,)
+        return self._summaries(uid for (uid,) in self.connection.execute(query + " ORDER BY path", parameters).fetchall())
+
+    def referencing(self, sop_instance_uid: str) -> List[HeaderSummary]:
+        """The objects that reference a SOP Instance UID (e.g. the plans referencing an RTSS)"""
+        rows = self.connection.execute(
+            "SELECT DISTINCT sop_instance_uid FROM object_references WHERE referenced_sop_instance_uid = ?",
+            (sop_instance_uid,),
+        ).fetchall()
+        return self._summaries(uid for (uid,) in rows)
+
+    def sros_for_plan(self, plan_sop_instance_uid: str) -> List[HeaderSummary]:
+        """The SROs registering to the Frame of Reference of a plan"""
+        plan = self.get(plan_sop_instance_uid)
+        if plan is None or plan.kind != KIND_PLAN:
+            raise ValueError(f"No plan {plan_sop_instance_uid} in the index")
+        return [
+            sro
+            for frame_of_reference_uid in plan.frames_of_reference
+            for sro in self.on_frame_of_reference(frame_of_reference_uid, KIND_SRO)
+        ]
+
+
+if __name__ == "__main__":
+    with ArchiveIndex(sys.argv[1]) as archive_index:
+        print(archive_index.update(sys.argv[2]))
+        if len(sys.argv) > 3:
+            for sro in archive_index.sros_for_plan(sys.argv[3]):
+                print(f"{sro.sop_instance_uid}: {sro.path}")
@@ -0,0 +1,206 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Calculate the correction as soon as the imaging system exports an SRO
+
+Usage:
+    python auto_watch.py <export_directory> [poll_interval_seconds]
+
+The export directory is polled with os.scandir. Only files that are new or changed since
+the previous poll (by modification time and size) are read, and each is read once, without
+pixel data. SROs, in room RTSSs and plans are kept in an in memory UID index, and an SRO is
+calculated as soon as its in room RTSS and plan (matched through the registered Frames of
+Reference) have been seen, whichever of the three arrives last. An SRO whose calculation fails
+is reported once and dropped (until it is exported again). Only the most recently used datasets
+are kept in memory, an evicted one is read again from its file when it is needed.
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+import extract_plan_setupbeam_isocenter as ep
+import extract_reg_matrix as er
+import extract_rtss_setup_isocenter as ertss
+from uid_index import (
+    KIND_PLAN,
+    KIND_RTSS,
+    KIND_SRO,
+    HeaderSummary,
+    UidIndex,
+    dataset_header_summary,
+)
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+DEFAULT_MAX_DATASETS = 64
+
+
+def print_result(sro: HeaderSummary, rtss: HeaderSummary, plan: HeaderSummary, ypr: np.ndarray, translation: np.ndarray):
+    """Default result handler, prints the correction the way do_calculate does"""
+    print("=" * 30)
+    print(f"SRO: {sro.path}")
+    print(f"In-room RTSS: {rtss.path}")
+    print(f"RT Ion Plan: {plan.path}")
+    c6.report_correction(ypr, translation)
+
+
+def print_error(sro: HeaderSummary, error: Exception):
+    """Default error handler"""
+    print(f"Unable to calculate {sro.path}: {error}")
+
+
+class DirectoryWatcher:
+    """Polls an export directory and calculates each SRO once its in room RTSS and plan are present"""
+
+    def __init__(
+        self,
+        directory: str,
+        on_result: Callable[[HeaderSummary, HeaderSummary, HeaderSummary, np.ndarray, np.ndarray], None] = print_result,
+        on_error: Callable[[HeaderSummary, Exception], None] = print_error,
+        tolerance_ortho_normality: float | None = None,
+        reorthonormalization_tolerance: float | None = None,
+        max_datasets: int = DEFAULT_MAX_DATASETS,
+    ):
+        """
+        Args:
+            directory (str): the folder the imaging system exports to
+            on_result: called with the SRO, in room RTSS and plan summaries, Yaw/Pitch/Roll and the translation
+            on_error: called with the SRO summary and the exception when the calculation fails
+            tolerance_ortho_normality (float | None): tolerance passed on to the rotation matrix check
+            reorthonormalization_tolerance (float | None): wider bound within which the rotation is re-orthonormalized
+            max_datasets (int): the number of datasets kept in memory, the least recently used are evicted
+        """
+        if max_datasets < 1:
+            raise ValueError("max_datasets must be positive")
+        self.directory = directory
+        self.on_result = on_result
+        self.on_error = on_error
+        self.tolerance_ortho_normality = tolerance_ortho_normality
+        self.reorthonormalization_tolerance = reorthonormalization_tolerance
+        self.max_datasets = max_datasets
+        self.index = UidIndex()
+        self._seen: Dict[str, Tuple[int, int]] = {}
+        self._datasets: "OrderedDict[str, pydicom.Dataset]" = OrderedDict()
+        self._pending_sros: Dict[str, HeaderSummary] = {}
+
+    def poll_once(self) -> List[HeaderSummary]:
+        """Read the new or changed files and calculate whatever they complete
+
+        Returns:
+            List[HeaderSummary]: the SROs calculated in this poll
+        """
+        listing = {}
+        changed = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                listing[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                if self._seen.get(entry.path) != listing[entry.path]:
+                    changed.append(entry.path)
+        self._seen = listing  # a deleted file that is exported again is read again
+
+        calculated = []
+        for path in sorted(changed, key=lambda changed_path: listing[changed_path]):
+            calculated += self.add_file(path)
+        return calculated
+
+    def add_file(self, path: str) -> List[HeaderSummary]:
+        """Index one file and calculate the SROs it completes"""
+        try:
+            ds = pydicom.dcmread(path, force=True, stop_before_pixels=True)
+        except Exception:
+            return []  # not DICOM, or still being written (its size will change and it is read again)
+        summary = dataset_header_summary(ds, path)
+        if summary.kind not in (KIND_SRO, KIND_RTSS, KIND_PLAN) or not summary.sop_instance_uid:
+            return []
+        self.index.add(summary)
+        self._keep_dataset(summary.sop_instance_uid, ds)
+
+        if summary.kind == KIND_SRO:
+            candidates = [summary]
+            self._pending_sros[summary.sop_instance_uid] = summary
+        else:
+            candidates = [
+                sro
+                for frame_of_reference_uid in summary.frames_of_reference
+                for sro in self.index.sros_registering(frame_of_reference_uid)
+                if sro.sop_instance_uid in self._pending_sros
+            ]
+        return [sro for sro in dict.fromkeys(candidates) if self._calculate(sro)]
+
+    def _keep_dataset(self, sop_instance_uid: str, ds: pydicom.Dataset) -> None:
+        self._datasets[sop_instance_uid] = ds
+        self._datasets.move_to_end(sop_instance_uid)
+        while len(self._datasets) > self.max_datasets:
+            self._datasets.popitem(last=False)
+
+    def _dataset(self, summary: HeaderSummary) -> pydicom.Dataset:
+        """The dataset of an indexed object, read again from its file if it was evicted"""
+        ds = self._datasets.get(summary.sop_instance_uid)
+        if ds is None:
+            ds = pydicom.dcmread(summary.path, force=True, stop_before_pixels=True)
+        self._keep_dataset(summary.sop_instance_uid, ds)
+        return ds
+
+    def _calculate(self, sro: HeaderSummary) -> bool:
+        frames_of_reference = self.index.match_frames_of_reference(sro)
+        if frames_of_reference is None:
+            return False
+        rtss_frame_of_reference, plan_frame_of_reference = frames_of_reference
+        rtss = self.index.latest(KIND_RTSS, rtss_frame_of_reference)
+        plan = self.index.latest(KIND_PLAN, plan_frame_of_reference)
+        try:
+            plan_ds = self._dataset(plan)
+            ypr, translation = c6.compute_6dof_from_components(
+                er.extract_4x4_matrix_for_calculation(self._dataset(sro), rtss_frame_of_reference, plan_frame_of_reference),
+                np.array(ertss.extract_rtss_setup_isocenter(self._dataset(rtss)), dtype=np.float64),
+                np.array(ep.extract_plan_setupbeam_isocenter(plan_ds), dtype=np.float64),
+                str(plan_ds.PatientSetupSequence[0].PatientPosition),
+                tolerance_ortho_normality=self.tolerance_ortho_normality,
+                reorthonormalization_tolerance=self.reorthonormalization_tolerance,
+            )
+        except Exception as e:
+            # reported once, the SRO is not retried when more objects arrive
+            self._drop_pending(sro)
+            self.on_error(sro, e)
+            return False
+        self._drop_pending(sro)
+        self.on_result(sro, rtss, plan, ypr, translation)
+        return True
+
+    def _drop_pending(self, sro: HeaderSummary) -> None:
+        del self._pending_sros[sro.sop_instance_uid]
+        self._datasets.pop(sro.sop_instance_uid, None)
+
+    def run(self, stop_event: threading.Event, poll_interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        """Poll until stop_event is set"""
+        self.poll_once()
+        while not stop_event.wait(poll_interval):
+            self.poll_once()
+
+
+if __name__ == "__main__":
+    watcher = DirectoryWatcher(sys.argv[1])
+    try:
+        watcher.run(threading.Event(), float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
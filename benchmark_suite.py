@@ -0,0 +1,350 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro benchmarks for the 6DOF calculation
+
+Usage:
+    python benchmark_suite.py [benchmark_name ...]
+
+With no arguments every registered benchmark is run.
+Each benchmark reports the best time per call over several repeats.
+"""
+
+import contextlib
+import io
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict
+
+import numpy as np
+from pydicom import Dataset, Sequence, uid
+from pydicom.dataset import FileMetaDataset
+
+import compute_6dof_from_reg_rtss_plan as c6
+import convert_matrix_to_euler as cnv
+import correction_api
+import gen_inroom_rtss
+import store_scp
+from course_session import CourseSession
+from mock_datasets import (
+    make_ion_plan_dataset,
+    make_registration_dataset,
+    make_rtss_dataset,
+)
+from monte_carlo_setup_uncertainty import simulate_setup_uncertainty
+
+BENCHMARKS: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+REPEAT = 5
+
+
+def benchmark(name: str) -> Callable:
+    """Register a benchmark function under name"""
+
+    def register(func: Callable[[], Dict[str, float]]) -> Callable[[], Dict[str, float]]:
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+def best_seconds_per_call(func: Callable[[], object], number: int, repeat: int = REPEAT) -> float:
+    """Best of repeat timings of number calls, divided by number"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def rotation_about_z(rotation_degrees: float = 1.0, translation: tuple = (10.0, -5.0, 2.5)) -> np.ndarray:
+    """A rigid 4x4 rotated about the DICOM Patient z axis, the registration of the benchmark SROs"""
+    angle = np.radians(rotation_degrees)
+    four_by_four = np.identity(4)
+    four_by_four[0:2, 0:2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    four_by_four[0:3, 3] = translation
+    return four_by_four
+
+
+@benchmark("full_calculation")
+def bench_full_calculation() -> Dict[str, float]:
+    """compute_6dof_from_reg_rtss_plan on datasets already in memory (printing discarded)"""
+    reg_ds, rtss_ds, plan_ds = make_registration_dataset(rotation_about_z()), make_rtss_dataset(), make_ion_plan_dataset()
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            c6.compute_6dof_from_reg_rtss_plan(reg_ds, rtss_ds, plan_ds)
+
+    return {"us_per_fraction": 1e6 * best_seconds_per_call(run, number=500)}
+
+
+@benchmark("course_session_fraction")
+def bench_course_session_fraction() -> Dict[str, float]:
+    """CourseSession.compute_fraction, plan side precomputed once"""
+    reg_ds, rtss_ds = make_registration_dataset(rotation_about_z()), make_rtss_dataset()
+    session = CourseSession(make_ion_plan_dataset())
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.compute_fraction(reg_ds, rtss_ds)
+
+    return {"us_per_fraction": 1e6 * best_seconds_per_call(run, number=2000)}
+
+
+@benchmark("correction_api_summaries")
+def bench_correction_api_summaries() -> Dict[str, float]:
+    """correction_api.compute_correction from summaries made once, against the datasets on every call"""
+    reg_ds, rtss_ds, plan_ds = make_registration_dataset(rotation_about_z()), make_rtss_dataset(), make_ion_plan_dataset()
+    summaries = (
+        correction_api.summarize_registration(reg_ds),
+        correction_api.summarize_rtss(rtss_ds),
+        correction_api.summarize_plan(plan_ds),
+    )
+    return {
+        "datasets_us_per_fraction": 1e6
+        * best_seconds_per_call(lambda: correction_api.compute_correction(reg_ds, rtss_ds, plan_ds), number=2000),
+        "summaries_us_per_fraction": 1e6
+        * best_seconds_per_call(lambda: correction_api.compute_correction(*summaries), number=2000),
+    }
+
+
+@benchmark("euler_angles_to_rotation_matrix_batch")
+def bench_euler_angles_to_rotation_matrix_batch() -> Dict[str, float]:
+    """Rotation synthesis throughput, batch (closed form) against the per triple function"""
+    batch_size = 1_000_000
+    angles = np.random.default_rng(0).uniform(-np.pi, np.pi, (batch_size, 3))
+    batch_seconds = best_seconds_per_call(lambda: cnv.euler_angles_to_rotation_matrix_batch(angles), number=1)
+    loop_angles = angles[:2000]
+    loop_seconds = best_seconds_per_call(
+        lambda: [cnv.euler_angles_to_rotation_matrix(theta) for theta in loop_angles], number=1
+    ) * (batch_size / len(loop_angles))
+    return {
+        "batch_s_per_million": batch_seconds * 1e6 / batch_size,
+        "per_triple_s_per_million": loop_seconds * 1e6 / batch_size,
+    }
+
+
+@benchmark("monte_carlo_setup_uncertainty")
+def bench_monte_carlo_setup_uncertainty() -> Dict[str, float]:
+    """Samples per second through the vectorized decomposition, position conversion and translation chain"""
+    sample_count = 1_000_000
+    four_by_four = np.identity(4)
+    four_by_four[0:3, 3] = [10.0, -5.0, 2.5]
+    seconds = best_seconds_per_call(
+        lambda: simulate_setup_uncertainty(
+            four_by_four,
+            [100.0, 200.0, 300.0],
+            [105.0, 195.0, 305.0],
+            "HFS",
+            sample_count,
+            rotation_sigma_degrees=0.5,
+            translation_sigma_mm=1.0,
+            setup_isocenter_sigma_mm=0.5,
+            seed=0,
+        ),
+        number=1,
+        repeat=2,
+    )
+    return {"s_per_million_samples": seconds * 1e6 / sample_count}
+
+
+@benchmark("stack_center_from_path")
+def bench_stack_center_from_path() -> Dict[str, float]:
+    """CT stack center of a directory, sorted full headers against the streaming geometry only pass"""
+    slice_count = 200
+    with tempfile.TemporaryDirectory() as ct_directory:
+        for index in range(slice_count):
+            ds = Dataset()
+            ds.SOPClassUID = uid.CTImageStorage
+            ds.SOPInstanceUID = uid.generate_uid()
+            ds.PatientName = "BENCH^STACK"
+            ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+            ds.ImagePositionPatient = [-250.0, -250.0, -100.0 + index]
+            ds.PixelSpacing = [0.98, 0.98]
+            ds.Rows = 512
+            ds.Columns = 512
+            ds.PatientPosition = "HFS"
+            ds.WindowCenter = [40, 400]
+            ds.WindowWidth = [400, 2000]
+            ds.RescaleIntercept = -1024
+            ds.RescaleSlope = 1
+            for element in range(40):  # vendor private elements after the geometry, as in a scanner's headers
+                ds.add_new((0x0029, 0x1010 + element), "LO", f"PRIVATE {element}")
+            ds.save_as(Path(ct_directory) / f"CT{index}.dcm", implicit_vr=True, little_endian=True)
+        sorted_seconds = best_seconds_per_call(lambda: gen_inroom_rtss.get_stack_center_from_path(ct_directory), number=1)
+        streaming_seconds = best_seconds_per_call(
+            lambda: gen_inroom_rtss.get_stack_center_from_path_streaming(ct_directory), number=1
+        )
+    return {
+        "sorted_ms_per_stack": 1e3 * sorted_seconds,
+        "streaming_ms_per_stack": 1e3 * streaming_seconds,
+    }
+
+
+@benchmark("enhanced_ct_stack_center")
+def bench_enhanced_ct_stack_center() -> Dict[str, float]:
+    """Stack center of a one file 600 frame enhanced CT (functional groups read, pixel data not decoded)"""
+    frame_count = 600
+    ds = Dataset()
+    ds.SOPClassUID = uid.EnhancedCTImageStorage
+    ds.SOPInstanceUID = uid.generate_uid()
+    ds.SeriesInstanceUID = uid.generate_uid()
+    ds.FrameOfReferenceUID = uid.generate_uid()
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.NumberOfFrames = frame_count
+    ds.BitsAllocated = 16
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = [0.98, 0.98]
+    shared_groups = Dataset()
+    shared_groups.PlaneOrientationSequence = Sequence([plane_orientation])
+    shared_groups.PixelMeasuresSequence = Sequence([pixel_measures])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared_groups])
+    ds.PerFrameFunctionalGroupsSequence = Sequence()
+    for index in range(frame_count):
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = [-250.0, -250.0, -300.0 + index]
+        frame = Dataset()
+        frame.PlanePositionSequence = Sequence([plane_position])
+        ds.PerFrameFunctionalGroupsSequence.append(frame)
+    ds.PixelData = bytes(2 * 64 * 64)  # a small stand in, it is never read
+    with tempfile.TemporaryDirectory() as ct_directory:
+        ds.save_as(Path(ct_directory) / "CBCT.dcm", implicit_vr=True, little_endian=True)
+
+        def run():
+            (stack,) = gen_inroom_rtss.scan_stack_geometry(Path(ct_directory), workers=1)
+            return gen_inroom_rtss.get_stack_geometry_center(stack)
+
+        seconds = best_seconds_per_call(run, number=1)
+    return {"ms_per_stack": 1e3 * seconds}
+
+
+@benchmark("inroom_rtss_per_series")
+def bench_inroom_rtss_per_series() -> Dict[str, float]:
+    """In room RTSS for every series of a mixed directory, in this process against worker processes"""
+    series_count = 8
+    slice_count = 250
+    with tempfile.TemporaryDirectory() as ct_directory, tempfile.TemporaryDirectory() as output_directory:
+        for series in range(series_count):
+            series_instance_uid = uid.generate_uid()
+            frame_of_reference_uid = uid.generate_uid()
+            for index in range(slice_count):
+                ds = Dataset()
+                ds.SOPClassUID = uid.CTImageStorage
+                ds.SOPInstanceUID = uid.generate_uid()
+                ds.StudyInstanceUID = "1.2.3"
+                ds.SeriesInstanceUID = series_instance_uid
+                ds.FrameOfReferenceUID = frame_of_reference_uid
+                ds.PatientID = "BENCH"
+                ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+                ds.ImagePositionPatient = [-250.0, -250.0, -100.0 + index]
+                ds.PixelSpacing = [0.98, 0.98]
+                ds.Rows = 512
+                ds.Columns = 512
+                ds.PatientPosition = "HFS"
+                ds.save_as(Path(ct_directory) / f"CT{series}_{index}.dcm", implicit_vr=True, little_endian=True)
+
+        def run(workers):
+            with contextlib.redirect_stdout(io.StringIO()):
+                gen_inroom_rtss.generate_inroom_rtss_per_series(Path(ct_directory), Path(output_directory), workers=workers)
+
+        serial_seconds = best_seconds_per_call(lambda: run(1), number=1, repeat=2)
+        parallel_seconds = best_seconds_per_call(lambda: run(None), number=1, repeat=2)
+    file_count = series_count * slice_count
+    return {
+        "serial_files_per_second": file_count / serial_seconds,
+        "parallel_files_per_second": file_count / parallel_seconds,
+    }
+
+
+def make_export_datasets(sro_count: int) -> tuple:
+    """An in room RTSS, a plan and sro_count SROs relating them through their Frames of Reference, ready to send"""
+    cbct_frame_of_reference, plan_frame_of_reference = uid.generate_uid(), uid.generate_uid()
+    rtss_ds = make_rtss_dataset()
+    rtss_ds.SOPClassUID = uid.RTStructureSetStorage
+    frame_item = Dataset()
+    frame_item.FrameOfReferenceUID = cbct_frame_of_reference
+    rtss_ds.ReferencedFrameOfReferenceSequence = Sequence([frame_item])
+    plan_ds = make_ion_plan_dataset()
+    plan_ds.SOPClassUID = uid.RTIonPlanStorage
+    plan_ds.FrameOfReferenceUID = plan_frame_of_reference
+    sros = []
+    for _ in range(sro_count):
+        reg_ds = make_registration_dataset(rotation_about_z())
+        reg_ds.SOPClassUID = uid.SpatialRegistrationStorage
+        reg_ds.RegistrationSequence[0].FrameOfReferenceUID = cbct_frame_of_reference
+        reference_item = Dataset()
+        reference_item.FrameOfReferenceUID = plan_frame_of_reference
+        reg_ds.RegistrationSequence.append(reference_item)
+        sros.append(reg_ds)
+    for ds in [rtss_ds, plan_ds] + sros:
+        ds.SOPInstanceUID = uid.generate_uid()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = uid.ImplicitVRLittleEndian
+    return rtss_ds, plan_ds, sros
+
+
+def bench_store_scp_associations() -> Dict[str, float]:
+    """Associations per second, each storing one SRO that is calculated on arrival, from concurrent local senders"""
+    senders, associations_per_sender = 4, 50
+    rtss_ds, plan_ds, sros = make_export_datasets(senders * associations_per_sender)
+    calculated = threading.Semaphore(0)
+    scp = store_scp.CalculationSCP(on_result=lambda *result: calculated.release(), maximum_associations=2 * senders)
+    port = scp.start(port=0)
+    sender_ae = store_scp.pynetdicom.AE()
+    for sop_class in store_scp.STORAGE_SOP_CLASSES:
+        sender_ae.add_requested_context(sop_class, uid.ImplicitVRLittleEndian)
+
+    def send(datasets):
+        for ds in datasets:
+            assoc = sender_ae.associate(
+                "127.0.0.1", port, evt_handlers=[(store_scp.evt.EVT_CONN_OPEN, store_scp.disable_nagle)]
+            )
+            if not assoc.is_established:
+                raise RuntimeError("Association with the receiver was not established")
+            assoc.send_c_store(ds)
+            assoc.release()
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            send([rtss_ds, plan_ds])
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=senders) as executor:
+                list(executor.map(send, [sros[index::senders] for index in range(senders)]))
+            for _ in sros:
+                calculated.acquire()
+            seconds = time.perf_counter() - start
+    finally:
+        scp.stop()
+    return {"associations_per_second": len(sros) / seconds}
+
+
+if store_scp.pynetdicom is not None:
+    benchmark("store_scp_associations")(bench_store_scp_associations)
+
+
+def run_benchmarks(names: list[str]) -> Dict[str, Dict[str, float]]:
+    """Run the named benchmarks (all of them when names is empty) and print one line each"""
+    results = {}
+    for name in names or list(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+        formatted = ", ".join(f"{key}={value:.3f}" for key, value in results[name].items())
+        print(f"{name}: {formatted}")
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmarks(sys.argv[1:])
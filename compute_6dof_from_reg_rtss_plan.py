@@ -21,32 +21,127 @@ Returns:
 """
 
 import sys
-from typing import Tuple
+import threading
+from typing import Callable, Dict, Sequence, Tuple
 
 import numpy as np
 import pydicom
 
+import convert_matrix_to_euler as cnv
 import extract_plan_setupbeam_isocenter as ep
 import extract_reg_matrix as er
 import extract_rtss_setup_isocenter as ertss
+from memory_profile import MemoryProfiler, pop_memory_profile_argument
+
+# DICOM Patient Position (0018,5100) defined terms with a known mapping to IEC 61217 Table Top.
+# Upright (seated) treatment has no Patient Position defined term, it is not supported.
+PATIENT_POSITION_CODES: Tuple[str, ...] = (
+    "HFS",
+    "HFP",
+    "FFS",
+    "FFP",
+    "HFDR",
+    "HFDL",
+    "FFDR",
+    "FFDL",
+)
+
+_PATIENT_POSITION_INDEX = {code: index for index, code in enumerate(PATIENT_POSITION_CODES)}
+
+# Signed permutation matrices, rows are IEC Table Top [X, Y, Z], columns are DICOM Patient [x, y, z]
+_DICOM_PATIENT_TO_IEC = np.array(
+    [
+        [[1, 0, 0], [0, 0, 1], [0, -1, 0]],  # HFS
+        [[-1, 0, 0], [0, 0, 1], [0, 1, 0]],  # HFP
+        [[-1, 0, 0], [0, 0, -1], [0, -1, 0]],  # FFS
+        [[-1, 0, 0], [0, 0, -1], [0, 1, 0]],  # FFP
+        [[0, 1, 0], [0, 0, 1], [1, 0, 0]],  # HFDR
+        [[0, -1, 0], [0, 0, 1], [-1, 0, 0]],  # HFDL
+        [[0, -1, 0], [0, 0, -1], [1, 0, 0]],  # FFDR
+        [[0, 1, 0], [0, 0, -1], [-1, 0, 0]],  # FFDL
+    ],
+    dtype=np.float64,
+)
+_DICOM_PATIENT_TO_IEC.flags.writeable = False
+
+# Signed permutation matrices taking [Yaw, Pitch, Roll] decomposed as if HFS to IEC Table Top [Yaw, Pitch, Roll]
+_DICOM_YPR_TO_IEC_YPR = np.array(
+    [
+        [[1, 0, 0], [0, 1, 0], [0, 0, 1]],  # HFS
+        [[-1, 0, 0], [0, -1, 0], [0, 0, 1]],  # HFP
+        [[1, 0, 0], [0, -1, 0], [0, 0, -1]],  # FFS
+        [[-1, 0, 0], [0, 1, 0], [0, 0, -1]],  # FFP
+        [[0, 1, 0], [-1, 0, 0], [0, 0, 1]],  # HFDR
+        [[0, -1, 0], [1, 0, 0], [0, 0, 1]],  # HFDL
+        [[0, 1, 0], [1, 0, 0], [0, 0, -1]],  # FFDR
+        [[0, -1, 0], [-1, 0, 0], [0, 0, -1]],  # FFDL
+    ],
+    dtype=np.float64,
+)
+_DICOM_YPR_TO_IEC_YPR.flags.writeable = False
+
+# Sign applied to the rotated (Plan - Registration Translation) vector before subtracting it from the Setup Isocenter.
+# The prone positions use the AP and Lateral sign change that compute_6dof_from_reg_rtss_plan has been testing.
+_ROTATED_DELTA_SIGN = np.array(
+    [
+        [1, 1, 1],  # HFS
+        [-1, -1, 1],  # HFP
+        [1, 1, 1],  # FFS
+        [-1, -1, 1],  # FFP
+        [1, 1, 1],  # HFDR
+        [1, 1, 1],  # HFDL
+        [1, 1, 1],  # FFDR
+        [1, 1, 1],  # FFDL
+    ],
+    dtype=np.float64,
+)
+_ROTATED_DELTA_SIGN.flags.writeable = False
+
+
+def select_registration_matrix(reg_ds: pydicom.Dataset, rtss_ds: pydicom.Dataset, plan_ds: pydicom.Dataset) -> np.ndarray:
+    """The 4x4 registration of the SRO that registers the in room image of the RTSS to the plan
+
+    Args:
+        reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
+        rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
+        plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan
+
+    Returns:
+        np.ndarray: the 4x4 matrix (see extract_reg_matrix.extract_4x4_matrix_for_calculation)
+    """
+    return er.extract_4x4_matrix_for_calculation(
+        reg_ds, ertss.extract_rtss_frame_of_reference_uid(rtss_ds), str(plan_ds.get("FrameOfReferenceUID", ""))
+    )
 
 
 def compute_6dof_from_reg_rtss_plan(
-    reg_ds: pydicom.Dataset, rtss_ds: pydicom.Dataset, plan_ds: pydicom.Dataset,
-    tolerance_ortho_normality: float | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    reg_ds: pydicom.Dataset,
+    rtss_ds: pydicom.Dataset,
+    plan_ds: pydicom.Dataset,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
     """
     Args:
         reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
         rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
         plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan (containing the planned setup isocenter)
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which the registration rotation
+        is projected onto the nearest rotation matrix instead of failing the calculation
 
     Returns:
         The correction in IEC61217 Table Top as a pair of np.arrays,
         the first of which is the Yaw/Pitch/Roll representation and
         the second is the translation
     """
-    rotation_matrix = er.extract_matrix_as_np_array(reg_ds)
-    ypr_degrees_assume_hfs = er.decompose_matrix_order_rpy_as_ypr_degrees(rotation_matrix, tolerance_ortho_normality=tolerance_ortho_normality)
+    four_by_four_matrix = select_registration_matrix(reg_ds, rtss_ds, plan_ds)
+    rotation_matrix = four_by_four_matrix[0:3, 0:3]
+    ypr_degrees_assume_hfs = er.decompose_matrix_order_rpy_as_ypr_degrees(
+        rotation_matrix,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
 
     patient_position = plan_ds.PatientSetupSequence[0].PatientPosition
 
@@ -65,8 +160,6 @@ def compute_6dof_from_reg_rtss_plan(
     print(f"Patient Position: {patient_position}")
     print(f"Patient Support Angle: {setup_couch_angle}")
 
-    four_by_four_matrix = er.extract_4x4_matrix_as_np_array(reg_ds)
-
     rotation_inverse = rotation_matrix.transpose()  # nice feature of rotation matrices
 
     reg_translation = four_by_four_matrix[0:3, 3]
@@ -121,39 +214,360 @@ def compute_6dof_from_reg_rtss_plan(
     return ypr_degrees, translate_iec
 
 
+def compute_6dof_from_components(
+    four_by_four_matrix: np.ndarray,
+    setup_iso_dicom_patient: np.ndarray,
+    plan_iso_dicom_patient: np.ndarray,
+    patient_position: str,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Same calculation as compute_6dof_from_reg_rtss_plan, from values already extracted from the DICOM objects
+    and without the diagnostic printing of intermediate values.
+
+    Args:
+        four_by_four_matrix (np.ndarray): the 4x4 registration matrix from the SRO
+        setup_iso_dicom_patient (np.ndarray): the Setup Isocenter from the in room RTSS
+        plan_iso_dicom_patient (np.ndarray): the isocenter from the RT Ion Plan
+        patient_position (str): The DICOM Patient Position coded string from the plan
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+
+    Returns:
+        The correction in IEC61217 Table Top as a pair of np.arrays,
+        the first of which is the Yaw/Pitch/Roll representation and
+        the second is the translation
+    """
+    dicom_patient_to_iec, ypr_to_iec, rotated_delta_sign = patient_position_tables(patient_position)
+    return compute_6dof_from_position_tables(
+        np.asarray(four_by_four_matrix, dtype=np.float64),
+        np.asarray(setup_iso_dicom_patient, dtype=np.float64),
+        np.asarray(plan_iso_dicom_patient, dtype=np.float64),
+        dicom_patient_to_iec,
+        ypr_to_iec,
+        rotated_delta_sign,
+        tolerance_ortho_normality,
+        reorthonormalization_tolerance,
+    )
+
+
+def compute_6dof_from_position_tables(
+    four_by_four_matrix: np.ndarray,
+    setup_iso_dicom_patient: np.ndarray,
+    plan_iso_dicom_patient: np.ndarray,
+    dicom_patient_to_iec: np.ndarray,
+    ypr_to_iec: np.ndarray,
+    rotated_delta_sign: np.ndarray,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """compute_6dof_from_components with the Patient Position table entries already looked up
+    (see patient_position_tables), for callers that reuse them across many calculations
+    """
+    rotation_matrix = four_by_four_matrix[0:3, 0:3]
+    ypr_degrees_assume_hfs = er.decompose_matrix_order_rpy_as_ypr_degrees(
+        rotation_matrix,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+        orthonormality_check=cnv.is_orthonormal,
+    )
+    rotated_delta_plan = rotation_matrix.T @ (plan_iso_dicom_patient - four_by_four_matrix[0:3, 3])
+    translate_dicom_patient = setup_iso_dicom_patient - rotated_delta_sign * rotated_delta_plan
+    return ypr_to_iec @ ypr_degrees_assume_hfs, dicom_patient_to_iec @ translate_dicom_patient
+
+
+def compute_6dof_from_components_batch(
+    four_by_four_matrices: np.ndarray,
+    setup_iso_dicom_patient: np.ndarray,
+    plan_iso_dicom_patient: np.ndarray,
+    patient_position: str | Sequence[str],
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized compute_6dof_from_components
+
+    The inputs broadcast against each other, e.g. a single 4x4 with (N,3) plan isocenters,
+    or (N,4,4) perturbed registrations with a single setup and plan isocenter.
+    Each registration matrix given is decomposed once, so a single (4,4) is decomposed once whatever the
+    number of isocenters (identical matrices given as separate rows are not merged).
+
+    Args:
+        four_by_four_matrices (np.ndarray): (4,4) or (N,4,4) registration matrices
+        setup_iso_dicom_patient (np.ndarray): (3,) or (N,3) Setup Isocenters
+        plan_iso_dicom_patient (np.ndarray): (3,) or (N,3) plan isocenters
+        patient_position (str | Sequence[str]): one Patient Position, or one per row
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+
+    Returns:
+        The corrections in IEC61217 Table Top as a pair of (N,3) np.arrays, Yaw/Pitch/Roll and translation
+    """
+    four_by_four_matrices = np.asarray(four_by_four_matrices, dtype=np.float64).reshape(-1, 4, 4)
+    setup_iso_dicom_patient = np.asarray(setup_iso_dicom_patient, dtype=np.float64).reshape(-1, 3)
+    plan_iso_dicom_patient = np.asarray(plan_iso_dicom_patient, dtype=np.float64).reshape(-1, 3)
+    rotation_matrices = four_by_four_matrices[:, 0:3, 0:3]
+    ypr_degrees_assume_hfs = er.decompose_matrices_order_rpy_as_ypr_degrees(
+        rotation_matrices,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
+
+    count = max(len(four_by_four_matrices), len(setup_iso_dicom_patient), len(plan_iso_dicom_patient))
+    if not isinstance(patient_position, str):
+        count = max(count, len(patient_position))
+    rotation_matrices = np.broadcast_to(rotation_matrices, (count, 3, 3))
+    delta_plan = np.broadcast_to(plan_iso_dicom_patient - four_by_four_matrices[:, 0:3, 3], (count, 3))
+    rotated_delta_plan = np.einsum("nji,nj->ni", rotation_matrices, delta_plan)
+    rotated_delta_sign = _ROTATED_DELTA_SIGN[patient_position_index(patient_position)]
+    translate_dicom_patient = setup_iso_dicom_patient - rotated_delta_sign * rotated_delta_plan
+
+    ypr_degrees = _apply_position_table(
+        _DICOM_YPR_TO_IEC_YPR, np.broadcast_to(ypr_degrees_assume_hfs, (count, 3)), patient_position
+    )
+    translate_iec = _apply_position_table(_DICOM_PATIENT_TO_IEC, translate_dicom_patient, patient_position)
+    return ypr_degrees, translate_iec
+
+
+def compute_6dof_for_all_registrations(
+    reg_ds: pydicom.Dataset,
+    rtss_ds: pydicom.Dataset,
+    plan_ds: pydicom.Dataset,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Tuple[Dict[str, int], np.ndarray, np.ndarray]:
+    """Evaluate every registration in the SRO in one batched call
+
+    Args:
+        reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
+        rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
+        plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan (containing the planned setup isocenter)
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+
+    Returns:
+        The row of each Frame of Reference UID, and the (K,3) Yaw/Pitch/Roll and (K,3) translations
+        in IEC61217 Table Top, one row per registration in the SRO
+    """
+    four_by_four_matrices, index_of_frame_of_reference = er.extract_registration_matrices(reg_ds)
+    if len(four_by_four_matrices) == 0:
+        raise ValueError("No matrix registration in SRO")
+    ypr_degrees, translate_iec = compute_6dof_from_components_batch(
+        four_by_four_matrices,
+        np.array(ertss.extract_rtss_setup_isocenter(rtss_ds), dtype=np.float64),
+        np.array(ep.extract_plan_setupbeam_isocenter(plan_ds), dtype=np.float64),
+        str(plan_ds.PatientSetupSequence[0].PatientPosition),
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
+    return index_of_frame_of_reference, ypr_degrees, translate_iec
+
+
+def compute_6dof_for_all_isocenters(
+    reg_ds: pydicom.Dataset,
+    rtss_ds: pydicom.Dataset,
+    plan_ds: pydicom.Dataset,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Dict[str, object]:
+    """Correction table for every distinct (isocenter, Patient Support Angle) in the plan, in one batched call
+
+    Args:
+        reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
+        rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
+        plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+
+    Returns:
+        Dict[str, object]: "isocenter" (M,3) in DICOM Patient, "patient_support_angle" (M,),
+        "beam_numbers" (list of M lists), and the IEC 61217 Table Top "ypr_degrees" (M,3) and "translation_iec_mm" (M,3)
+    """
+    isocenters, couch_angles, beam_numbers = ep.extract_plan_isocenters_and_couch_angles(plan_ds)
+    ypr_degrees, translate_iec = compute_6dof_from_components_batch(
+        select_registration_matrix(reg_ds, rtss_ds, plan_ds),
+        np.array(ertss.extract_rtss_setup_isocenter(rtss_ds), dtype=np.float64),
+        isocenters,
+        str(plan_ds.PatientSetupSequence[0].PatientPosition),
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
+    return {
+        "isocenter": isocenters,
+        "patient_support_angle": couch_angles,
+        "beam_numbers": beam_numbers,
+        "ypr_degrees": ypr_degrees,
+        "translation_iec_mm": translate_iec,
+    }
+
+
+def patient_support_rotation_matrices(patient_support_angles_degrees: np.ndarray) -> np.ndarray:
+    """Rotation about IEC 61217 Fixed Z for each Patient Support Angle (counter clockwise seen from above)
+
+    Args:
+        patient_support_angles_degrees (np.ndarray): (N,) Patient Support Angles in degrees
+
+    Returns:
+        np.ndarray: (N,3,3) matrices taking Table Top (at zero pitch and roll) vectors into IEC Fixed
+    """
+    angles = np.radians(np.asarray(patient_support_angles_degrees, dtype=np.float64))
+    rotation_matrices = np.zeros((len(angles), 3, 3), dtype=np.float64)
+    rotation_matrices[:, 0, 0] = np.cos(angles)
+    rotation_matrices[:, 0, 1] = -np.sin(angles)
+    rotation_matrices[:, 1, 0] = np.sin(angles)
+    rotation_matrices[:, 1, 1] = np.cos(angles)
+    rotation_matrices[:, 2, 2] = 1.0
+    return rotation_matrices
+
+
+def express_at_patient_support_angles(
+    ypr_degrees: np.ndarray, translate_iec: np.ndarray, patient_support_angles_degrees: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Express Table Top corrections in IEC 61217 Fixed coordinates with the patient support rotated to each angle
+
+    The rotation matrices are computed once per distinct angle. The Table Top rotation is composed in the
+    convention the Yaw, Pitch, Roll come from (decompose_matrices_order_rpy_as_ypr_degrees: pitch about IEC X,
+    then yaw about IEC Z, then roll about IEC Y), conjugated by the patient support rotation (P R P^T) and
+    decomposed again in the same convention.
+
+    Args:
+        ypr_degrees (np.ndarray): (N,3) Table Top Yaw, Pitch, Roll in degrees
+        translate_iec (np.ndarray): (N,3) Table Top translations
+        patient_support_angles_degrees (np.ndarray): (N,) Patient Support Angle of each row
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the (N,3) Yaw, Pitch, Roll and the (N,3) translations in IEC Fixed
+    """
+    unique_angles, row_of_angle = np.unique(np.asarray(patient_support_angles_degrees, dtype=np.float64), return_inverse=True)
+    support_rotations = patient_support_rotation_matrices(unique_angles)[row_of_angle]
+
+    translate_fixed = np.einsum("nij,nj->ni", support_rotations, np.asarray(translate_iec, dtype=np.float64))
+    pitch_yaw_roll = np.radians(np.reshape(ypr_degrees, (-1, 3))[:, [1, 0, 2]])
+    table_top_rotations = cnv.euler_angles_to_rotation_matrix_ordered(pitch_yaw_roll, "xzy")
+    fixed_rotations = support_rotations @ table_top_rotations @ np.transpose(support_rotations, (0, 2, 1))
+    pitch_yaw_roll_fixed = np.degrees(cnv.rotation_matrix_to_euler_angles_ordered(fixed_rotations, "xzy"))
+    return pitch_yaw_roll_fixed[:, [1, 0, 2]], translate_fixed
+
+
+def compute_6dof_per_beam(
+    reg_ds: pydicom.Dataset,
+    rtss_ds: pydicom.Dataset,
+    plan_ds: pydicom.Dataset,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Dict[str, np.ndarray]:
+    """Correction table with one row per beam, also expressed at the beam's Patient Support Angle
+
+    The plan is traversed once, the correction is computed once per distinct (isocenter, Patient Support Angle)
+    and the rotation to the couch angle once per distinct angle, all in batch.
+
+    Args:
+        reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
+        rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
+        plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+
+    Returns:
+        Dict[str, np.ndarray]: in Beam Number order, "beam_number" (B,), "patient_support_angle" (B,),
+        "isocenter" (B,3), the Table Top "ypr_degrees" and "translation_iec_mm" (B,3), and the same correction
+        in IEC Fixed with the couch at the beam's angle, "ypr_degrees_at_couch_angle" and
+        "translation_iec_mm_at_couch_angle" (B,3)
+    """
+    table = compute_6dof_for_all_isocenters(
+        reg_ds,
+        rtss_ds,
+        plan_ds,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
+    ypr_at_couch_angle, translate_at_couch_angle = express_at_patient_support_angles(
+        table["ypr_degrees"], table["translation_iec_mm"], table["patient_support_angle"]
+    )
+    beams_per_row = [len(beam_numbers) for beam_numbers in table["beam_numbers"]]
+    beam_numbers = np.concatenate([np.asarray(numbers, dtype=np.int64) for numbers in table["beam_numbers"]])
+    order = np.argsort(beam_numbers, kind="stable")
+    row_of_beam = np.repeat(np.arange(len(beams_per_row)), beams_per_row)[order]
+    return {
+        "beam_number": beam_numbers[order],
+        "patient_support_angle": table["patient_support_angle"][row_of_beam],
+        "isocenter": table["isocenter"][row_of_beam],
+        "ypr_degrees": table["ypr_degrees"][row_of_beam],
+        "translation_iec_mm": table["translation_iec_mm"][row_of_beam],
+        "ypr_degrees_at_couch_angle": ypr_at_couch_angle[row_of_beam],
+        "translation_iec_mm_at_couch_angle": translate_at_couch_angle[row_of_beam],
+    }
+
+
+def patient_position_tables(patient_position: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The (read only) table entries used by the calculation for a Patient Position
+
+    Args:
+        patient_position (str): The DICOM Patient Position coded string
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: the DICOM Patient to IEC Table Top 3x3 matrix,
+        the Yaw/Pitch/Roll 3x3 matrix, and the sign applied to the rotated plan isocenter offset
+    """
+    index = patient_position_index(patient_position)
+    return _DICOM_PATIENT_TO_IEC[index], _DICOM_YPR_TO_IEC_YPR[index], _ROTATED_DELTA_SIGN[index]
+
+
+def patient_position_index(patient_position: str | Sequence[str]) -> int | np.ndarray:
+    """Look up the row of the patient position tables for one or more DICOM Patient Position codes
+
+    Args:
+        patient_position (str | Sequence[str]): a single DICOM Patient Position (0018,5100) code,
+        or a sequence of codes (one per element of a batch)
+
+    Raises:
+        ValueError: When a Patient Position code is not in PATIENT_POSITION_CODES
+
+    Returns:
+        int | np.ndarray: the table index, or an array of table indices for a sequence of codes
+    """
+    if isinstance(patient_position, str):
+        try:
+            return _PATIENT_POSITION_INDEX[patient_position]
+        except KeyError:
+            raise ValueError(f"patient position {patient_position} not supported yet") from None
+    return np.array([patient_position_index(position) for position in patient_position], dtype=np.intp)
+
+
 def convert_dicom_patient_ypr_to_iec_ypr(ypr_in_dcm: np.ndarray, patient_position: str) -> np.ndarray:
-    """_summary_
+    """Convert the yaw, pitch, and roll decomposed assuming HFS into IEC 61217 Table Top yaw, pitch, and roll
+
+    For HFS, HFP, FFS and FFP the conversion only changes signs and is exact.
+    For the decubitus and sitting positions the angles are exchanged between axes,
+    which is exact for a single rotation and correct to first order for combined (small) rotations.
 
     Args:
         ypr_in_dcm (np.ndarray): the yaw, pitch, and roll decomposed from the SRO 4x4 in RPY order,
         but without addressing whether the patient was in some position other than HFS
 
-        patient_position (str): The string from DICOM Patient Position (0018,5100) element, e.g. HFS HFP FFP FFS
+        patient_position (str): The string from DICOM Patient Position (0018,5100) element, e.g. HFS HFP FFP FFS HFDR
+
+    Raises:
+        ValueError: When the DICOM Patient Position is not yet supported in this function
 
     Returns:
         np.ndarray: the yaw, pitch, and roll that is directly applicable to an IEC 61217 Table Top
     """
-    ypr_in_iec = np.array([0.0, 0.0, 0.0])
-    if patient_position == "HFS":
-        ypr_in_iec[0] = ypr_in_dcm[0]  # Yaw
-        ypr_in_iec[1] = ypr_in_dcm[1]  # Pitch
-        ypr_in_iec[2] = ypr_in_dcm[2]  # Roll
-    elif patient_position == "HFP":
-        ypr_in_iec[0] = -ypr_in_dcm[0]  # Z axis
-        ypr_in_iec[1] = -ypr_in_dcm[1]  # X axis
-        ypr_in_iec[2] = ypr_in_dcm[2]  # Y axis
-    elif patient_position == "FFP":
-        ypr_in_iec[0] = -ypr_in_dcm[0]
-        ypr_in_iec[1] = ypr_in_dcm[1]
-        ypr_in_iec[2] = -ypr_in_dcm[2]
-    elif patient_position == "FFS":
-        ypr_in_iec[0] = ypr_in_dcm[0]
-        ypr_in_iec[1] = -ypr_in_dcm[1]
-        ypr_in_iec[2] = -ypr_in_dcm[2]
-    else:
-        raise ValueError(f"patient position {patient_position} not supported yet")
-
-    return ypr_in_iec
+    return _DICOM_YPR_TO_IEC_YPR[patient_position_index(patient_position)] @ np.asarray(ypr_in_dcm, dtype=np.float64)
+
+
+def convert_dicom_patient_ypr_to_iec_ypr_batch(
+    ypr_in_dcm: np.ndarray, patient_position: str | Sequence[str]
+) -> np.ndarray:
+    """Batch version of convert_dicom_patient_ypr_to_iec_ypr
+
+    Args:
+        ypr_in_dcm (np.ndarray): (N,3) yaw, pitch, and roll decomposed assuming HFS
+        patient_position (str | Sequence[str]): one Patient Position for the whole batch, or one per row
+
+    Returns:
+        np.ndarray: (N,3) yaw, pitch, and roll in IEC 61217 Table Top
+    """
+    return _apply_position_table(_DICOM_YPR_TO_IEC_YPR, ypr_in_dcm, patient_position)
 
 
 def convert_dicom_patient_to_tait_bryan(iso_in_dcm: np.ndarray) -> np.ndarray:
@@ -202,26 +616,29 @@ def convert_dicom_patient_to_iec(iso_in_dcm: np.ndarray, patient_position: str)
     Returns:
         np.ndarray: The translation in IEC 61217 Table Top coordinates
     """
-    iso_in_iec = np.array([0.0, 0.0, 0.0])
-    if patient_position == "HFS":
-        iso_in_iec[0] = iso_in_dcm[0]
-        iso_in_iec[1] = iso_in_dcm[2]
-        iso_in_iec[2] = -iso_in_dcm[1]
-    elif patient_position == "HFP":
-        iso_in_iec[0] = -iso_in_dcm[0]
-        iso_in_iec[1] = iso_in_dcm[2]
-        iso_in_iec[2] = iso_in_dcm[1]
-    elif patient_position == "FFP":
-        iso_in_iec[0] = -iso_in_dcm[0]
-        iso_in_iec[1] = -iso_in_dcm[2]
-        iso_in_iec[2] = iso_in_dcm[1]
-    elif patient_position == "FFS":
-        iso_in_iec[0] = -iso_in_dcm[0]
-        iso_in_iec[1] = -iso_in_dcm[2]
-        iso_in_iec[2] = -iso_in_dcm[1]
-    else:
-        raise ValueError(f"patient position {patient_position} not supported yet")
-    return iso_in_iec
+    return _DICOM_PATIENT_TO_IEC[patient_position_index(patient_position)] @ np.asarray(iso_in_dcm, dtype=np.float64)
+
+
+def convert_dicom_patient_to_iec_batch(iso_in_dcm: np.ndarray, patient_position: str | Sequence[str]) -> np.ndarray:
+    """Batch version of convert_dicom_patient_to_iec
+
+    Args:
+        iso_in_dcm (np.ndarray): (N,3) translations in DICOM Patient coordinates
+        patient_position (str | Sequence[str]): one Patient Position for the whole batch, or one per row
+
+    Returns:
+        np.ndarray: (N,3) translations in IEC 61217 Table Top coordinates
+    """
+    return _apply_position_table(_DICOM_PATIENT_TO_IEC, iso_in_dcm, patient_position)
+
+
+def _apply_position_table(table: np.ndarray, vectors: np.ndarray, patient_position: str | Sequence[str]) -> np.ndarray:
+    """Multiply each row of vectors by the table entry for its patient position (no branching on the position)"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    index = patient_position_index(patient_position)
+    if np.ndim(index) == 0:
+        return vectors @ table[index].T
+    return np.einsum("nij,nj->ni", table[index], vectors)
 
 
 def extend3d_to_4d(vec3: np.ndarray) -> np.ndarray:
@@ -240,28 +657,123 @@ def extend3d_to_4d(vec3: np.ndarray) -> np.ndarray:
     return vec4
 
 
-def do_calculate(sro_path: str, rtss_path: str, ionPlan_path: str):
-    """Do the calculation based on the input DICOM files
+CALCULATION_STAGES = ("Reading SRO", "Reading in-room RTSS", "Reading RT Ion Plan", "Calculating")
+
+
+class CalculationCancelled(Exception):
+    """Raised by do_calculate when its cancel_event is set"""
+
+
+def mosaiq_display_values(ypr: np.ndarray, translation: np.ndarray) -> Dict[str, float]:
+    """The correction as MOSAIQ displays it, translations in cm and rotations per IEC axis, rounded to 0.1
 
     Args:
-        SRO file path
-        in-room RTSS file path
-        RT Ion Plan file path
+        ypr (np.ndarray): IEC Rotation [Yaw, Pitch, Roll] in degrees
+        translation (np.ndarray): IEC Translation in mm [Lateral, Longitudinal, Vertical]
+
+    Returns:
+        Dict[str, float]: lateral_cm, longitudinal_cm, vertical_cm, rotation_x_deg, rotation_y_deg, rotation_z_deg
     """
-    sro_ds = pydicom.dcmread(sro_path, force=True)
-    inroom_rtss_ds = pydicom.dcmread(rtss_path, force=True)
-    rtionplan_ds = pydicom.dcmread(ionPlan_path, force=True)
-    ypr, translation = compute_6dof_from_reg_rtss_plan(sro_ds, inroom_rtss_ds, rtionplan_ds)
+    return {
+        "lateral_cm": float(round(translation[0] / 10.0, 1)),
+        "longitudinal_cm": float(round(translation[1] / 10.0, 1)),
+        "vertical_cm": float(round(translation[2] / 10.0, 1)),
+        "rotation_x_deg": float(round(ypr[1], 1)),
+        "rotation_y_deg": float(round(ypr[2], 1)),
+        "rotation_z_deg": float(round(ypr[0], 1)),
+    }
+
+
+def report_correction(ypr: np.ndarray, translation: np.ndarray) -> None:
+    """Print the correction, in mm and degrees and as MOSAIQ displays it"""
     print(f"IEC Translation in mm[Lateral, Longitudinal, Vertical]: {translation}")
     print(f"IEC Rotation [Yaw, Pitch, Roll]: {ypr}")
 
+    display = mosaiq_display_values(ypr, translation)
     print("MOSAIQ Display:")
     print(
         f"IEC Translation in cm [Lateral, Longitudinal, Vertical]:\
-              [{round(translation[0]/10.0,1)}, {round(translation[1]/10.0,1)}, {round(translation[2]/10.0,1)}]"
+              [{display['lateral_cm']}, {display['longitudinal_cm']}, {display['vertical_cm']}]"
+    )
+    print(
+        "IEC Rotation [X axis, Y axis, Z axis]: "
+        f"[{display['rotation_x_deg']}, {display['rotation_y_deg']}, {display['rotation_z_deg']}]"
     )
-    print(f"IEC Rotation [X axis, Y axis, Z axis]: [{round(ypr[1],1)}, {round(ypr[2],1)}, {round(ypr[0],1)}]")
+
+
+def do_calculate(
+    sro_path: str,
+    rtss_path: str,
+    ionPlan_path: str,
+    reorthonormalization_tolerance: float | None = None,
+    result_writer=None,
+    progress: Callable[[str], None] | None = None,
+    cancel_event: threading.Event | None = None,
+    read_dataset: Callable[[str], pydicom.Dataset] | None = None,
+    memory_profiler: MemoryProfiler | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Do the calculation based on the input DICOM files
+
+    Args:
+        SRO file path
+        in-room RTSS file path
+        RT Ion Plan file path
+        reorthonormalization_tolerance: wider bound within which the registration rotation is re-orthonormalized
+        result_writer: optional result_writers.ResultWriter that the correction record is also written to
+        progress: optional callable, called with the name of each stage (one of CALCULATION_STAGES) as it starts
+        cancel_event: optional threading.Event, checked before each stage
+        read_dataset: optional callable returning the dataset for a path (e.g. from a preload cache),
+        by default the file is read with pydicom.dcmread
+        memory_profiler: optional memory_profile.MemoryProfiler, records each stage (one of CALCULATION_STAGES)
+
+    Returns:
+        The correction in IEC61217 Table Top, Yaw/Pitch/Roll and translation
+
+    Raises:
+        CalculationCancelled: if cancel_event was set before the calculation finished
+    """
+
+    def start_stage(stage: str) -> None:
+        if cancel_event is not None and cancel_event.is_set():
+            raise CalculationCancelled(f"Calculation cancelled before {stage}")
+        if progress is not None:
+            progress(stage)
+        if memory_profiler is not None:
+            memory_profiler.start(stage)
+
+    if read_dataset is None:
+
+        def read_dataset(path: str) -> pydicom.Dataset:
+            return pydicom.dcmread(path, force=True)
+
+    try:
+        start_stage(CALCULATION_STAGES[0])
+        sro_ds = read_dataset(sro_path)
+        start_stage(CALCULATION_STAGES[1])
+        inroom_rtss_ds = read_dataset(rtss_path)
+        start_stage(CALCULATION_STAGES[2])
+        rtionplan_ds = read_dataset(ionPlan_path)
+        start_stage(CALCULATION_STAGES[3])
+        ypr, translation = compute_6dof_from_reg_rtss_plan(
+            sro_ds, inroom_rtss_ds, rtionplan_ds, reorthonormalization_tolerance=reorthonormalization_tolerance
+        )
+    finally:
+        if memory_profiler is not None:
+            memory_profiler.stop()
+    report_correction(ypr, translation)
+
+    if result_writer is not None:
+        result_writer.write_correction(ypr, translation, sro_ds, inroom_rtss_ds, rtionplan_ds)
+    return ypr, translation
 
 
 if __name__ == "__main__":
-    do_calculate(sys.argv[1], sys.argv[2], sys.argv[3])
+    # --memory-profile <file.json> (- for stderr) reports the memory used by each stage
+    memory_profile_path = pop_memory_profile_argument(sys.argv)
+    profiler = MemoryProfiler() if memory_profile_path is not None else None
+    # optional fourth argument: the bound within which a drifting registration rotation is re-orthonormalized
+    do_calculate(
+        sys.argv[1], sys.argv[2], sys.argv[3], float(sys.argv[4]) if len(sys.argv) > 4 else None, memory_profiler=profiler
+    )
+    if profiler is not None:
+        profiler.write(memory_profile_path)
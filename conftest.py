@@ -6,6 +6,8 @@ from pathlib import Path
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 
+from mock_datasets import make_ion_plan_dataset, make_registration_dataset, make_rtss_dataset
+
 @pytest.fixture
 def create_temp_directory():
     """Create a temporary directory for test files."""
@@ -45,33 +47,75 @@ def create_mock_ct_dataset():
     return ds
 
 
-def create_matrix_item():
-    """Create the matrix item with the 4x4 transformation matrix."""
-    matrix_item = Dataset()
-    matrix_item.FrameOfReferenceTransformationMatrix = [
-        0.999, 0.012, 0.008, 10.0,   # First row
-        -0.010, 0.998, 0.015, -5.0,   # Second row
-        -0.009, -0.014, 0.999, 2.5,   # Third row
-        0.0, 0.0, 0.0, 1.0            # Fourth row
-    ]
-    return matrix_item
+@pytest.fixture
+def create_mock_registration_dataset():
+    """Create a mock registration dataset with transformation matrix."""
+    return make_registration_dataset()
 
 
-def build_registration_sequence(matrix_item):
-    """Compose the nested registration sequence using the matrix item."""
-    matrix_seq = Sequence([matrix_item])
-    matrix_reg_item = Dataset()
-    matrix_reg_item.MatrixSequence = matrix_seq
-    matrix_reg_seq = Sequence([matrix_reg_item])
-    reg_item = Dataset()
-    reg_item.MatrixRegistrationSequence = matrix_reg_seq
-    return Sequence([reg_item])
+@pytest.fixture
+def create_mock_rtss_dataset():
+    """Create a mock in room RT Structure Set with a SetupIsocenter point."""
+    return make_rtss_dataset()
 
 
 @pytest.fixture
-def create_mock_registration_dataset():
-    """Create a mock registration dataset with transformation matrix."""
-    reg_ds = Dataset()
-    matrix_item = create_matrix_item()
-    reg_ds.RegistrationSequence = build_registration_sequence(matrix_item)
-    return reg_ds
+def create_mock_ion_plan_dataset():
+    """Create a mock RT Ion Plan with a single beam and a patient setup."""
+    return make_ion_plan_dataset()
+
+
+@pytest.fixture
+def create_mock_export_set(create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset):
+    """The mock SRO, in room RTSS and RT Ion Plan with the SOP Classes and Frames of Reference that relate them.
+    The SRO registers the CBCT Frame of Reference of the RTSS (first item) to the plan's Frame of Reference.
+    """
+    reg_ds = create_mock_registration_dataset
+    reg_ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.66.1"  # Spatial Registration Storage
+    reg_ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.6"
+    reg_ds.RegistrationSequence[0].FrameOfReferenceUID = "1.2.3.4.5.6.7.8.9.2"
+    reference_item = Dataset()
+    reference_item.FrameOfReferenceUID = "1.2.3.4.5.6.7.8.9.5"
+    reg_ds.RegistrationSequence.append(reference_item)
+
+    rtss_ds = create_mock_rtss_dataset
+    rtss_ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.481.3"  # RT Structure Set Storage
+    frame_item = Dataset()
+    frame_item.FrameOfReferenceUID = "1.2.3.4.5.6.7.8.9.2"
+    rtss_ds.ReferencedFrameOfReferenceSequence = Sequence([frame_item])
+
+    plan_ds = create_mock_ion_plan_dataset
+    plan_ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.481.8"  # RT Ion Plan Storage
+    referenced_rtss_item = Dataset()
+    referenced_rtss_item.ReferencedSOPInstanceUID = "1.2.3.4.5.6.7.8.9.7"
+    plan_ds.ReferencedStructureSetSequence = Sequence([referenced_rtss_item])
+    return reg_ds, rtss_ds, plan_ds
+
+
+@pytest.fixture
+def dicom_paths(tmp_path, create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset):
+    """The mock SRO, in room RTSS and RT Ion Plan written to files, as [sro_path, rtss_path, plan_path]."""
+    paths = []
+    for name, ds in (
+        ("sro.dcm", create_mock_registration_dataset),
+        ("rtss.dcm", create_mock_rtss_dataset),
+        ("plan.dcm", create_mock_ion_plan_dataset),
+    ):
+        paths.append(str(tmp_path / name))
+        ds.save_as(paths[-1], implicit_vr=True, little_endian=True)
+    return paths
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--max-slowdown",
+        type=float,
+        default=None,
+        help="performance gate: allowed slowdown against perf_baselines.json (time is not checked without it)",
+    )
+    parser.addoption(
+        "--max-memory-growth",
+        type=float,
+        default=None,
+        help="performance gate: allowed peak memory growth against perf_baselines.json",
+    )
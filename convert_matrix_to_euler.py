@@ -9,15 +9,45 @@
 Returns:
     np.ndarray: the Euler angles
 """
+import logging
 import math
+from typing import Callable, Tuple
 
 import numpy as np
 
 
+# Production threshold for the difference of R^T R from identity
+DEFAULT_TOLERANCE_ORTHO_NORMALITY = 2e-6
+
+# Smallest to largest singular value ratio below which a matrix is treated as singular
+_RANK_TOLERANCE = 3 * np.finfo(np.float64).eps
+
+
+def orthonormality_error(rotation_matrix: np.ndarray) -> float:
+    """Frobenius norm of the difference of R^T R from identity
+    Computed element by element from the six distinct entries of the symmetric R^T R,
+    without building an identity or a product matrix
+
+    Args:
+        rotation_matrix (np.ndarray): the 3x3 matrix
+
+    Returns:
+        float: the Frobenius norm of (R^T R - I)
+    """
+    (r00, r01, r02), (r10, r11, r12), (r20, r21, r22) = rotation_matrix.tolist()
+    g00 = r00 * r00 + r10 * r10 + r20 * r20 - 1.0
+    g11 = r01 * r01 + r11 * r11 + r21 * r21 - 1.0
+    g22 = r02 * r02 + r12 * r12 + r22 * r22 - 1.0
+    g01 = r00 * r01 + r10 * r11 + r20 * r21
+    g02 = r00 * r02 + r10 * r12 + r20 * r22
+    g12 = r01 * r02 + r11 * r12 + r21 * r22
+    return math.sqrt(g00 * g00 + g11 * g11 + g22 * g22 + 2.0 * (g01 * g01 + g02 * g02 + g12 * g12))
+
+
 # Checks if a matrix is a valid rotation matrix.
 def is_rotation_matrix(rotation_matrix: np.ndarray, tolerance_ortho_normality=None) -> bool:
     """Checks if a matrix is a valid rotation matrix.
-    By transposing, multiplying, and checking the diagonal norm
+    By checking the Frobenius norm of the difference of R^T R from identity
     Args:
         rotation_matrix (np.ndarray): the rotation matrix
 
@@ -25,35 +55,121 @@ def is_rotation_matrix(rotation_matrix: np.ndarray, tolerance_ortho_normality=No
         bool: true if the matrix is close enough to a rotation matrix to be decomposable
     """
     if tolerance_ortho_normality is None:
-        tolerance_ortho_normality = 2e-6  # Production threshold
+        tolerance_ortho_normality = DEFAULT_TOLERANCE_ORTHO_NORMALITY
     else:
         print(f"Externally specified identity Tolerance: {tolerance_ortho_normality} ")
 
-    transpose = np.transpose(rotation_matrix)
-    should_be_identity = np.dot(transpose, rotation_matrix)
-    identity_matrix = np.identity(3, dtype=rotation_matrix.dtype)
-    norm = np.linalg.norm(identity_matrix - should_be_identity)
+    norm = orthonormality_error(rotation_matrix)
     print(f"difference from identity = {norm}")
-    # while this can be more compactly expressed as "return norm < tolerance"
-    # the result is not the same.  Don't ask me why.  Bad smell, I know.
-    if (norm < tolerance_ortho_normality):
-        return True
-    return False
+    # norm is a python float (not np.float64), so the comparison is a python bool
+    return norm < tolerance_ortho_normality
+
 
+def is_orthonormal(rotation_matrix: np.ndarray, tolerance_ortho_normality: float | None = None) -> bool:
+    """is_rotation_matrix without printing the tolerance and the difference from identity
 
-def rotation_matrix_to_euler_angles(rotation_matrix: np.ndarray, tolerance_ortho_normality: float | None = None) -> np.ndarray:
+    Args:
+        rotation_matrix (np.ndarray): the rotation matrix
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+
+    Returns:
+        bool: true if the matrix is close enough to a rotation matrix to be decomposable
+    """
+    if tolerance_ortho_normality is None:
+        tolerance_ortho_normality = DEFAULT_TOLERANCE_ORTHO_NORMALITY
+    return orthonormality_error(rotation_matrix) < tolerance_ortho_normality
+
+
+def nearest_rotation_matrix(matrix: np.ndarray) -> Tuple[np.ndarray, float | np.ndarray]:
+    """Project a 3x3 matrix (or a stack of them) onto the nearest rotation matrix (in the Frobenius norm)
+    using the singular value decomposition, i.e. the orthogonal factor of the polar decomposition
+    with the sign of the smallest singular direction chosen so the determinant is +1
+
+    Args:
+        matrix (np.ndarray): a 3x3 matrix, or an (N,3,3) stack
+
+    Raises:
+        ValueError: When a matrix is singular, its nearest rotation matrix is not unique
+
+    Returns:
+        Tuple[np.ndarray, float | np.ndarray]: the rotation matrix (or stack),
+        and the Frobenius norm of the correction that was applied (per matrix for a stack)
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    u, singular_values, vt = np.linalg.svd(matrix)
+    if np.any(singular_values[..., 2] <= _RANK_TOLERANCE * singular_values[..., 0]):
+        raise ValueError("Singular matrix, there is no unique nearest rotation matrix")
+    u[..., :, 2] *= np.sign(np.linalg.det(u @ vt))[..., np.newaxis]
+    rotation_matrix = u @ vt
+    correction = np.linalg.norm(rotation_matrix - matrix, axis=(-2, -1))
+    if correction.ndim == 0:
+        correction = float(correction)
+    return rotation_matrix, correction
+
+
+def log_reorthonormalization(orthonormality_error: float | np.ndarray, correction: float | np.ndarray) -> None:
+    """Log a re-orthonormalization for audit, with the values as the record's
+    orthonormality_error and reorthonormalization_correction attributes (floats, or lists for a stack)
+
+    Args:
+        orthonormality_error (float | np.ndarray): difference of R^T R from identity before the correction
+        correction (float | np.ndarray): Frobenius norm of the correction applied
+    """
+    extra = {
+        "orthonormality_error": np.asarray(orthonormality_error).tolist(),
+        "reorthonormalization_correction": np.asarray(correction).tolist(),
+    }
+    if np.ndim(correction) == 0:
+        logging.warning(
+            "Re-orthonormalized rotation matrix, difference from identity = %s, correction (Frobenius norm) = %s",
+            extra["orthonormality_error"],
+            extra["reorthonormalization_correction"],
+            extra=extra,
+        )
+    else:
+        logging.warning(
+            "Re-orthonormalized %d rotation matrices, largest difference from identity = %s, "
+            "largest correction (Frobenius norm) = %s",
+            np.size(correction),
+            np.max(orthonormality_error),
+            np.max(correction),
+            extra=extra,
+        )
+
+
+def rotation_matrix_to_euler_angles(
+    rotation_matrix: np.ndarray,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+    orthonormality_check: Callable[..., bool] = is_rotation_matrix,
+) -> np.ndarray:
     """Calculates rotation matrix to euler angles
     The result is the same as MATLAB except the order
     of the euler angles ( x and z are swapped ).
 
     Args:
         rotation_matrix (np.ndarray): the 3x3 rotation matrix
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): when the matrix fails the orthonormality check
+        but the difference is below this (wider) bound, the matrix is replaced by the nearest rotation
+        matrix and the decomposition continues (and is logged, see log_reorthonormalization).
+        None (the default) disables re-orthonormalization.
+        orthonormality_check (Callable[..., bool]): the check of the matrix, is_rotation_matrix (which prints
+        the difference from identity) by default, is_orthonormal to decompose without printing
+
+    Raises:
+        ValueError: When the matrix is not close enough to a rotation matrix
 
     Returns:
         np.ndarray: the euler angles in order Roll, Pitch, Yaw
     """
 
-    assert is_rotation_matrix(rotation_matrix, tolerance_ortho_normality=tolerance_ortho_normality)
+    if not orthonormality_check(rotation_matrix, tolerance_ortho_normality=tolerance_ortho_normality):
+        norm = orthonormality_error(rotation_matrix)
+        if reorthonormalization_tolerance is None or not norm < reorthonormalization_tolerance:
+            raise ValueError(f"Matrix is not a rotation matrix, difference from identity = {norm}")
+        rotation_matrix, correction = nearest_rotation_matrix(rotation_matrix)
+        log_reorthonormalization(norm, correction)
 
     _sy = math.sqrt(rotation_matrix[0, 0] * rotation_matrix[0, 0] + rotation_matrix[1, 0] * rotation_matrix[1, 0])
 
@@ -113,6 +229,167 @@ def euler_angles_to_rotation_matrix(theta: np.ndarray) -> np.ndarray:
     return rotation_matrix
 
 
+def euler_angles_to_rotation_matrix_batch(theta: np.ndarray) -> np.ndarray:
+    """Vectorized euler_angles_to_rotation_matrix, R = Rz @ Ry @ Rx (euler_angles_to_rotation_matrix_ordered for "xyz")
+
+    Args:
+        theta (np.ndarray): (N,3) euler angles in order of Roll, Pitch, Yaw (Tait-Bryan)
+
+    Returns:
+        np.ndarray: (N,3,3) rotation matrices
+    """
+    theta = np.asarray(theta, dtype=np.float64)
+    if theta.ndim != 2 or theta.shape[1] != 3:
+        raise ValueError(f"Expected (N,3) euler angles, got shape {theta.shape}")
+    return euler_angles_to_rotation_matrix_ordered(theta, "xyz")
+
+
+# Axis sequences, in the order the rotations are applied about the fixed (extrinsic) axes,
+# "xyz" is R = Rz @ Ry @ Rx, i.e. the order used by rotation_matrix_to_euler_angles
+EULER_ORDERS = ("xyz", "xzy", "yxz", "yzx", "zxy", "zyx", "xyx", "xzx", "yxy", "yzy", "zxz", "zyz")
+
+_SINGULAR_THRESHOLD = 1e-6
+
+
+def _compile_euler_order(order: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Flat (row * 3 + column) element indices and signs used by the decomposition for one axis sequence
+
+    With i, j the first two axes and k the remaining one, and s the parity of (i, j, k):
+    Tait-Bryan (i, j, k): a = atan2(s R[k,j], R[k,k]), b = atan2(-s R[k,i], hypot(R[i,i], R[j,i])), c = atan2(s R[j,i], R[i,i])
+    Proper Euler (i, j, i): a = atan2(R[i,j], s R[i,k]), b = atan2(hypot(R[i,j], R[i,k]), R[i,i]), c = atan2(R[j,i], -s R[k,i])
+    and at the singularity (hypot ~ 0): a = atan2(-s R[j,k], R[j,j]), c = 0
+    """
+    i, j = "xyz".index(order[0]), "xyz".index(order[1])
+    k = 3 - i - j
+    parity = 1.0 if (j - i) % 3 == 1 else -1.0
+
+    def flat(row: int, column: int) -> int:
+        return 3 * row + column
+
+    if order[2] != order[0]:
+        # [a_num, a_den, c_num, c_den, b_element, hypot_0, hypot_1, singular_a_num, singular_a_den]
+        indices = [flat(k, j), flat(k, k), flat(j, i), flat(i, i), flat(k, i), flat(i, i), flat(j, i), flat(j, k), flat(j, j)]
+        # signs of a_num, a_den, c_num, c_den, then b = atan2(w0 * element + w1 * hypot, w2 * element + w3 * hypot),
+        # then singular a_num
+        signs = [parity, 1.0, parity, 1.0, -parity, 0.0, 0.0, 1.0, -parity]
+    else:
+        indices = [flat(i, j), flat(i, k), flat(j, i), flat(k, i), flat(i, i), flat(i, j), flat(i, k), flat(j, k), flat(j, j)]
+        signs = [1.0, parity, 1.0, -parity, 0.0, 1.0, 1.0, 0.0, -parity]
+    return np.array(indices, dtype=np.intp), np.array(signs, dtype=np.float64)
+
+
+_EULER_TABLES = {order: _compile_euler_order(order) for order in EULER_ORDERS}
+
+
+def _euler_table(order: str) -> Tuple[np.ndarray, np.ndarray]:
+    try:
+        return _EULER_TABLES[order]
+    except KeyError:
+        raise ValueError(f"Euler order {order} not supported, must be one of {EULER_ORDERS}") from None
+
+
+def orthonormality_errors(rotation_matrices: np.ndarray) -> np.ndarray:
+    """Vectorized orthonormality_error for an (N,3,3) stack
+
+    Args:
+        rotation_matrices (np.ndarray): the (N,3,3) stack of matrices
+
+    Returns:
+        np.ndarray: (N,) Frobenius norms of (R^T R - I)
+    """
+    gram = np.einsum("nki,nkj->nij", rotation_matrices, rotation_matrices)
+    gram[:, [0, 1, 2], [0, 1, 2]] -= 1.0
+    return np.sqrt(np.einsum("nij,nij->n", gram, gram))
+
+
+def rotation_matrix_to_euler_angles_ordered(
+    rotation_matrix: np.ndarray, order: str = "xyz", tolerance_ortho_normality: float | None = None
+) -> np.ndarray:
+    """Decompose a rotation matrix (or an (N,3,3) stack of them) into Euler / Tait-Bryan angles for any axis sequence
+
+    Every order goes through the same code path, only the element indices and signs from the precompiled
+    table differ.
+
+    Args:
+        rotation_matrix (np.ndarray): the 3x3 rotation matrix, or an (N,3,3) stack
+        order (str): one of EULER_ORDERS, the axes in the order the rotations are applied
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+
+    Raises:
+        ValueError: When the order is not supported, or a matrix is not close enough to a rotation matrix
+
+    Returns:
+        np.ndarray: the angles (radians) in the order of application, shape (3,) or (N,3)
+    """
+    indices, signs = _euler_table(order)
+    if tolerance_ortho_normality is None:
+        tolerance_ortho_normality = DEFAULT_TOLERANCE_ORTHO_NORMALITY
+    matrices = np.asarray(rotation_matrix, dtype=np.float64).reshape(-1, 3, 3)
+    errors = orthonormality_errors(matrices)
+    if not np.all(errors < tolerance_ortho_normality):
+        raise ValueError(
+            f"{np.count_nonzero(~(errors < tolerance_ortho_normality))} matrices are not rotation matrices, "
+            f"largest difference from identity = {np.nanmax(errors)}"
+        )
+
+    gathered = matrices.reshape(-1, 9)[:, indices]
+    element = gathered[:, 4]
+    hypot = np.hypot(gathered[:, 5], gathered[:, 6])
+    singular = hypot < _SINGULAR_THRESHOLD
+
+    angles = np.empty((len(matrices), 3), dtype=np.float64)
+    angles[:, 0] = np.where(
+        singular,
+        np.arctan2(signs[8] * gathered[:, 7], gathered[:, 8]),
+        np.arctan2(signs[0] * gathered[:, 0], signs[1] * gathered[:, 1]),
+    )
+    angles[:, 1] = np.arctan2(signs[4] * element + signs[5] * hypot, signs[6] * element + signs[7] * hypot)
+    angles[:, 2] = np.where(singular, 0.0, np.arctan2(signs[2] * gathered[:, 2], signs[3] * gathered[:, 3]))
+
+    if np.ndim(rotation_matrix) == 2:
+        return angles[0]
+    return angles
+
+
+def euler_angles_to_rotation_matrix_ordered(theta: np.ndarray, order: str = "xyz") -> np.ndarray:
+    """Compose the rotation matrix for Euler / Tait-Bryan angles in any axis sequence,
+    the inverse of rotation_matrix_to_euler_angles_ordered
+
+    The first rotation is written directly, and each following rotation about an axis is applied by
+    mixing the other two rows, without building the elementary matrices or multiplying 3x3 matrices.
+
+    Args:
+        theta (np.ndarray): angles (radians) in the order of application, shape (3,) or (N,3)
+        order (str): one of EULER_ORDERS
+
+    Returns:
+        np.ndarray: the 3x3 rotation matrix, or an (N,3,3) stack
+    """
+    _euler_table(order)
+    angles = np.asarray(theta, dtype=np.float64).reshape(-1, 3)
+    cos, sin = np.cos(angles), np.sin(angles)
+
+    axis = "xyz".index(order[0])
+    first, second = (axis + 1) % 3, (axis + 2) % 3
+    rotation_matrices = np.zeros((len(angles), 3, 3), dtype=np.float64)
+    rotation_matrices[:, axis, axis] = 1.0
+    rotation_matrices[:, first, first] = cos[:, 0]
+    rotation_matrices[:, second, second] = cos[:, 0]
+    rotation_matrices[:, first, second] = -sin[:, 0]
+    rotation_matrices[:, second, first] = sin[:, 0]
+    for position in (1, 2):
+        axis = "xyz".index(order[position])
+        first, second = (axis + 1) % 3, (axis + 2) % 3
+        cos_column, sin_column = cos[:, position, np.newaxis], sin[:, position, np.newaxis]
+        first_row = rotation_matrices[:, first, :].copy()
+        second_row = rotation_matrices[:, second, :].copy()
+        rotation_matrices[:, first, :] = cos_column * first_row - sin_column * second_row
+        rotation_matrices[:, second, :] = sin_column * first_row + cos_column * second_row
+    if np.ndim(theta) == 1:
+        return rotation_matrices[0]
+    return rotation_matrices
+
+
 if __name__ == "__main__":
     # matrix --> euler angles --> matrix
     sample_rotation_matrix = np.array(
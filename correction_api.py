@@ -0,0 +1,263 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library interface to the 6DOF calculation, for embedding in other pipelines
+
+Each input of compute_correction can be given as:
+    - a pydicom Dataset
+    - the encoded object, as bytes, bytearray, memoryview or a binary file object
+    - a path (str or os.PathLike), read when the summary is made
+    - a summary (RegistrationSummary, SetupIsocenterSummary, PlanSummary) made beforehand
+and any mix of them. A summary holds only the values the calculation uses, extracted in a single pass,
+so a plan (or an SRO, or an RTSS) summarized once can be reused for any number of calculations without
+reading or traversing the DICOM object again. Nothing here prints, and nothing is read except the paths given.
+
+Usage:
+    plan = summarize_plan(plan_bytes)
+    ypr, translation = compute_correction(reg_ds, rtss_path, plan)
+"""
+
+import io
+import os
+from typing import BinaryIO, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+import extract_reg_matrix as er
+import extract_rtss_setup_isocenter as ertss
+
+Source = pydicom.Dataset | bytes | bytearray | memoryview | BinaryIO | str | os.PathLike
+
+
+class RegistrationSummary(NamedTuple):
+    """What the calculation uses from a Spatial Registration Object"""
+
+    sop_instance_uid: str
+    four_by_four: np.ndarray
+    """the (composed) 4x4 registration matrix"""
+
+
+class SetupIsocenterSummary(NamedTuple):
+    """What the calculation uses from an in room RTSS"""
+
+    sop_instance_uid: str
+    setup_isocenter: np.ndarray
+    """in DICOM Patient coordinates of the in room image"""
+    frame_of_reference_uid: str = ""
+    """of the in room image, which selects the registration of the SRO"""
+
+
+class PlanSummary(NamedTuple):
+    """What the calculation uses from an RT Ion Plan"""
+
+    sop_instance_uid: str
+    isocenter: np.ndarray
+    """of the setup beam, in DICOM Patient coordinates of the reference image"""
+    patient_position: str
+    patient_support_angle: float
+    """of the setup beam"""
+    frame_of_reference_uid: str = ""
+    """of the reference image, whose (usually identity) registration is not the one calculated with"""
+
+
+def read_source(source: Source) -> pydicom.Dataset:
+    """The dataset of a source, parsed from bytes or a file object, or read from a path (a Dataset is returned as is)"""
+    if isinstance(source, pydicom.Dataset):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return pydicom.dcmread(io.BytesIO(source), force=True)
+    if isinstance(source, (str, os.PathLike)) or hasattr(source, "read"):
+        return pydicom.dcmread(source, force=True)
+    raise TypeError(f"Not a DICOM source: {type(source).__name__}")
+
+
+def summarize_registration(
+    source: Source | RegistrationSummary,
+    frame_of_reference_uid: str | None = None,
+    registered_frame_of_reference_uid: str = "",
+    reference_frame_of_reference_uid: str = "",
+) -> RegistrationSummary:
+    """The registration matrix of an SRO
+
+    Args:
+        source: the SRO (see read_source), or a summary returned as is
+        frame_of_reference_uid (str | None): the registered Frame of Reference to use, which must be in the SRO,
+        None to select the registration as compute_6dof_from_reg_rtss_plan does, from the next two
+        registered_frame_of_reference_uid (str): the Frame of Reference of the in room image (that of its RTSS)
+        reference_frame_of_reference_uid (str): the Frame of Reference of the plan
+        (see extract_reg_matrix.extract_4x4_matrix_for_calculation)
+
+    Raises:
+        ValueError: When no registration in the SRO is for frame_of_reference_uid, or the SRO has no matrix registration
+
+    Returns:
+        RegistrationSummary: the SOP Instance UID and the 4x4 matrix
+    """
+    if isinstance(source, RegistrationSummary):
+        return source
+    reg_ds = read_source(source)
+    if frame_of_reference_uid is None:
+        four_by_four = er.extract_4x4_matrix_for_calculation(
+            reg_ds, registered_frame_of_reference_uid, reference_frame_of_reference_uid
+        )
+    else:
+        four_by_four = er.extract_4x4_matrix_for_frame_of_reference(reg_ds, frame_of_reference_uid)
+    return RegistrationSummary(str(reg_ds.get("SOPInstanceUID", "")), four_by_four)
+
+
+def summarize_rtss(source: Source | SetupIsocenterSummary) -> SetupIsocenterSummary:
+    """The Setup Isocenter of an in room RTSS (the ROI names of extract_rtss_setup_isocenter)
+
+    Args:
+        source: the RTSS (see read_source), or a summary returned as is
+
+    Raises:
+        ValueError: When the RTSS has no Setup Isocenter
+
+    Returns:
+        SetupIsocenterSummary: the SOP Instance UID, the Setup Isocenter and the Frame of Reference
+    """
+    if isinstance(source, SetupIsocenterSummary):
+        return source
+    rtss_ds = read_source(source)
+    setup_isocenter = np.array(ertss.extract_rtss_setup_isocenter(rtss_ds), dtype=np.float64)
+    return SetupIsocenterSummary(
+        str(rtss_ds.get("SOPInstanceUID", "")), setup_isocenter, ertss.extract_rtss_frame_of_reference_uid(rtss_ds)
+    )
+
+
+def summarize_plan(source: Source | PlanSummary, beam_number: int | None = None) -> PlanSummary:
+    """The setup beam isocenter, Patient Support Angle and the Patient Position of an RT Ion Plan
+
+    Args:
+        source: the plan (see read_source), or a summary returned as is
+        beam_number (int | None): the Beam Number of the setup beam, None for the first beam
+        (as compute_6dof_from_reg_rtss_plan does)
+
+    Raises:
+        ValueError: When there is no such beam, or no isocenter in its first control point
+
+    Returns:
+        PlanSummary: the values read from the first control point of the setup beam and the first Patient Setup
+    """
+    if isinstance(source, PlanSummary):
+        return source
+    plan_ds = read_source(source)
+    beams = plan_ds.IonBeamSequence
+    if beam_number is None:
+        beam = beams[0]
+    else:
+        beam = next((item for item in beams if int(item.get("BeamNumber", -1)) == beam_number), None)
+        if beam is None:
+            raise ValueError(f"No beam {beam_number} in plan")
+    first_control_point = beam.IonControlPointSequence[0]
+    isocenter = first_control_point.get("IsocenterPosition") or []
+    if len(isocenter) == 0:
+        raise ValueError(f"No isocenter in beam {beam.get('BeamNumber', '')} of plan")
+    return PlanSummary(
+        str(plan_ds.get("SOPInstanceUID", "")),
+        np.array(isocenter, dtype=np.float64),
+        str(plan_ds.PatientSetupSequence[0].PatientPosition),
+        float(first_control_point.get("PatientSupportAngle", 0.0)),
+        str(plan_ds.get("FrameOfReferenceUID", "")),
+    )
+
+
+def compute_correction(
+    registration: Source | RegistrationSummary,
+    rtss: Source | SetupIsocenterSummary,
+    plan: Source | PlanSummary,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+    frame_of_reference_uid: str | None = None,
+    beam_number: int | None = None,
+    at_patient_support_angle: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The same correction as compute_6dof_from_reg_rtss_plan, from any mix of sources and summaries, without printing
+
+    Args:
+        registration: the SRO, or its summary
+        rtss: the in room RTSS, or its summary
+        plan: the RT Ion Plan, or its summary
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which the registration rotation
+        is projected onto the nearest rotation matrix instead of failing the calculation
+        frame_of_reference_uid (str | None): the registration of the SRO to use, see summarize_registration
+        beam_number (int | None): the setup beam of the plan, see summarize_plan
+        at_patient_support_angle (bool): express the correction in IEC 61217 Fixed with the patient support
+        at the setup beam's Patient Support Angle (see express_at_patient_support_angles) instead of Table Top
+
+    Returns:
+        The correction in IEC61217 Table Top as a pair of np.arrays,
+        the first of which is the Yaw/Pitch/Roll representation and
+        the second is the translation
+    """
+    ypr, translation = compute_corrections(
+        [registration],
+        [rtss],
+        plan,
+        tolerance_ortho_normality,
+        reorthonormalization_tolerance,
+        frame_of_reference_uid=frame_of_reference_uid,
+        beam_number=beam_number,
+        at_patient_support_angle=at_patient_support_angle,
+    )
+    return ypr[0], translation[0]
+
+
+def compute_corrections(
+    registrations: Sequence[Source | RegistrationSummary],
+    rtsss: Sequence[Source | SetupIsocenterSummary],
+    plan: Source | PlanSummary,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+    frame_of_reference_uid: str | None = None,
+    beam_number: int | None = None,
+    at_patient_support_angle: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """compute_correction for N (registration, RTSS) pairs against one plan, in a single vectorized calculation
+    (the vectorized decomposition is also the one that does not print the orthonormality check)
+    frame_of_reference_uid and beam_number only apply to the objects that are not already summarized.
+    Without frame_of_reference_uid each registration is selected with the Frames of Reference of its RTSS and the plan.
+
+    Returns:
+        The corrections in IEC61217 Table Top as a pair of (N,3) np.arrays, Yaw/Pitch/Roll and translation
+    """
+    if len(registrations) != len(rtsss):
+        raise ValueError(f"{len(registrations)} registrations for {len(rtsss)} RTSSs")
+    plan_summary = summarize_plan(plan, beam_number)
+    rtss_summaries = [summarize_rtss(rtss) for rtss in rtsss]
+    four_by_fours = [
+        summarize_registration(
+            registration,
+            frame_of_reference_uid,
+            rtss_summary.frame_of_reference_uid,
+            plan_summary.frame_of_reference_uid,
+        ).four_by_four
+        for registration, rtss_summary in zip(registrations, rtss_summaries)
+    ]
+    ypr, translation = c6.compute_6dof_from_components_batch(
+        np.array(four_by_fours).reshape(-1, 4, 4),
+        np.array([rtss_summary.setup_isocenter for rtss_summary in rtss_summaries]).reshape(-1, 3),
+        plan_summary.isocenter,
+        plan_summary.patient_position,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
+    if at_patient_support_angle:
+        return c6.express_at_patient_support_angles(
+            ypr, translation, np.full(len(ypr), plan_summary.patient_support_angle, dtype=np.float64)
+        )
+    return ypr, translation
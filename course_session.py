@@ -0,0 +1,109 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per course cache of the plan side of the 6DOF calculation
+
+Over a course of treatment the plan isocenter, Patient Position, Patient Support Angle and
+the reference Frame of Reference do not change, only the SRO and the in room RTSS do.
+A CourseSession extracts the plan side once, so each fraction is only the matrix extraction
+and a couple of 3x3 products.
+
+Returns:
+    a pair of ndarray: two 3D vectors, rotations and translations
+"""
+
+import sys
+from typing import Tuple
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+import extract_plan_setupbeam_isocenter as ep
+import extract_reg_matrix as er
+import extract_rtss_setup_isocenter as ertss
+
+
+class CourseSession:
+    """The plan side terms of the 6DOF calculation, computed once for a patient course"""
+
+    def __init__(
+        self,
+        plan_ds: pydicom.Dataset,
+        tolerance_ortho_normality: float | None = None,
+        reorthonormalization_tolerance: float | None = None,
+    ):
+        """
+        Args:
+            plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan (containing the planned setup isocenter)
+            tolerance_ortho_normality (float | None): tolerance passed on to the rotation matrix check
+            reorthonormalization_tolerance (float | None): wider bound within which the rotation is re-orthonormalized
+        """
+        self.plan_sop_instance_uid = str(plan_ds.get("SOPInstanceUID", ""))
+        self.frame_of_reference_uid = str(plan_ds.get("FrameOfReferenceUID", ""))
+        self.patient_position = str(plan_ds.PatientSetupSequence[0].PatientPosition)
+        self.patient_support_angle = float(plan_ds.IonBeamSequence[0].IonControlPointSequence[0].PatientSupportAngle)
+        self.plan_isocenter = np.array(ep.extract_plan_setupbeam_isocenter(plan_ds), dtype=np.float64)
+        self.tolerance_ortho_normality = tolerance_ortho_normality
+        self.reorthonormalization_tolerance = reorthonormalization_tolerance
+        self._dicom_patient_to_iec, self._ypr_to_iec, self._rotated_delta_sign = c6.patient_position_tables(
+            self.patient_position
+        )
+
+    @classmethod
+    def from_path(cls, plan_path: str, **kwargs) -> "CourseSession":
+        """Read the RT Ion Plan and build the session from it"""
+        return cls(pydicom.dcmread(plan_path, force=True), **kwargs)
+
+    def compute_fraction(self, reg_ds: pydicom.Dataset, rtss_ds: pydicom.Dataset) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the correction for one fraction
+
+        Args:
+            reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
+            rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
+
+        Returns:
+            The correction in IEC61217 Table Top as a pair of np.arrays,
+            the first of which is the Yaw/Pitch/Roll representation and
+            the second is the translation
+        """
+        four_by_four_matrix = er.extract_4x4_matrix_for_calculation(
+            reg_ds, ertss.extract_rtss_frame_of_reference_uid(rtss_ds), self.frame_of_reference_uid
+        )
+        setup_iso_dicom_patient = np.array(ertss.extract_rtss_setup_isocenter(rtss_ds), dtype=np.float64)
+        return self.compute_fraction_from_components(four_by_four_matrix, setup_iso_dicom_patient)
+
+    def compute_fraction_from_components(
+        self, four_by_four_matrix: np.ndarray, setup_iso_dicom_patient: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the correction for one fraction from the already extracted registration matrix and setup isocenter"""
+        return c6.compute_6dof_from_position_tables(
+            four_by_four_matrix,
+            setup_iso_dicom_patient,
+            self.plan_isocenter,
+            self._dicom_patient_to_iec,
+            self._ypr_to_iec,
+            self._rotated_delta_sign,
+            self.tolerance_ortho_normality,
+            self.reorthonormalization_tolerance,
+        )
+
+
+if __name__ == "__main__":
+    session = CourseSession.from_path(sys.argv[1])
+    for sro_path, rtss_path in zip(sys.argv[2::2], sys.argv[3::2]):
+        ypr, translation = session.compute_fraction(
+            pydicom.dcmread(sro_path, force=True), pydicom.dcmread(rtss_path, force=True)
+        )
+        print(f"{sro_path}: IEC Translation in mm[Lateral, Longitudinal, Vertical]: {translation}")
+        print(f"{sro_path}: IEC Rotation [Yaw, Pitch, Roll]: {ypr}")
@@ -0,0 +1,128 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Discovery of DICOM files below a directory, whatever their extension
+
+Usage:
+    python dicom_files.py <directory>
+
+Files are recognized from their first bytes only: the 128 byte preamble followed by "DICM"
+(a DICOM Part 10 file), or, for files written without the preamble, a first data element that
+looks like the start of a dataset (group 0x0002 or 0x0008, then an explicit VR or a plausible
+implicit VR length). Everything else (reports, thumbnails, DICOMDIR siblings) is never parsed.
+"""
+
+import logging
+import os
+import sys
+from typing import Iterator
+
+PREAMBLE_LENGTH = 128
+
+DICM_PREFIX = b"DICM"
+
+_SNIFF_LENGTH = PREAMBLE_LENGTH + len(DICM_PREFIX)
+
+_FIRST_GROUPS = (0x0002, 0x0008)  # File Meta Information, or the Identifying group of a dataset without it
+
+_MAX_FIRST_ELEMENT_LENGTH = 0x10000  # the first elements (e.g. Specific Character Set, SOP Class UID) are short
+
+
+def looks_like_dicom(header: bytes) -> bool:
+    """Whether the first bytes of a file are those of a DICOM file
+
+    Args:
+        header (bytes): at least the first 132 bytes of the file (fewer if the file is shorter)
+
+    Returns:
+        bool: True for a Part 10 file (preamble and "DICM") or a dataset written without the preamble
+    """
+    if header[PREAMBLE_LENGTH:_SNIFF_LENGTH] == DICM_PREFIX:
+        return True
+    if len(header) < 8:
+        return False
+    group = int.from_bytes(header[0:2], "little")
+    if group not in _FIRST_GROUPS:
+        return False
+    if header[4:6].isalpha() and header[4:6].isupper():  # explicit VR
+        return True
+    return int.from_bytes(header[4:8], "little") < _MAX_FIRST_ELEMENT_LENGTH  # implicit VR length
+
+
+def is_dicom_file(path: str) -> bool:
+    """Whether a file is DICOM, from its first 132 bytes (see looks_like_dicom)"""
+    try:
+        with open(path, "rb") as fp:
+            return looks_like_dicom(fp.read(_SNIFF_LENGTH))
+    except OSError:
+        return False
+
+
+def iter_file_entries(directory: str, recursive: bool = True) -> Iterator[os.DirEntry]:
+    """The os.DirEntry of every file below a directory, yielded as they are found
+
+    The directory tree is walked with os.scandir and never listed as a whole, so a consumer
+    (e.g. a pool reading headers) starts on the first files while the rest are being found.
+
+    A subdirectory that cannot be listed (e.g. no permission, or removed meanwhile) is skipped with a warning.
+
+    Args:
+        directory (str): where to look
+        recursive (bool): also look in the subdirectories
+
+    Raises:
+        OSError: When directory itself cannot be listed
+
+    Yields:
+        os.DirEntry: each regular file (symbolic links to files included, to directories not followed)
+    """
+    pending = [str(directory)]
+    while pending:
+        current = pending.pop()
+        try:
+            scan = os.scandir(current)
+        except OSError as e:
+            if current == str(directory):
+                raise
+            logging.warning("Skipping %s: %s", current, e)
+            continue
+        with scan:
+            for entry in scan:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        pending.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def iter_dicom_files(directory: str, recursive: bool = True) -> Iterator[str]:
+    """The DICOM files below a directory, yielded as they are found (see iter_file_entries)
+
+    Args:
+        directory (str): where to look
+        recursive (bool): also look in the subdirectories
+
+    Raises:
+        OSError: When directory itself cannot be listed
+
+    Yields:
+        str: the path of each file recognized by is_dicom_file
+    """
+    for entry in iter_file_entries(directory, recursive):
+        if is_dicom_file(entry.path):
+            yield entry.path
+
+
+if __name__ == "__main__":
+    for path in iter_dicom_files(sys.argv[1]):
+        print(path)
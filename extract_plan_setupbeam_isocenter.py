@@ -18,7 +18,9 @@ Returns:
 """
 
 import sys
+from typing import Dict, List, Tuple
 
+import numpy as np
 import pydicom
 
 
@@ -39,9 +41,43 @@ def extract_plan_setupbeam_isocenter(_ds: pydicom.Dataset) -> list[str]:
     return plan_setup_iso
 
 
+def extract_plan_isocenters_and_couch_angles(_ds: pydicom.Dataset) -> Tuple[np.ndarray, np.ndarray, List[List[int]]]:
+    """Collects the distinct (isocenter, Patient Support Angle) pairs over all beams in a single pass
+    Both are taken from the first control point of each beam
+
+    Args:
+        ds (pydicom.Dataset): dataset representing the plan
+
+    Raises:
+        ValueError: When a beam has no isocenter
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, List[List[int]]]: the (M,3) isocenters, the (M,) Patient Support Angles,
+        and the Beam Numbers sharing each pair, in order of first appearance
+    """
+    row_of_pair: Dict[Tuple[float, ...], int] = {}
+    beam_numbers: List[List[int]] = []
+    for beam_index, beam in enumerate(_ds.IonBeamSequence):
+        first_control_point = beam.IonControlPointSequence[0]
+        isocenter = first_control_point.get("IsocenterPosition") or []
+        if len(isocenter) == 0:
+            raise ValueError(f"No isocenter in beam {beam_index} of plan")
+        pair = (*(float(value) for value in isocenter), float(first_control_point.get("PatientSupportAngle", 0.0)))
+        row = row_of_pair.setdefault(pair, len(row_of_pair))
+        if row == len(beam_numbers):
+            beam_numbers.append([])
+        beam_numbers[row].append(int(beam.get("BeamNumber", beam_index + 1)))
+
+    pairs = np.array(list(row_of_pair), dtype=np.float64).reshape(-1, 4)
+    return pairs[:, 0:3], pairs[:, 3], beam_numbers
+
+
 if __name__ == "__main__":
     PLAN_PATH = sys.argv[1]
     # print(path)
     plan_ds = pydicom.dcmread(PLAN_PATH, force=True)
     plan_iso = extract_plan_setupbeam_isocenter(plan_ds)
     print(plan_iso)
+    isocenters, couch_angles, beams = extract_plan_isocenters_and_couch_angles(plan_ds)
+    for isocenter, couch_angle, beam_numbers in zip(isocenters, couch_angles, beams):
+        print(f"Isocenter {isocenter} at Patient Support Angle {couch_angle}: beams {beam_numbers}")
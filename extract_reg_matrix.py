@@ -19,6 +19,7 @@ Returns:
 
 import math
 import sys
+from typing import Callable, Dict, Tuple
 
 import numpy as np
 import pydicom
@@ -73,18 +74,111 @@ def extract_4x4_matrix_as_np_array(sro_ds: pydicom.Dataset) -> np.ndarray:
     return transform_mtx
 
 
-def decompose_matrix_order_rpy_as_ypr_degrees(rotation_mtx: np.ndarray, tolerance_ortho_normality: float | None = None) -> np.ndarray:
+def extract_registration_matrices(sro_ds: pydicom.Dataset) -> Tuple[np.ndarray, Dict[str, int]]:
+    """Extract every matrix registration in the Spatial Registration Object in a single pass
+    Chained Matrix Sequence items are composed into one 4x4, the first item being applied first.
+    Registration Sequence items without a Matrix Registration Sequence (e.g. deformable only) are skipped.
+
+    Args:
+        sro_ds (pydicom.Dataset): Dataset representing the Spatial Registration Object
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, int]]: the (K,4,4) transformation matrices, and the index of the matrix
+        for each Frame of Reference UID (the first registration wins if a Frame of Reference appears twice)
+    """
+    matrices = []
+    index_of_frame_of_reference: Dict[str, int] = {}
+    for registration_item in sro_ds.RegistrationSequence:
+        matrix_registration_sequence = registration_item.get("MatrixRegistrationSequence")
+        if not matrix_registration_sequence:
+            continue
+        transform_mtx = np.identity(4)
+        for matrix_item in matrix_registration_sequence[0].MatrixSequence:
+            matrix = np.array(matrix_item.FrameOfReferenceTransformationMatrix, dtype=np.float64).reshape(4, 4)
+            transform_mtx = matrix @ transform_mtx
+        frame_of_reference_uid = str(registration_item.get("FrameOfReferenceUID", ""))
+        if frame_of_reference_uid:
+            index_of_frame_of_reference.setdefault(frame_of_reference_uid, len(matrices))
+        matrices.append(transform_mtx)
+    return np.array(matrices, dtype=np.float64).reshape(-1, 4, 4), index_of_frame_of_reference
+
+
+def extract_4x4_matrix_for_frame_of_reference(sro_ds: pydicom.Dataset, frame_of_reference_uid: str) -> np.ndarray:
+    """Extract the (composed) 4x4 transformation matrix registering the given Frame of Reference
+
+    Args:
+        sro_ds (pydicom.Dataset): Dataset representing the Spatial Registration Object
+        frame_of_reference_uid (str): the Frame of Reference UID of the Registration Sequence item
+
+    Raises:
+        ValueError: When no registration in the SRO is for that Frame of Reference
+
+    Returns:
+        np.ndarray: The 4x4 transformation matrix as a numpy array
+    """
+    matrices, index_of_frame_of_reference = extract_registration_matrices(sro_ds)
+    try:
+        return matrices[index_of_frame_of_reference[str(frame_of_reference_uid)]]
+    except KeyError:
+        raise ValueError(f"No registration for Frame of Reference {frame_of_reference_uid} in SRO") from None
+
+
+def extract_4x4_matrix_for_calculation(
+    sro_ds: pydicom.Dataset, registered_frame_of_reference_uid: str = "", reference_frame_of_reference_uid: str = ""
+) -> np.ndarray:
+    """Extract the (composed) 4x4 transformation matrix the correction is calculated from
+    That is the registration of the in room image's Frame of Reference when the SRO has one, otherwise the first
+    registration that is not of the reference (planning) Frame of Reference (which is usually the identity),
+    otherwise the first registration.
+
+    Args:
+        sro_ds (pydicom.Dataset): Dataset representing the Spatial Registration Object
+        registered_frame_of_reference_uid (str): the Frame of Reference of the in room image (and its RTSS)
+        reference_frame_of_reference_uid (str): the Frame of Reference of the plan
+
+    Raises:
+        ValueError: When the SRO has no matrix registration
+
+    Returns:
+        np.ndarray: The 4x4 transformation matrix as a numpy array
+    """
+    matrices, index_of_frame_of_reference = extract_registration_matrices(sro_ds)
+    if len(matrices) == 0:
+        raise ValueError("No matrix registration in SRO")
+    if str(registered_frame_of_reference_uid) in index_of_frame_of_reference:
+        return matrices[index_of_frame_of_reference[str(registered_frame_of_reference_uid)]]
+    reference_index = index_of_frame_of_reference.get(str(reference_frame_of_reference_uid))
+    for index, matrix in enumerate(matrices):
+        if index != reference_index:
+            return matrix
+    return matrices[0]
+
+
+def decompose_matrix_order_rpy_as_ypr_degrees(
+    rotation_mtx: np.ndarray,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+    orthonormality_check: Callable[..., bool] = cnv.is_rotation_matrix,
+) -> np.ndarray:
     """Decomposes the provided 3x3 matrix into Yaw, Pitch, and Roll
     The decomposition order is Roll, Pitch, Yaw (because IEC 61217 and DICOM state that the application of the values
     is to be performed translation first, then yaw, then pitch, then roll, so the decomposition reverses that
 
     Args:
         R (np.ndarray): the 3x3 rotation matrix
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+        orthonormality_check (Callable[..., bool]): cnv.is_rotation_matrix (printing) or cnv.is_orthonormal
 
     Returns:
         np.ndarray: the IEC 61217 Table Top rotation angles (with Patient Support Angle being Yaw)
     """
-    euler_angles = cnv.rotation_matrix_to_euler_angles(rotation_mtx, tolerance_ortho_normality=tolerance_ortho_normality)
+    euler_angles = cnv.rotation_matrix_to_euler_angles(
+        rotation_mtx,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+        orthonormality_check=orthonormality_check,
+    )
     # Rprime = cnv.eulerAnglesToRotationMatrix(euler_angles)
     in_degrees = euler_angles * 180.0 / math.pi
     _iec_pitch = in_degrees[0]
@@ -93,6 +187,38 @@ def decompose_matrix_order_rpy_as_ypr_degrees(rotation_mtx: np.ndarray, toleranc
     return np.array([_iec_yaw, _iec_pitch, _iec_roll])
 
 
+def decompose_matrices_order_rpy_as_ypr_degrees(
+    rotation_matrices: np.ndarray,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> np.ndarray:
+    """Vectorized decompose_matrix_order_rpy_as_ypr_degrees for an (N,3,3) stack of rotation matrices
+
+    Args:
+        rotation_matrices (np.ndarray): the (N,3,3) rotation matrices
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity
+        reorthonormalization_tolerance (float | None): wider bound within which R is projected onto the nearest rotation
+
+    Returns:
+        np.ndarray: (N,3) IEC 61217 Table Top rotation angles [Yaw, Pitch, Roll] in degrees
+    """
+    rotation_matrices = np.asarray(rotation_matrices, dtype=np.float64).reshape(-1, 3, 3)
+    if reorthonormalization_tolerance is not None:
+        if tolerance_ortho_normality is None:
+            tolerance_ortho_normality = cnv.DEFAULT_TOLERANCE_ORTHO_NORMALITY
+        errors = cnv.orthonormality_errors(rotation_matrices)
+        drifted = ~(errors < tolerance_ortho_normality) & (errors < reorthonormalization_tolerance)
+        if np.any(drifted):
+            rotation_matrices = rotation_matrices.copy()
+            rotation_matrices[drifted], corrections = cnv.nearest_rotation_matrix(rotation_matrices[drifted])
+            cnv.log_reorthonormalization(errors[drifted], corrections)
+    euler_angles = cnv.rotation_matrix_to_euler_angles_ordered(
+        rotation_matrices, "xyz", tolerance_ortho_normality=tolerance_ortho_normality
+    )
+    in_degrees = euler_angles * 180.0 / math.pi
+    return np.stack([-in_degrees[:, 1], in_degrees[:, 0], in_degrees[:, 2]], axis=1)
+
+
 if __name__ == "__main__":
     SRO_PATH = sys.argv[1]
     # print(path)
@@ -50,6 +50,22 @@ def extract_rtss_setup_isocenter(_ds: Dataset) -> list[str]:
     return _rt_ss_iso
 
 
+def extract_rtss_frame_of_reference_uid(_ds: Dataset) -> str:
+    """Extract the Frame of Reference UID of the in room image the RTSS was drawn on
+
+    Args:
+        ds (Dataset): dataset representing the RT SS for the in room CT/CBCT
+
+    Returns:
+        str: The first Referenced Frame of Reference UID, or an empty string when there is none
+    """
+    for referenced_frame_of_reference_item in _ds.get("ReferencedFrameOfReferenceSequence", []):
+        frame_of_reference_uid = str(referenced_frame_of_reference_item.get("FrameOfReferenceUID", ""))
+        if frame_of_reference_uid:
+            return frame_of_reference_uid
+    return ""
+
+
 if __name__ == "__main__":
     RTSS_PATH = sys.argv[1]
     # print(path)
@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 
-import glob
 import logging
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import chain, islice
 from os import path as os_path
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, NamedTuple
 
 import numpy as np
 from pydicom import Dataset, Sequence, dcmread as read_file, uid, dcmwrite as write_file
+from pydicom.filereader import read_partial
+from pydicom.tag import BaseTag, Tag
+
+from dicom_files import iter_dicom_files
+from memory_profile import MemoryProfiler, pop_memory_profile_argument, profiled
 
 #  Copied and modified from ImageLoading.py from OnkoDICOM, which was LGPL 2.1 at the time
 
@@ -90,6 +96,14 @@ def get_stack_center(sorted_dict_on_displacement: List[tuple[str, Dataset]]) ->
     logging.debug(f"Patient Position (with respect to gravity and the Gantry): {last_ds.PatientPosition}")
     orientation = last_ds.ImageOrientationPatient
     logging.debug(f"Image Orientation Patient: {orientation}")
+    return _stack_center(first_image_pos, last_image_pos, orientation, row_spacing, column_spacing, rows, cols)
+
+
+def _stack_center(first_image_pos, last_image_pos, orientation, row_spacing, column_spacing, rows, cols) -> List[float]:
+    """
+    Midpoint of the first pixel of the first slice and the last pixel of the last slice
+    (orientation, spacing and size being those of the last slice).
+    """
     ds_orient_x = orientation[0:3]
     ds_orient_y = orientation[3:6]
     orient_x = np.array(list(map(float, ds_orient_x)))
@@ -102,22 +116,137 @@ def get_stack_center(sorted_dict_on_displacement: List[tuple[str, Dataset]]) ->
     return image_stack_isocenter_pos.tolist()
 
 
+class StackCenterAccumulator:
+    """
+    Incremental get_stack_center for slices that arrive one at a time (e.g. over the network).
+    Only the slices with the largest and smallest displacement along the stack axis are kept,
+    which are the first and last slices of image_stack_sort, so memory does not grow with the stack.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._first = None  # (displacement, dataset) largest displacement
+        self._last = None  # (displacement, dataset) smallest displacement
+        self._orientation = None
+        self._stack_axis = None  # cross product of the orientation, the same for every slice of a stack
+
+    def add(self, ds: Dataset) -> None:
+        """
+        :param ds: header of one slice (ImageOrientationPatient, ImagePositionPatient,
+            PixelSpacing, Rows and Columns are used)
+        """
+        orientation = tuple(ds.ImageOrientationPatient)
+        if orientation != self._orientation:
+            self._orientation = orientation
+            orient_x = np.array(list(map(float, orientation[0:3])))
+            orient_y = np.array(list(map(float, orientation[3:6])))
+            self._stack_axis = np.cross(orient_x, orient_y)
+        # the same projection as img_stack_displacement
+        displacement = self._stack_axis.dot(np.array(list(map(float, ds.ImagePositionPatient))))
+        # ties resolve as the stable reverse sort of image_stack_sort does
+        if self._first is None or displacement > self._first[0]:
+            self._first = (displacement, ds)
+        if self._last is None or displacement <= self._last[0]:
+            self._last = (displacement, ds)
+        self.count += 1
+
+    def center(self) -> List[float]:
+        """
+        :return: the same stack center as get_stack_center of the sorted slices
+        """
+        if self.count == 0:
+            raise ValueError("No slices in stack")
+        return get_stack_center([(None, self._first[1]), (None, self._last[1])])
+
+
 def load_ct_headers_from_directory(ct_directory: Path) -> Dict[Path, Dataset]:
-    files = list_files(ct_directory, "dcm")
+    files = iter_dicom_files(ct_directory, recursive=False)
     ds_dict = {}
     for file in files:
         ds = read_file(file, force=True, stop_before_pixels=True)
-        if ds.SOPClassUID == uid.CTImageStorage:
+        if ds.get("SOPClassUID") == uid.CTImageStorage:
             ds_dict[file] = ds
     return ds_dict
 
 
-def list_files(filepath: Path, filetype: str) -> List[Path]:
-    paths = []
-    str_glob = f"*.{filetype}"
-    for name in glob.glob(os_path.join(str(filepath), str_glob)):
-        paths.append(name)
-    return paths
+STACK_GEOMETRY_KEYWORDS = [
+    "SOPClassUID",
+    "ImageOrientationPatient",
+    "ImagePositionPatient",
+    "PixelSpacing",
+    "Rows",
+    "Columns",
+    "PatientPosition",
+    "SeriesInstanceUID",
+    "FrameOfReferenceUID",
+    "SOPInstanceUID",  # for the ContourImageSequence of the in room RTSS
+]
+
+
+_STACK_GEOMETRY_TAGS = [Tag(keyword) for keyword in STACK_GEOMETRY_KEYWORDS]
+
+_LAST_STACK_GEOMETRY_TAG = max(_STACK_GEOMETRY_TAGS)
+
+
+def _after_stack_geometry(tag: BaseTag, vr: str | None, length: int) -> bool:
+    return tag > _LAST_STACK_GEOMETRY_TAG
+
+
+ENHANCED_CT_SOP_CLASSES = (uid.EnhancedCTImageStorage, uid.LegacyConvertedEnhancedCTImageStorage)
+
+CT_IMAGE_SOP_CLASSES = (uid.CTImageStorage,) + ENHANCED_CT_SOP_CLASSES
+
+_ENHANCED_CT_GEOMETRY_TAGS = _STACK_GEOMETRY_TAGS + [
+    Tag("NumberOfFrames"),
+    Tag("SharedFunctionalGroupsSequence"),
+    Tag("PerFrameFunctionalGroupsSequence"),
+]
+
+_PIXEL_DATA_TAGS = {Tag("FloatPixelData"), Tag("DoubleFloatPixelData"), Tag("PixelData")}
+
+
+def _at_pixel_data(tag: BaseTag, vr: str | None, length: int) -> bool:
+    return tag in _PIXEL_DATA_TAGS
+
+
+def read_ct_geometry_header(file: Path) -> Dataset:
+    """
+    Read only the elements get_stack_center uses (STACK_GEOMETRY_KEYWORDS), stopping at the first
+    element past them, so the rest of the header (and the pixel data) is never parsed.
+    For an enhanced (multi-frame) CT the functional groups, which follow the image pixel module,
+    are read as well, up to the pixel data.
+    """
+    with open(file, "rb") as fp:
+        ds = read_partial(fp, stop_when=_after_stack_geometry, force=True, specific_tags=_STACK_GEOMETRY_TAGS)
+        if ds.get("SOPClassUID") in ENHANCED_CT_SOP_CLASSES:
+            fp.seek(0)
+            ds = read_partial(fp, stop_when=_at_pixel_data, force=True, specific_tags=_ENHANCED_CT_GEOMETRY_TAGS)
+    return ds
+
+
+def load_ct_geometry_headers_from_directory(ct_directory: Path) -> Iterator[Dataset]:
+    """
+    The geometry headers of the CT images in a directory, one file at a time,
+    so the caller can consume them without keeping the stack.
+    """
+    for file in iter_dicom_files(ct_directory, recursive=False):
+        ds = read_ct_geometry_header(file)
+        if ds.get("SOPClassUID") == uid.CTImageStorage:
+            yield ds
+
+
+def get_stack_center_from_path_streaming(ct_directory: Path) -> List[float]:
+    """
+    Same result as get_stack_center_from_path, for when only the center is needed.
+    The stack is neither sorted nor kept: a running min/max of the displacement along the stack axis
+    (StackCenterAccumulator) over the geometry elements of each slice, in O(N) time and O(1) memory.
+    """
+    accumulator = StackCenterAccumulator()
+    for ds in load_ct_geometry_headers_from_directory(ct_directory):
+        accumulator.add(ds)
+    ct_stack_center = accumulator.center()
+    logging.debug(f"CT volume with {accumulator.count} slices in {ct_directory} is centered at {ct_stack_center}")
+    return ct_stack_center
 
 
 def get_stack_center_from_path(ct_directory: Path) -> List[float]:
@@ -128,11 +257,366 @@ def get_stack_center_from_path(ct_directory: Path) -> List[float]:
     return ct_stack_center
 
 
+ORIENTATION_TOLERANCE = 1e-4
+
+PIXEL_SPACING_TOLERANCE_MM = 1e-4
+
+SLICE_POSITION_TOLERANCE_MM = 0.01
+
+SLICE_GAP_FACTOR = 1.5
+
+
+class StackGeometry(NamedTuple):
+    """
+    The geometry of one image stack (one SeriesInstanceUID and FrameOfReferenceUID) as arrays,
+    one row per slice, in the order of image_stack_sort.
+    """
+
+    series_instance_uid: str
+    frame_of_reference_uid: str
+    keys: List
+    """the keys of the headers the stack was built from (the file paths for a directory),
+    (key, frame number) for the frames of an enhanced CT"""
+    orientation: np.ndarray
+    """(N,6) ImageOrientationPatient"""
+    position: np.ndarray
+    """(N,3) ImagePositionPatient"""
+    pixel_spacing: np.ndarray
+    """(N,2) PixelSpacing (row spacing, column spacing)"""
+    rows_columns: np.ndarray
+    """(N,2) Rows and Columns"""
+    displacement: np.ndarray
+    """(N,) projection of the position on the stack axis, descending"""
+
+
+class FrameGeometry(NamedTuple):
+    """The geometry of a set of frames (single frame images or the frames of enhanced CTs), one row per frame"""
+
+    keys: List
+    stack_uids: List[tuple[str, str]]
+    """(SeriesInstanceUID, FrameOfReferenceUID)"""
+    orientation: np.ndarray
+    position: np.ndarray
+    pixel_spacing: np.ndarray
+    rows_columns: np.ndarray
+
+
+def _single_frame_geometry(headers: Dict) -> FrameGeometry:
+    datasets = list(headers.values())
+    return FrameGeometry(
+        keys=list(headers),
+        stack_uids=[(str(ds.get("SeriesInstanceUID", "")), str(ds.get("FrameOfReferenceUID", ""))) for ds in datasets],
+        orientation=np.array([ds.ImageOrientationPatient for ds in datasets], dtype=float).reshape(-1, 6),
+        position=np.array([ds.ImagePositionPatient for ds in datasets], dtype=float).reshape(-1, 3),
+        pixel_spacing=np.array([ds.PixelSpacing for ds in datasets], dtype=float).reshape(-1, 2),
+        rows_columns=np.array([(ds.Rows, ds.Columns) for ds in datasets], dtype=int).reshape(-1, 2),
+    )
+
+
+def _functional_group_values(ds: Dataset, sequence_keyword: str, keyword: str) -> np.ndarray:
+    """
+    (F, VM) array of an attribute of a functional group macro, taken once from the shared functional groups
+    when it is there, otherwise from each item of the per-frame functional groups.
+    """
+    frame_count = int(ds.get("NumberOfFrames", len(ds.get("PerFrameFunctionalGroupsSequence", []))))
+    for shared in ds.get("SharedFunctionalGroupsSequence", []):
+        for macro in shared.get(sequence_keyword, []):
+            if keyword in macro:
+                value = np.array(macro[keyword].value, dtype=float)
+                return np.broadcast_to(value, (frame_count, value.size))
+    try:
+        values = [_decimal_string_values(frame[sequence_keyword][0], keyword) for frame in ds.PerFrameFunctionalGroupsSequence]
+    except (AttributeError, KeyError, IndexError):
+        raise ValueError(f"{keyword} ({sequence_keyword}) missing from the functional groups") from None
+    return np.array(values, dtype=float)
+
+
+def _decimal_string_values(ds: Dataset, keyword: str) -> list:
+    """The values of a DS attribute, split from the raw bytes when not yet converted (many frames, one attribute each)"""
+    element = ds.get_item(keyword)
+    if element is None:
+        raise KeyError(keyword)
+    if isinstance(element.value, bytes):
+        return element.value.split(b"\\")
+    return list(ds[keyword].value)
+
+
+def enhanced_ct_frame_geometry(ds: Dataset, key) -> FrameGeometry:
+    """
+    The geometry of every frame of an enhanced (multi-frame) CT, from its functional groups,
+    without decoding the pixel data.
+
+    :param ds: the header, read with at least STACK_GEOMETRY_KEYWORDS and the functional groups
+    :param key: the key of the header, the frames are keyed by (key, frame number)
+    :return: one row per frame, in the order of the frames
+    """
+    position = _functional_group_values(ds, "PlanePositionSequence", "ImagePositionPatient")
+    frame_count = len(position)
+    return FrameGeometry(
+        keys=[(key, frame_number) for frame_number in range(1, frame_count + 1)],
+        stack_uids=[(str(ds.get("SeriesInstanceUID", "")), str(ds.get("FrameOfReferenceUID", "")))] * frame_count,
+        orientation=_functional_group_values(ds, "PlaneOrientationSequence", "ImageOrientationPatient"),
+        position=position,
+        pixel_spacing=_functional_group_values(ds, "PixelMeasuresSequence", "PixelSpacing"),
+        rows_columns=np.broadcast_to(np.array([ds.Rows, ds.Columns], dtype=int), (frame_count, 2)),
+    )
+
+
+def split_stacks(headers: Dict) -> List[StackGeometry]:
+    """
+    Gather the geometry of the image headers into arrays and split them into one stack per
+    SeriesInstanceUID and FrameOfReferenceUID, each sorted along its stack axis.
+    The frames of an enhanced CT are keyed by (key of the header, frame number).
+
+    :param headers: CT headers (read with at least STACK_GEOMETRY_KEYWORDS) keyed by e.g. file path
+    :return: the stacks, ordered by SeriesInstanceUID and FrameOfReferenceUID
+    """
+    parts = [
+        enhanced_ct_frame_geometry(ds, key)
+        for key, ds in headers.items()
+        if ds.get("SOPClassUID") in ENHANCED_CT_SOP_CLASSES
+    ]
+    single_frame = {key: ds for key, ds in headers.items() if ds.get("SOPClassUID") not in ENHANCED_CT_SOP_CLASSES}
+    if single_frame:
+        parts.insert(0, _single_frame_geometry(single_frame))
+    if not parts:
+        return []
+    keys = [key for part in parts for key in part.keys]
+    stack_uids = [stack_uid for part in parts for stack_uid in part.stack_uids]
+    orientation = np.concatenate([part.orientation for part in parts])
+    position = np.concatenate([part.position for part in parts])
+    pixel_spacing = np.concatenate([part.pixel_spacing for part in parts])
+    rows_columns = np.concatenate([part.rows_columns for part in parts])
+    # the same projection as img_stack_displacement, for every slice at once
+    displacement = np.einsum("ij,ij->i", np.cross(orientation[:, 0:3], orientation[:, 3:6]), position)
+    labels, stack_of_slice = np.unique([f"{series}\\{frame}" for series, frame in stack_uids], return_inverse=True)
+
+    stacks = []
+    for stack_index in range(len(labels)):
+        members = np.flatnonzero(stack_of_slice == stack_index)
+        # stable, so ties stay in the order of the headers as with the reverse sort of image_stack_sort
+        order = members[np.argsort(-displacement[members], kind="stable")]
+        series_instance_uid, frame_of_reference_uid = stack_uids[order[0]]
+        stacks.append(
+            StackGeometry(
+                series_instance_uid=series_instance_uid,
+                frame_of_reference_uid=frame_of_reference_uid,
+                keys=[keys[index] for index in order],
+                orientation=orientation[order],
+                position=position[order],
+                pixel_spacing=pixel_spacing[order],
+                rows_columns=rows_columns[order],
+                displacement=displacement[order],
+            )
+        )
+    return stacks
+
+
+DEFAULT_CHUNK_SIZE = 64
+
+
+def _read_ct_geometry_header(file: str) -> tuple[str, Dataset | None]:
+    """The file and geometry header of a (single or multi-frame) CT image, None for other files"""
+    try:
+        ds = read_ct_geometry_header(file)
+    except Exception:
+        return file, None
+    return file, ds if ds.get("SOPClassUID") in CT_IMAGE_SOP_CLASSES else None
+
+
+def read_ct_geometry_headers(
+    files: Iterable[str], workers: int | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Dict[str, Dataset]:
+    """
+    Read the geometry headers of CT images, in parallel for more than one chunk of files.
+
+    :param files: the files to read (e.g. the iter_dicom_files generator, consumed as the workers read),
+        those that are not CT images are left out
+    :param workers: processes reading headers, None for os.cpu_count(), 1 reads in this process
+    :param chunk_size: files per task sent to a worker
+    :return: the headers keyed by file
+    """
+    files = iter(files)
+    first_chunk = list(islice(files, chunk_size + 1))
+    if workers == 1 or len(first_chunk) <= chunk_size:
+        headers = map(_read_ct_geometry_header, chain(first_chunk, files))
+        return {file: ds for file, ds in headers if ds is not None}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        headers = executor.map(_read_ct_geometry_header, chain(first_chunk, files), chunksize=chunk_size)
+        return {file: ds for file, ds in headers if ds is not None}
+
+
+def scan_stack_geometry(
+    ct_directory: Path, workers: int | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE, recursive: bool = True
+) -> List[StackGeometry]:
+    """
+    Read the geometry headers of the CT images in a directory (one read per file) and split them into stacks.
+    See read_ct_geometry_headers for workers and chunk_size, recursive includes the subdirectories.
+    """
+    return split_stacks(read_ct_geometry_headers(iter_dicom_files(ct_directory, recursive), workers, chunk_size))
+
+
+def stack_geometry_problems(stack: StackGeometry) -> List[str]:
+    """
+    Check what get_stack_center assumes of a stack: every slice has the orientation, size and pixel spacing
+    of the last one, and the slices are evenly spaced along the stack axis, without gaps or duplicates.
+
+    :param stack: the stack to check
+    :return: a description of each problem found, empty when the stack is consistent
+    """
+    return _geometry_problems(
+        np.ptp(stack.orientation, axis=0).max(),
+        np.ptp(stack.rows_columns, axis=0).max(),
+        np.ptp(stack.pixel_spacing, axis=0).max(),
+        stack.displacement,
+    )
+
+
+def _geometry_problems(orientation_range, rows_columns_range, pixel_spacing_range, displacement) -> List[str]:
+    """stack_geometry_problems from the largest differences between slices and the descending displacements"""
+    problems = []
+    if orientation_range > ORIENTATION_TOLERANCE:
+        problems.append("ImageOrientationPatient differs between slices")
+    if rows_columns_range > 0:
+        problems.append("Rows/Columns differ between slices")
+    if pixel_spacing_range > PIXEL_SPACING_TOLERANCE_MM:
+        problems.append("PixelSpacing differs between slices")
+
+    steps = -np.diff(displacement)
+    duplicates = steps <= SLICE_POSITION_TOLERANCE_MM
+    if duplicates.any():
+        problems.append(f"{np.count_nonzero(duplicates)} duplicate slice positions")
+    steps = steps[~duplicates]
+    if steps.size:
+        spacing = np.median(steps)
+        gaps = steps > SLICE_GAP_FACTOR * spacing
+        if gaps.any():
+            problems.append(f"{np.count_nonzero(gaps)} gaps in the stack (slice spacing {spacing:g} mm)")
+        if np.abs(steps[~gaps] - spacing).max() > SLICE_POSITION_TOLERANCE_MM:
+            problems.append(f"Slice spacing is not uniform (median {spacing:g} mm)")
+    return problems
+
+
+def validate_stack_geometry(stack: StackGeometry) -> None:
+    """
+    :param stack: the stack to check
+    :raises ValueError: listing the problems found by stack_geometry_problems
+    """
+    _raise_geometry_problems(stack.series_instance_uid, stack.frame_of_reference_uid, stack_geometry_problems(stack))
+
+
+def _raise_geometry_problems(series_instance_uid: str, frame_of_reference_uid: str, problems: List[str]) -> None:
+    if problems:
+        raise ValueError(f"Series {series_instance_uid} (Frame of Reference {frame_of_reference_uid}): " + "; ".join(problems))
+
+
+def get_stack_geometry_center(stack: StackGeometry) -> List[float]:
+    """
+    :param stack: a (sorted) stack from split_stacks
+    :return: the same stack center as get_stack_center of the sorted headers
+    """
+    row_spacing, column_spacing = stack.pixel_spacing[-1]
+    rows, cols = stack.rows_columns[-1]
+    return _stack_center(stack.position[0], stack.position[-1], stack.orientation[-1], row_spacing, column_spacing, rows, cols)
+
+
+class StackGeometryAccumulator:
+    """
+    get_stack_geometry_center and validate_stack_geometry for the frames of one stack folded in as they are read,
+    so the headers are not kept: only the frames with the largest and smallest displacement along the stack axis,
+    the range of orientation, size and pixel spacing, and one displacement (8 bytes) per frame for the spacing check.
+    """
+
+    def __init__(self, series_instance_uid: str, frame_of_reference_uid: str):
+        self.series_instance_uid = series_instance_uid
+        self.frame_of_reference_uid = frame_of_reference_uid
+        self._first = None  # (displacement, position, orientation, pixel spacing, rows/columns) largest displacement
+        self._last = None  # the same for the smallest displacement
+        self._minimum = None  # elementwise minimum of orientation, pixel spacing and rows/columns
+        self._maximum = None
+        self._displacement = []
+
+    @property
+    def count(self) -> int:
+        return len(self._displacement)
+
+    def add(self, frames: FrameGeometry) -> None:
+        """
+        :param frames: frames of this stack, e.g. one single frame image or the frames of an enhanced CT
+        """
+        values = np.concatenate([frames.orientation, frames.pixel_spacing, frames.rows_columns], axis=1)
+        minimum, maximum = values.min(axis=0), values.max(axis=0)
+        self._minimum = minimum if self._minimum is None else np.minimum(self._minimum, minimum)
+        self._maximum = maximum if self._maximum is None else np.maximum(self._maximum, maximum)
+        # the same projection as img_stack_displacement
+        displacement = np.einsum("ij,ij->i", np.cross(frames.orientation[:, 0:3], frames.orientation[:, 3:6]), frames.position)
+        for index, value in enumerate(displacement):
+            frame = (
+                value,
+                frames.position[index],
+                frames.orientation[index],
+                frames.pixel_spacing[index],
+                frames.rows_columns[index],
+            )
+            # ties resolve as the stable sort of split_stacks does
+            if self._first is None or value > self._first[0]:
+                self._first = frame
+            if self._last is None or value <= self._last[0]:
+                self._last = frame
+        self._displacement.extend(displacement.tolist())
+
+    def problems(self) -> List[str]:
+        """:return: the problems stack_geometry_problems finds for the same frames"""
+        ranges = self._maximum - self._minimum
+        displacement = -np.sort(-np.array(self._displacement))
+        return _geometry_problems(ranges[0:6].max(), ranges[8:10].max(), ranges[6:8].max(), displacement)
+
+    def validate(self) -> None:
+        """:raises ValueError: as validate_stack_geometry does"""
+        _raise_geometry_problems(self.series_instance_uid, self.frame_of_reference_uid, self.problems())
+
+    def center(self) -> List[float]:
+        """:return: the same stack center as get_stack_geometry_center"""
+        if self._first is None:
+            raise ValueError("No slices in stack")
+        _, first_position, _, _, _ = self._first
+        _, last_position, orientation, (row_spacing, column_spacing), (rows, cols) = self._last
+        return _stack_center(first_position, last_position, orientation, row_spacing, column_spacing, rows, cols)
+
+
+def accumulate_stack_geometry(ct_directory: Path, recursive: bool = True) -> List[StackGeometryAccumulator]:
+    """
+    The stacks of the CT images in a directory, as scan_stack_geometry splits them, reading the geometry
+    header of one file at a time into a StackGeometryAccumulator per SeriesInstanceUID and FrameOfReferenceUID,
+    for when only the center of each stack is needed.
+
+    :param ct_directory: where the CT images are
+    :param recursive: include the subdirectories of ct_directory
+    :return: the stacks, ordered by SeriesInstanceUID and FrameOfReferenceUID
+    """
+    stacks = {}
+    for file in iter_dicom_files(ct_directory, recursive):
+        file, ds = _read_ct_geometry_header(file)
+        if ds is None:
+            continue
+        if ds.get("SOPClassUID") in ENHANCED_CT_SOP_CLASSES:
+            frames = enhanced_ct_frame_geometry(ds, file)
+        else:
+            frames = _single_frame_geometry({file: ds})
+        series_instance_uid, frame_of_reference_uid = frames.stack_uids[0]
+        label = f"{series_instance_uid}\\{frame_of_reference_uid}"
+        if label not in stacks:
+            stacks[label] = StackGeometryAccumulator(series_instance_uid, frame_of_reference_uid)
+        stacks[label].add(frames)
+    return [stacks[label] for label in sorted(stacks)]
+
+
 def usage():
-    print(f"{sys.argv[0]} ct_directory rt_ion_plan_file_path ref_rtss_file_path")
+    print(f"{sys.argv[0]} ct_directory rt_ion_plan_file_path ref_rtss_file_path [--memory-profile report.json]")
     print("The ct_directory is used to find the CBCT isocenter and to provide patient and study information")
     print("The RT Ion Plan is used to identify the (original) Frame of Reference UID and to validate the referenced RT SS UID")
     print("The Referenced RT Structure Set is used to identify the Series and SOP Instance UIDs of the reference CT")
+    print("--memory-profile writes the peak and retained memory and the top allocation sites of each stage (- for stderr)")
 
 
 def pre_populate_inroom_rtss_header(ct_ds: Dataset, inroom_rtss_ds: Dataset = None) -> Dataset:
@@ -199,6 +683,8 @@ def populate_ifsseq0099_rtss(sorted_stack, ct_stack_center, inroom_rtss_ds):
         contour_sequence_item = Dataset()
         contour_sequence_item.ReferencedSOPClassUID = ct_ds.SOPClassUID
         contour_sequence_item.ReferencedSOPInstanceUID = ct_ds.SOPInstanceUID
+        if ct_ds.SOPClassUID in ENHANCED_CT_SOP_CLASSES:
+            contour_sequence_item.ReferencedFrameNumber = ct_tuple[0][1]  # keyed by (file, frame number)
         ref_series_sequence_item.ContourImageSequence.append(contour_sequence_item)
 
     ref_study_sequence_item.ReferencedSeriesSequence.append(ref_series_sequence_item)
@@ -263,7 +749,101 @@ def populate_ifsseq0099_rtss(sorted_stack, ct_stack_center, inroom_rtss_ds):
     inroom_rtss_ds.RTROIObservationsSequence.append(rt_roi_observations_sequence_item)
 
 
+def generate_inroom_rtss(sorted_stack, ct_stack_center, first_ct_ds: Dataset = None) -> Dataset:
+    """
+    :param sorted_stack: (key, header) of the slices in the order of image_stack_sort,
+        the headers need at least SOPClassUID and SOPInstanceUID
+    :param ct_stack_center: the Setup Isocenter
+    :param first_ct_ds: complete header of the first slice, for the patient and study information,
+        when the headers in sorted_stack are partial (e.g. from read_ct_geometry_header)
+    :return: the IFSSEQ0099 in room RTSS
+    """
+    if first_ct_ds is not None:
+        sorted_stack = [(sorted_stack[0][0], first_ct_ds)] + list(sorted_stack[1:])
+    inroom_rtss_ds = pre_populate_inroom_rtss_header(sorted_stack[0][1])
+    populate_ifsseq0099_rtss(sorted_stack, ct_stack_center, inroom_rtss_ds)
+    inroom_rtss_ds.is_implicit_VR = True
+    inroom_rtss_ds.is_little_endian = True
+    return inroom_rtss_ds
+
+
+INROOM_RTSS_STAGES = ("Reading CT headers", "Stack geometry", "Building RTSS", "Writing RTSS")
+
+
+def write_inroom_rtss(
+    sorted_stack, ct_stack_center, output_directory: Path = Path("."), memory_profiler: MemoryProfiler | None = None
+) -> str:
+    """
+    Generate the in room RTSS of a stack of geometry headers keyed by file and write it to output_directory,
+    only the first slice is read again (for the patient and study information).
+
+    :param memory_profiler: records the INROOM_RTSS_STAGES building and writing the RTSS, when given
+    :return: the file written
+    """
+    with profiled(memory_profiler, INROOM_RTSS_STAGES[2]):
+        first_key = sorted_stack[0][0]
+        first_file = first_key[0] if isinstance(first_key, tuple) else first_key  # a frame of an enhanced CT
+        first_ct_ds = read_file(first_file, force=True, stop_before_pixels=True)
+        inroom_rtss_ds = generate_inroom_rtss(sorted_stack, ct_stack_center, first_ct_ds)
+    with profiled(memory_profiler, INROOM_RTSS_STAGES[3]):
+        rtss_path = os_path.join(str(output_directory), f"RS_{inroom_rtss_ds.SOPInstanceUID}.dcm")
+        write_file(rtss_path, inroom_rtss_ds)
+    return rtss_path
+
+
+def generate_inroom_rtss_per_series(
+    ct_directory: Path,
+    output_directory: Path = Path("."),
+    workers: int | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    recursive: bool = True,
+    memory_profiler: MemoryProfiler | None = None,
+) -> List[tuple[StackGeometry, str | ValueError]]:
+    """
+    Write an in room RTSS for every CT series (SeriesInstanceUID and FrameOfReferenceUID) in a directory,
+    e.g. a planning CT and several CBCTs exported together. The headers are read once, in parallel,
+    and the stacks are then generated in parallel.
+
+    :param ct_directory: where the CT images are
+    :param output_directory: where the RTSSs are written
+    :param workers: processes, None for os.cpu_count(), 1 does everything in this process
+    :param chunk_size: files per header reading task sent to a worker
+    :param recursive: include the subdirectories of ct_directory
+    :param memory_profiler: records each of the INROOM_RTSS_STAGES (building and writing once per stack),
+        everything is then done in this process, as the memory of worker processes is not traced
+    :return: for each stack, the RTSS file written, or the ValueError of validate_stack_geometry
+    """
+    if memory_profiler is not None:
+        workers = 1
+    with profiled(memory_profiler, INROOM_RTSS_STAGES[0]):
+        headers = read_ct_geometry_headers(iter_dicom_files(ct_directory, recursive), workers, chunk_size)
+    results = []
+    jobs = {}  # position in results: arguments of write_inroom_rtss
+    with profiled(memory_profiler, INROOM_RTSS_STAGES[1]):
+        for stack in split_stacks(headers):
+            try:
+                validate_stack_geometry(stack)
+            except ValueError as e:
+                results.append((stack, e))
+                continue
+            sorted_stack = [(key, headers[key[0] if isinstance(key, tuple) else key]) for key in stack.keys]
+            jobs[len(results)] = (sorted_stack, get_stack_geometry_center(stack), output_directory)
+            results.append((stack, None))
+    if workers == 1 or len(jobs) <= 1:
+        written = {
+            position: write_inroom_rtss(*arguments, memory_profiler=memory_profiler) for position, arguments in jobs.items()
+        }
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {position: executor.submit(write_inroom_rtss, *arguments) for position, arguments in jobs.items()}
+            written = {position: future.result() for position, future in futures.items()}
+    return [(stack, written.get(position, result)) for position, (stack, result) in enumerate(results)]
+
+
 if __name__ == "__main__":
+    # --memory-profile <file.json> (- for stderr) reports the memory used by each stage
+    memory_profile_path = pop_memory_profile_argument(sys.argv)
+    profiler = MemoryProfiler() if memory_profile_path is not None else None
     num_args = len(sys.argv)
     if num_args < 2:
         usage()
@@ -272,30 +852,35 @@ if __name__ == "__main__":
     ct_directory = Path(sys.argv[1]).expanduser()
     if not ct_directory.exists():
         sys.exit(f"Unable to find {ct_directory}")
-    # ct_stack_center = get_stack_center_from_path(ct_directory)
-    dict_of_ct_headers = load_ct_headers_from_directory(ct_directory)
-    sorted_stack = image_stack_sort(dict_of_ct_headers)
-    ct_stack_center = get_stack_center(sorted_stack)
-    print(ct_stack_center)
     if num_args < 4:
+        # only the center is needed, the geometry elements of one file at a time are enough
+        with profiled(profiler, INROOM_RTSS_STAGES[0]):
+            stacks = accumulate_stack_geometry(ct_directory)
+        for stack in stacks:
+            try:
+                stack.validate()
+            except ValueError as e:
+                sys.exit(str(e))
+            print(f"{stack.series_instance_uid}: {stack.center()}")
+        if profiler is not None:
+            profiler.write(memory_profile_path)
         usage()
         sys.exit()
-    else:
-        ion_plan_ds = read_file(Path(sys.argv[2]).expanduser(), force=True)
-        ref_rt_ss = read_file(Path(sys.argv[3]).expanduser(), force=True)
-        plan_ref_rtss = str(ion_plan_ds.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
-        ref_rtss_uid = str(ref_rt_ss.SOPInstanceUID)
-        if plan_ref_rtss != ref_rtss_uid:
-            sys.exit(f"Referenced RT SS in plan: {plan_ref_rtss} doesn't match RT SS UID: {ref_rtss_uid}")
-
-    now = datetime.now()
-    # Pre-populate the inroom RT SS with data from the CT
-    # Patient and Study Information
-    first_ct_ds = sorted_stack[0][1]
-    inroom_rtss_ds = pre_populate_inroom_rtss_header(first_ct_ds)
-
-    populate_ifsseq0099_rtss(sorted_stack, ct_stack_center, inroom_rtss_ds)
-
-    inroom_rtss_ds.is_implicit_VR = True
-    inroom_rtss_ds.is_little_endian = True
-    write_file(f"RS_{inroom_rtss_ds.SOPInstanceUID}.dcm", inroom_rtss_ds)
+    ion_plan_ds = read_file(Path(sys.argv[2]).expanduser(), force=True)
+    ref_rt_ss = read_file(Path(sys.argv[3]).expanduser(), force=True)
+    plan_ref_rtss = str(ion_plan_ds.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
+    ref_rtss_uid = str(ref_rt_ss.SOPInstanceUID)
+    if plan_ref_rtss != ref_rtss_uid:
+        sys.exit(f"Referenced RT SS in plan: {plan_ref_rtss} doesn't match RT SS UID: {ref_rtss_uid}")
+
+    # one in room RT SS per CT series in the directory
+    results = generate_inroom_rtss_per_series(ct_directory, memory_profiler=profiler)
+    if profiler is not None:
+        profiler.write(memory_profile_path)
+    if not results:
+        sys.exit(f"No CT images in {ct_directory}")
+    for stack, result in results:
+        if isinstance(result, ValueError):
+            print(f"Skipped {result}")
+        else:
+            print(f"{stack.series_instance_uid}: {get_stack_geometry_center(stack)} written to {result}")
@@ -1,19 +1,45 @@
 import os
+import queue
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import *
 from tkinter import ttk, filedialog, messagebox
 from tkinter.scrolledtext import ScrolledText
 from tkinter.ttk import *
 import compute_6dof_from_reg_rtss_plan
+from auto_watch import DirectoryWatcher
+from preload_cache import PreloadCache
+
+
+OUTPUT_FLUSH_INTERVAL_MS = 50
 
 
 class Redirector:
+    """File-like object for sys.stdout/sys.stderr that is safe to write to from any thread.
+    Messages are queued and inserted into the widget in one batch by flush_to_widget on the Tk main loop.
+    """
+
     def __init__(self, widget):
         self.widget = widget
+        self.messages = queue.SimpleQueue()
 
     def write(self, message):
-        self.widget.insert("end", message)
-        self.widget.see("end")
+        self.messages.put(message)
+
+    def flush(self):
+        pass
+
+    def flush_to_widget(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.widget.insert("end", "".join(batch))
+            self.widget.see("end")
 
 
 def showWindow():
@@ -37,19 +63,87 @@ def open_IonPlanfile_dialog():
 def calculate():
     if os.path.exists(SRO_file_path.get()) and os.path.exists(RTSS_file_path.get()) and os.path.exists(IonPlan_file_path.get()):
         print("="*30)
-        compute_6dof_from_reg_rtss_plan.do_calculate(SRO_file_path.get(), RTSS_file_path.get(), IonPlan_file_path.get())
+        cancel_event.clear()
+        buttonStart.config(state="disabled")
+        buttonCancel.config(state="normal")
+        future = executor.submit(
+            compute_6dof_from_reg_rtss_plan.do_calculate,
+            SRO_file_path.get(),
+            RTSS_file_path.get(),
+            IonPlan_file_path.get(),
+            progress=gui_events.put,
+            cancel_event=cancel_event,
+            read_dataset=preload_cache.get,
+        )
+        future.add_done_callback(gui_events.put)
     else:
         messagebox.showerror("ERROR", "Given DICOM files not found.")
 
+def cancel():
+    cancel_event.set()
+    progress_text.set("Cancelling...")
+
+def calculation_done(future):
+    buttonStart.config(state="normal")
+    buttonCancel.config(state="disabled")
+    try:
+        future.result()
+        progress_text.set("Done")
+    except compute_6dof_from_reg_rtss_plan.CalculationCancelled:
+        progress_text.set("Cancelled")
+    except Exception as e:
+        progress_text.set("Failed")
+        print(f"ERROR: {e}")
+
+def toggle_watch():
+    """Start (or stop) calculating every SRO exported to a folder, as soon as its RTSS and plan are there too"""
+    if watch_stop_event.is_set():
+        directory = filedialog.askdirectory(title="Export folder to watch")
+        if not directory:
+            return
+        watch_stop_event.clear()
+        print("="*30)
+        print(f"Watching {directory}")
+        threading.Thread(target=DirectoryWatcher(directory).run, args=(watch_stop_event,), daemon=True).start()
+        buttonWatch.config(text="Stop watching")
+    else:
+        watch_stop_event.set()
+        print("Stopped watching")
+        buttonWatch.config(text="Watch folder...")
+
+def poll_worker():
+    """Runs on the Tk main loop: applies the stage names and results queued by the worker, then the batched output"""
+    while True:
+        try:
+            event = gui_events.get_nowait()
+        except queue.Empty:
+            break
+        if isinstance(event, str):
+            progress_text.set(event + "...")
+        else:
+            calculation_done(event)
+    sys.stdout.flush_to_widget()
+    root.after(OUTPUT_FLUSH_INTERVAL_MS, poll_worker)
+
 
 root = Tk()
 root.title("RT Registration Calc")
 root.geometry("800x600")
 root.minsize(640,480)
 
+executor = ThreadPoolExecutor(max_workers=1)
+cancel_event = threading.Event()
+watch_stop_event = threading.Event()
+watch_stop_event.set()  # set while no folder is watched
+gui_events = queue.SimpleQueue()  # stage names and finished futures from the worker
+# files are parsed as soon as they are selected, on their own threads so the calculation never waits behind them
+preload_cache = PreloadCache(ThreadPoolExecutor(max_workers=3))
+
 SRO_file_path = StringVar()
 RTSS_file_path = StringVar()
 IonPlan_file_path = StringVar()
+for slot, file_path in (("SRO", SRO_file_path), ("RTSS", RTSS_file_path), ("IonPlan", IonPlan_file_path)):
+    file_path.trace_add("write", lambda *args, slot=slot, file_path=file_path: preload_cache.preload(slot, file_path.get()))
 
 notebook = ttk.Notebook(root)
 notebook.pack(pady=10, fill="both", expand=True)
@@ -82,8 +176,17 @@ entryIonPlan.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
 buttonIonPlan = Button(tab1, text="...", width=3, command=open_IonPlanfile_dialog)
 buttonIonPlan.grid(row=2, column=2, padx=5, pady=5)
 
-buttonStart = Button(tab1, text="Calculate", width=20, command=calculate)
-buttonStart.grid(row=3, column=0, columnspan=3, padx=5, pady=10)
+frameButtons = Frame(tab1)
+frameButtons.grid(row=3, column=0, columnspan=3, padx=5, pady=10)
+buttonStart = Button(frameButtons, text="Calculate", width=20, command=calculate)
+buttonStart.pack(side="left", padx=5)
+buttonCancel = Button(frameButtons, text="Cancel", width=10, command=cancel, state="disabled")
+buttonCancel.pack(side="left", padx=5)
+buttonWatch = Button(frameButtons, text="Watch folder...", width=16, command=toggle_watch)
+buttonWatch.pack(side="left", padx=5)
+progress_text = StringVar()
+labelProgress = Label(frameButtons, textvariable=progress_text, width=24)
+labelProgress.pack(side="left", padx=5)
 
 textOutput = ScrolledText(tab1)
 textOutput.config(background="gray12", foreground="gray88")
@@ -98,7 +201,8 @@ textAbout = ScrolledText(tab2)
 textAbout.pack(pady=10, fill="both", expand=True)
 
 sys.stdout = Redirector(textOutput)
-sys.stderr = Redirector(textOutput)
+sys.stderr = sys.stdout
+root.after(OUTPUT_FLUSH_INTERVAL_MS, poll_worker)
 
 with open("README.md", "r") as f:
     content = f.read()
@@ -0,0 +1,169 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in memory profile of the stages of a calculation
+
+A MemoryProfiler is passed to do_calculate (compute_6dof_from_reg_rtss_plan) or to
+generate_inroom_rtss_per_series (gen_inroom_rtss), or requested on their command lines with
+`--memory-profile <file.json>` ("-" for stderr, apart from the results on stdout). For each stage it records:
+    - the tracemalloc peak during the stage, above what was allocated when it started
+    - what the stage left allocated, and the source lines that allocated most of it
+    - the resident set size (RSS) at the end of the stage and its change over the stage (Linux only, None elsewhere)
+Nothing is traced unless a profiler is in use, tracemalloc slows Python allocations down noticeably.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict, Iterator, List, NamedTuple
+
+MEMORY_PROFILE_OPTION = "--memory-profile"
+
+DEFAULT_TOP_ALLOCATIONS = 10
+
+_KIB = 1024
+
+_IGNORED_FILES = (tracemalloc.__file__, contextlib.__file__, "<frozen importlib._bootstrap>", "<unknown>")
+
+
+class StageMemory(NamedTuple):
+    stage: str
+    seconds: float
+    peak_kib: float
+    """tracemalloc peak during the stage, above the traced memory at its start"""
+    retained_kib: float
+    """traced memory at the end of the stage less that at its start"""
+    rss_kib: float | None
+    """resident set size at the end of the stage"""
+    rss_delta_kib: float | None
+    top_allocations: List[Dict[str, object]]
+    """{"site": "file:line", "kib": ..., "count": ...} of the memory retained, largest first"""
+
+
+def current_rss_kib() -> float | None:
+    """Resident set size of this process, None where /proc/self/statm is not available"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / _KIB
+
+
+class MemoryProfiler:
+    """Records a StageMemory for each stage between start(stage) and the next start() or stop()"""
+
+    def __init__(self, top_allocations: int = DEFAULT_TOP_ALLOCATIONS):
+        """
+        Args:
+            top_allocations (int): allocation sites reported per stage
+        """
+        self.top_allocations = top_allocations
+        self.stages: List[StageMemory] = []
+        self._stage: str | None = None
+        self._started_tracing = False
+        self._start_time = 0.0
+        self._start_traced = 0
+        self._start_rss: float | None = None
+        self._start_snapshot: tracemalloc.Snapshot | None = None
+
+    def start(self, stage: str) -> None:
+        """Begin a stage, ending the current one"""
+        self.stop()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._stage = stage
+        self._start_snapshot = tracemalloc.take_snapshot()
+        self._start_rss = current_rss_kib()
+        self._start_traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self._start_time = time.perf_counter()
+
+    def stop(self) -> None:
+        """End the current stage (if any), and stop tracing if start() began it"""
+        if self._stage is None:
+            return
+        seconds = time.perf_counter() - self._start_time
+        traced, peak = tracemalloc.get_traced_memory()
+        rss = current_rss_kib()
+        snapshot = tracemalloc.take_snapshot()
+        filters = [tracemalloc.Filter(False, filename) for filename in _IGNORED_FILES]
+        differences = snapshot.filter_traces(filters).compare_to(self._start_snapshot.filter_traces(filters), "lineno")
+        top = [
+            {
+                "site": f"{difference.traceback[0].filename}:{difference.traceback[0].lineno}",
+                "kib": round(difference.size_diff / _KIB, 1),
+                "count": difference.count_diff,
+            }
+            for difference in differences[: self.top_allocations]
+            if difference.size_diff > 0
+        ]
+        self.stages.append(
+            StageMemory(
+                stage=self._stage,
+                seconds=seconds,
+                peak_kib=(peak - self._start_traced) / _KIB,
+                retained_kib=(traced - self._start_traced) / _KIB,
+                rss_kib=rss,
+                rss_delta_kib=None if rss is None or self._start_rss is None else rss - self._start_rss,
+                top_allocations=top,
+            )
+        )
+        self._stage = None
+        self._start_snapshot = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """The block as one stage"""
+        self.start(stage)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def report(self) -> Dict[str, object]:
+        """The stages as plain data, ready for json"""
+        return {"stages": [stage._asdict() for stage in self.stages]}
+
+    def write(self, path: str) -> None:
+        """Write the report as JSON to path ("-" for stderr, so it does not mix with the results on stdout)"""
+        if path == "-":
+            json.dump(self.report(), sys.stderr, indent=2)
+            print(file=sys.stderr)
+            return
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+def profiled(profiler: MemoryProfiler | None, stage: str) -> contextlib.AbstractContextManager:
+    """profiler.stage(stage), or a context doing nothing when there is no profiler"""
+    return contextlib.nullcontext() if profiler is None else profiler.stage(stage)
+
+
+def pop_memory_profile_argument(argv: List[str]) -> str | None:
+    """Remove `--memory-profile <path>` from a command line, returning the path (None when absent)"""
+    if MEMORY_PROFILE_OPTION not in argv:
+        return None
+    position = argv.index(MEMORY_PROFILE_OPTION)
+    if position + 1 >= len(argv):
+        raise ValueError(f"{MEMORY_PROFILE_OPTION} needs the path of the report (- for stderr)")
+    path = argv[position + 1]
+    del argv[position : position + 2]
+    return path
@@ -0,0 +1,103 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal in memory SRO, in room RTSS and RT Ion Plan datasets, shared by the test fixtures and the benchmarks
+
+Each holds only what the calculation reads. For complete objects written to disk see synthetic_corpus.
+"""
+
+from typing import Sequence as SequenceType
+
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+MOCK_FOUR_BY_FOUR = np.array(
+    [
+        [0.999, 0.012, 0.008, 10.0],
+        [-0.010, 0.998, 0.015, -5.0],
+        [-0.009, -0.014, 0.999, 2.5],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+"""the registration of the mock SRO (close to, but not exactly, a rotation)"""
+MOCK_FOUR_BY_FOUR.flags.writeable = False
+
+
+def make_matrix_item(four_by_four: SequenceType[float] | np.ndarray = MOCK_FOUR_BY_FOUR) -> Dataset:
+    """Create the matrix item with the 4x4 transformation matrix."""
+    matrix_item = Dataset()
+    matrix_item.FrameOfReferenceTransformationMatrix = [float(value) for value in np.ravel(four_by_four)]
+    return matrix_item
+
+
+def build_registration_sequence(matrix_item: Dataset) -> Sequence:
+    """Compose the nested registration sequence using the matrix item."""
+    matrix_seq = Sequence([matrix_item])
+    matrix_reg_item = Dataset()
+    matrix_reg_item.MatrixSequence = matrix_seq
+    matrix_reg_seq = Sequence([matrix_reg_item])
+    reg_item = Dataset()
+    reg_item.MatrixRegistrationSequence = matrix_reg_seq
+    return Sequence([reg_item])
+
+
+def make_registration_dataset(four_by_four: SequenceType[float] | np.ndarray = MOCK_FOUR_BY_FOUR) -> Dataset:
+    """A registration dataset with a single registration."""
+    reg_ds = Dataset()
+    reg_ds.RegistrationSequence = build_registration_sequence(make_matrix_item(four_by_four))
+    return reg_ds
+
+
+def make_rtss_dataset(setup_isocenter: SequenceType[str | float] = ("100.0", "200.0", "300.0")) -> Dataset:
+    """An in room RT Structure Set with a SetupIsocenter point."""
+    contour_item = Dataset()
+    contour_item.ContourGeometricType = "POINT"
+    contour_item.ContourData = list(setup_isocenter)
+    contour_item.NumberOfContourPoints = 1
+    roi_contour_item = Dataset()
+    roi_contour_item.ContourSequence = Sequence([contour_item])
+    roi_contour_item.ReferencedROINumber = 2
+
+    roi_item = Dataset()
+    roi_item.ROINumber = 2
+    roi_item.ROIName = "SetupIsocenter"
+
+    rtss_ds = Dataset()
+    rtss_ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.3"
+    rtss_ds.ROIContourSequence = Sequence([roi_contour_item])
+    rtss_ds.StructureSetROISequence = Sequence([roi_item])
+    return rtss_ds
+
+
+def make_ion_plan_dataset(
+    isocenter: SequenceType[str | float] = ("105.0", "195.0", "305.0"), patient_position: str = "HFS"
+) -> Dataset:
+    """An RT Ion Plan with a single beam and a patient setup."""
+    control_point_item = Dataset()
+    control_point_item.IsocenterPosition = list(isocenter)
+    control_point_item.PatientSupportAngle = 0.0
+    beam_item = Dataset()
+    beam_item.BeamNumber = 1
+    beam_item.BeamName = "SETUP"
+    beam_item.IonControlPointSequence = Sequence([control_point_item])
+
+    patient_setup_item = Dataset()
+    patient_setup_item.PatientPosition = patient_position
+
+    plan_ds = Dataset()
+    plan_ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.4"
+    plan_ds.FrameOfReferenceUID = "1.2.3.4.5.6.7.8.9.5"
+    plan_ds.IonBeamSequence = Sequence([beam_item])
+    plan_ds.PatientSetupSequence = Sequence([patient_setup_item])
+    return plan_ds
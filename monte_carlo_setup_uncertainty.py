@@ -0,0 +1,329 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Monte-Carlo propagation of registration and setup uncertainty into the 6DOF correction
+
+The SRO 4x4 is perturbed by a random rotation (applied after the registration rotation) and a random
+translation, and the Setup Isocenter by a random offset. The samples go through the same vectorized
+decomposition, Patient Position conversion and translation math as compute_6dof_from_components_batch,
+in chunks (optionally spread over several processes). Each chunk is folded into a fixed size histogram and running
+moments as soon as it is done and then dropped, so memory is bounded by the chunk size, the number of chunks in
+flight and the histogram, not by the number of samples.
+
+Returns:
+    percentiles of the IEC 61217 Table Top Yaw/Pitch/Roll and translation
+"""
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+import convert_matrix_to_euler as cnv
+import extract_plan_setupbeam_isocenter as ep
+import extract_rtss_setup_isocenter as ertss
+
+NOISE_MODELS = ("normal", "uniform")
+
+DEFAULT_PERCENTILES = (2.5, 5.0, 50.0, 95.0, 97.5)
+
+# bins per output column, the percentiles are exact to (sample range / HISTOGRAM_BINS)
+HISTOGRAM_BINS = 1 << 16
+
+
+def _sample_noise(rng: np.random.Generator, model: str, scale: np.ndarray, count: int) -> np.ndarray:
+    """(count,3) samples, scale is the standard deviation (normal) or the half width (uniform) per axis"""
+    if model == "normal":
+        return rng.normal(0.0, 1.0, (count, 3)) * scale
+    if model == "uniform":
+        return rng.uniform(-1.0, 1.0, (count, 3)) * scale
+    raise ValueError(f"noise model {model} not supported, must be one of {NOISE_MODELS}")
+
+
+class _StreamingStatistics:
+    """Histogram, extrema and moments per column, merged chunk by chunk
+
+    The bin width doubles (merging neighbouring bins) whenever a chunk falls outside the current range,
+    so the histogram keeps a fixed size whatever the number of samples.
+    """
+
+    def __init__(self, columns: int, bins: int = HISTOGRAM_BINS):
+        self.bins = bins
+        self.count = 0
+        self.counts = np.zeros((columns, bins), dtype=np.int64)
+        self.low = np.zeros(columns, dtype=np.float64)
+        self.width = np.zeros(columns, dtype=np.float64)
+        self.minimum = np.full(columns, np.inf)
+        self.maximum = np.full(columns, -np.inf)
+        self.mean = np.zeros(columns, dtype=np.float64)
+        self.m2 = np.zeros(columns, dtype=np.float64)
+
+    def add(self, samples: np.ndarray) -> None:
+        """Fold a (count, columns) chunk into the statistics"""
+        count = samples.shape[0]
+        chunk_minimum = samples.min(axis=0)
+        chunk_maximum = samples.max(axis=0)
+        if self.count == 0:
+            self.low = chunk_minimum.copy()
+            span = np.maximum(chunk_maximum - chunk_minimum, 1e-9 * np.maximum(1.0, np.abs(chunk_minimum)))
+            self.width = span * (1.0 + 1e-9) / self.bins
+        for column in range(samples.shape[1]):
+            self._cover(column, chunk_minimum[column], chunk_maximum[column])
+            index = np.floor((samples[:, column] - self.low[column]) / self.width[column]).astype(np.int64)
+            self.counts[column] += np.bincount(np.clip(index, 0, self.bins - 1), minlength=self.bins)
+
+        # Chan et al. parallel update of the mean and the sum of squared deviations
+        chunk_mean = samples.mean(axis=0)
+        chunk_m2 = ((samples - chunk_mean) ** 2).sum(axis=0)
+        total = self.count + count
+        delta = chunk_mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + chunk_m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.minimum = np.minimum(self.minimum, chunk_minimum)
+        self.maximum = np.maximum(self.maximum, chunk_maximum)
+
+    def _cover(self, column: int, minimum: float, maximum: float) -> None:
+        """Double the bin width of a column until [minimum, maximum] is inside its range"""
+        while minimum < self.low[column] or maximum >= self.low[column] + self.width[column] * self.bins:
+            # grow downwards by half the new range when below, so the old bin edges stay new bin edges
+            shift = self.bins // 2 if minimum < self.low[column] else 0
+            merged = np.zeros(self.bins, dtype=np.int64)
+            np.add.at(merged, (np.arange(self.bins) + shift) // 2, self.counts[column])
+            self.counts[column] = merged
+            self.low[column] -= shift * self.width[column]
+            self.width[column] *= 2.0
+
+    def percentiles(self, percentiles: Sequence[float]) -> np.ndarray:
+        """(P, columns) percentiles, linear within a bin and clipped to the sample extrema"""
+        ranks = np.asarray(percentiles, dtype=np.float64) / 100.0 * (self.count - 1) + 0.5
+        values = np.empty((len(ranks), self.counts.shape[0]), dtype=np.float64)
+        for column, counts in enumerate(self.counts):
+            cumulative = np.cumsum(counts)
+            bin_index = np.minimum(np.searchsorted(cumulative, ranks), self.bins - 1)
+            before = cumulative[bin_index] - counts[bin_index]
+            fraction = (ranks - before) / np.maximum(counts[bin_index], 1)
+            values[:, column] = self.low[column] + self.width[column] * (bin_index + fraction)
+        return np.clip(values, self.minimum, self.maximum)
+
+    def standard_deviation(self) -> np.ndarray:
+        return np.sqrt(self.m2 / max(self.count - 1, 1))
+
+
+def _simulate_chunk(
+    seed: np.random.SeedSequence,
+    count: int,
+    four_by_four_matrix: np.ndarray,
+    setup_iso_dicom_patient: np.ndarray,
+    plan_iso_dicom_patient: np.ndarray,
+    patient_position: str,
+    rotation_noise: Tuple[str, np.ndarray],
+    translation_noise: Tuple[str, np.ndarray],
+    setup_isocenter_noise: Tuple[str, np.ndarray],
+    tolerance_ortho_normality: float | None,
+    reorthonormalization_tolerance: float | None,
+) -> np.ndarray:
+    """Simulate count samples, returns (count,6): Yaw, Pitch, Roll, then Lateral, Longitudinal, Vertical"""
+    rng = np.random.default_rng(seed)
+    rotation_noise_radians = np.radians(_sample_noise(rng, rotation_noise[0], rotation_noise[1], count))
+    perturbed = np.empty((count, 4, 4), dtype=np.float64)
+    perturbed[:] = four_by_four_matrix
+    perturbed[:, 0:3, 0:3] = cnv.euler_angles_to_rotation_matrix_batch(rotation_noise_radians) @ four_by_four_matrix[0:3, 0:3]
+    perturbed[:, 0:3, 3] += _sample_noise(rng, translation_noise[0], translation_noise[1], count)
+    setup_isos = setup_iso_dicom_patient + _sample_noise(rng, setup_isocenter_noise[0], setup_isocenter_noise[1], count)
+
+    ypr, translation = c6.compute_6dof_from_components_batch(
+        perturbed,
+        setup_isos,
+        plan_iso_dicom_patient,
+        patient_position,
+        tolerance_ortho_normality=tolerance_ortho_normality,
+        reorthonormalization_tolerance=reorthonormalization_tolerance,
+    )
+    return np.concatenate([ypr, translation], axis=1)
+
+
+def simulate_setup_uncertainty(
+    four_by_four_matrix: np.ndarray,
+    setup_iso_dicom_patient: np.ndarray,
+    plan_iso_dicom_patient: np.ndarray,
+    patient_position: str,
+    sample_count: int,
+    rotation_sigma_degrees: float | Sequence[float] = 0.0,
+    translation_sigma_mm: float | Sequence[float] = 0.0,
+    setup_isocenter_sigma_mm: float | Sequence[float] = 0.0,
+    rotation_noise_model: str = "normal",
+    translation_noise_model: str = "normal",
+    setup_isocenter_noise_model: str = "normal",
+    percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+    seed: int | None = None,
+    chunk_size: int = 100_000,
+    workers: int = 1,
+    tolerance_ortho_normality: float | None = None,
+    reorthonormalization_tolerance: float | None = None,
+) -> Dict[str, np.ndarray]:
+    """Propagate registration and setup uncertainty into percentiles of the IEC 61217 Table Top correction
+
+    Args:
+        four_by_four_matrix (np.ndarray): the 4x4 registration matrix from the SRO
+        setup_iso_dicom_patient (np.ndarray): the Setup Isocenter from the in room RTSS
+        plan_iso_dicom_patient (np.ndarray): the isocenter from the RT Ion Plan
+        patient_position (str): The DICOM Patient Position coded string from the plan
+        sample_count (int): the number of samples
+        rotation_sigma_degrees: scale of the rotation noise about DICOM Patient x, y, z (one value or one per axis)
+        translation_sigma_mm: scale of the registration translation noise (one value or one per axis)
+        setup_isocenter_sigma_mm: scale of the Setup Isocenter noise (one value or one per axis)
+        rotation_noise_model, translation_noise_model, setup_isocenter_noise_model (str): one of NOISE_MODELS,
+        for "normal" the scale is the standard deviation, for "uniform" the half width
+        percentiles (Sequence[float]): the percentiles to report
+        seed (int | None): seed for reproducible results, independent of chunk_size and workers
+        chunk_size (int): samples per chunk, which bounds the memory of the intermediate arrays
+        workers (int): number of processes, 1 computes the chunks in this process
+        tolerance_ortho_normality (float | None): allowed difference of R^T R from identity for the registration
+        reorthonormalization_tolerance (float | None): wider bound within which the registration rotation is
+        projected onto the nearest rotation matrix (once, before it is perturbed) instead of failing
+
+    Returns:
+        Dict[str, np.ndarray]: "percentiles" (P,), "ypr_degrees" (P,3) [Yaw, Pitch, Roll],
+        "translation_iec_mm" (P,3) [Lateral, Longitudinal, Vertical], their sample means "ypr_mean_degrees" and
+        "translation_mean_iec_mm" (3,), standard deviations "ypr_std_degrees" and "translation_std_iec_mm" (3,)
+        and "sample_count". The percentiles come from a histogram of HISTOGRAM_BINS bins per column, at most
+        2 * workers chunks are in flight, and no samples are kept beyond their chunk.
+    """
+    for model in (rotation_noise_model, translation_noise_model, setup_isocenter_noise_model):
+        if model not in NOISE_MODELS:
+            raise ValueError(f"noise model {model} not supported, must be one of {NOISE_MODELS}")
+    c6.patient_position_index(patient_position)
+    if sample_count < 1 or chunk_size < 1:
+        raise ValueError("sample_count and chunk_size must be positive")
+
+    four_by_four_matrix = np.asarray(four_by_four_matrix, dtype=np.float64)
+    if reorthonormalization_tolerance is not None:
+        orthonormality_error = cnv.orthonormality_error(four_by_four_matrix[0:3, 0:3])
+        if not cnv.is_orthonormal(four_by_four_matrix[0:3, 0:3], tolerance_ortho_normality) and (
+            orthonormality_error < reorthonormalization_tolerance
+        ):
+            four_by_four_matrix = four_by_four_matrix.copy()
+            four_by_four_matrix[0:3, 0:3], correction = cnv.nearest_rotation_matrix(four_by_four_matrix[0:3, 0:3])
+            cnv.log_reorthonormalization(orthonormality_error, correction)
+    setup_iso_dicom_patient = np.asarray(setup_iso_dicom_patient, dtype=np.float64)
+    plan_iso_dicom_patient = np.asarray(plan_iso_dicom_patient, dtype=np.float64)
+    noise = (
+        (rotation_noise_model, np.broadcast_to(np.asarray(rotation_sigma_degrees, dtype=np.float64), (3,))),
+        (translation_noise_model, np.broadcast_to(np.asarray(translation_sigma_mm, dtype=np.float64), (3,))),
+        (setup_isocenter_noise_model, np.broadcast_to(np.asarray(setup_isocenter_sigma_mm, dtype=np.float64), (3,))),
+    )
+
+    # one independent stream per chunk, so results depend only on seed and chunk_size
+    chunk_counts = [min(chunk_size, sample_count - start) for start in range(0, sample_count, chunk_size)]
+    chunk_seeds = np.random.SeedSequence(seed).spawn(len(chunk_counts))
+    arguments = (four_by_four_matrix, setup_iso_dicom_patient, plan_iso_dicom_patient, patient_position, *noise)
+    tolerances = (tolerance_ortho_normality, reorthonormalization_tolerance)
+
+    statistics = _StreamingStatistics(6)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            for chunk_seed, count in zip(chunk_seeds, chunk_counts):
+                if len(in_flight) == 2 * workers:
+                    statistics.add(in_flight.popleft().result())
+                in_flight.append(executor.submit(_simulate_chunk, chunk_seed, count, *arguments, *tolerances))
+            while in_flight:
+                statistics.add(in_flight.popleft().result())
+    else:
+        for chunk_seed, count in zip(chunk_seeds, chunk_counts):
+            statistics.add(_simulate_chunk(chunk_seed, count, *arguments, *tolerances))
+
+    percentile_values = statistics.percentiles(percentiles)
+    standard_deviation = statistics.standard_deviation()
+    return {
+        "percentiles": np.asarray(percentiles, dtype=np.float64),
+        "ypr_degrees": percentile_values[:, 0:3],
+        "translation_iec_mm": percentile_values[:, 3:6],
+        "ypr_mean_degrees": statistics.mean[0:3],
+        "translation_mean_iec_mm": statistics.mean[3:6],
+        "ypr_std_degrees": standard_deviation[0:3],
+        "translation_std_iec_mm": standard_deviation[3:6],
+        "sample_count": np.asarray(sample_count),
+    }
+
+
+def simulate_setup_uncertainty_from_datasets(
+    reg_ds: pydicom.Dataset, rtss_ds: pydicom.Dataset, plan_ds: pydicom.Dataset, sample_count: int, **kwargs
+) -> Dict[str, np.ndarray]:
+    """simulate_setup_uncertainty around the values compute_6dof_from_reg_rtss_plan would use
+
+    Args:
+        reg_ds (pydicom.Dataset): dataset representing the Spatial Registration Object
+        rtss_ds (pydicom.Dataset): dataset representing the RT Structure Set for the in room image volume
+        plan_ds (pydicom.Dataset): dataset representing the RT Ion Plan (containing the planned setup isocenter)
+        sample_count (int): the number of samples
+        **kwargs: the noise, percentile and chunking arguments of simulate_setup_uncertainty
+
+    Returns:
+        Dict[str, np.ndarray]: see simulate_setup_uncertainty
+    """
+    return simulate_setup_uncertainty(
+        c6.select_registration_matrix(reg_ds, rtss_ds, plan_ds),
+        np.array(ertss.extract_rtss_setup_isocenter(rtss_ds), dtype=np.float64),
+        np.array(ep.extract_plan_setupbeam_isocenter(plan_ds), dtype=np.float64),
+        str(plan_ds.PatientSetupSequence[0].PatientPosition),
+        sample_count,
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sro_path")
+    parser.add_argument("rtss_path")
+    parser.add_argument("plan_path")
+    parser.add_argument("--samples", type=int, default=1_000_000)
+    parser.add_argument("--rotation-sigma", type=float, default=0.5, help="degrees")
+    parser.add_argument("--translation-sigma", type=float, default=1.0, help="mm")
+    parser.add_argument("--setup-isocenter-sigma", type=float, default=0.5, help="mm")
+    parser.add_argument("--noise-model", choices=NOISE_MODELS, default="normal")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--reorthonormalization-tolerance", type=float, default=None)
+    args = parser.parse_args()
+
+    result = simulate_setup_uncertainty_from_datasets(
+        pydicom.dcmread(args.sro_path, force=True),
+        pydicom.dcmread(args.rtss_path, force=True),
+        pydicom.dcmread(args.plan_path, force=True),
+        args.samples,
+        rotation_sigma_degrees=args.rotation_sigma,
+        translation_sigma_mm=args.translation_sigma,
+        setup_isocenter_sigma_mm=args.setup_isocenter_sigma,
+        rotation_noise_model=args.noise_model,
+        translation_noise_model=args.noise_model,
+        setup_isocenter_noise_model=args.noise_model,
+        seed=args.seed,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        reorthonormalization_tolerance=args.reorthonormalization_tolerance,
+    )
+    print(f"Samples: {result['sample_count']}")
+    for percentile, ypr, translation in zip(result["percentiles"], result["ypr_degrees"], result["translation_iec_mm"]):
+        print(f"P{percentile:g}: IEC Translation in mm[Lateral, Longitudinal, Vertical]: {translation}")
+        print(f"P{percentile:g}: IEC Rotation [Yaw, Pitch, Roll]: {ypr}")
+    print(f"Mean: IEC Translation in mm[Lateral, Longitudinal, Vertical]: {result['translation_mean_iec_mm']}")
+    print(f"Mean: IEC Rotation [Yaw, Pitch, Roll]: {result['ypr_mean_degrees']}")
+    print(f"Std: IEC Translation in mm[Lateral, Longitudinal, Vertical]: {result['translation_std_iec_mm']}")
+    print(f"Std: IEC Rotation [Yaw, Pitch, Roll]: {result['ypr_std_degrees']}")
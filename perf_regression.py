@@ -0,0 +1,304 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Performance regression gate for the entry points, against stored baselines
+
+Usage:
+    python perf_regression.py [--record] [--baselines perf_baselines.json] [--max-slowdown 1.5]
+        [--max-memory-growth 1.25] [case_name ...]
+
+Each case runs an entry point on a synthetic_corpus input and measures its time per call and its
+peak traced memory (tracemalloc). Times are divided by the time of a fixed calibration loop measured in the
+same run, so a baseline recorded on one machine can gate another.
+With --record the measurements are written as the new baselines, otherwise they are compared with the
+baselines and the exit status is 1 when a case is slower than max-slowdown times its baseline, or allocates
+more than max-memory-growth times its baseline peak.
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import statistics
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple
+
+import numpy as np
+import pydicom
+from pydicom.dataelem import RawDataElement
+from pydicom.tag import Tag
+
+import compute_6dof_from_reg_rtss_plan as c6
+import gen_inroom_rtss
+from extract_rtss_setup_isocenter import extract_rtss_setup_isocenter
+from synthetic_corpus import CorpusSpec, generate_corpus, make_inroom_rtss
+
+BASELINES_PATH = Path(__file__).with_name("perf_baselines.json")
+
+DEFAULT_MAX_SLOWDOWN = 1.5
+
+DEFAULT_MAX_MEMORY_GROWTH = 1.25
+
+REPEAT = 7
+
+CORPUS_SPEC = CorpusSpec(patients=1, fractions=1, slices=200, rows=64, columns=64, beams=4, spots=2000, contour_points=1000)
+
+
+class PerfCase(NamedTuple):
+    setup: Callable[[Path], Callable[[], object]]
+    """builds the inputs in a scratch directory and returns the call to measure"""
+    number: int
+    """calls per timing"""
+
+
+class Measurement(NamedTuple):
+    seconds: float
+    """best time per call"""
+    normalized_time: float
+    """median ratio of the time per call to the calibration loop's time"""
+    peak_kib: float
+    """peak memory traced by tracemalloc during one call"""
+
+
+PERF_CASES: Dict[str, PerfCase] = {}
+
+
+def perf_case(name: str, number: int = 1) -> Callable:
+    """Register a case setup under name"""
+
+    def register(setup: Callable[[Path], Callable[[], object]]) -> Callable[[Path], Callable[[], object]]:
+        PERF_CASES[name] = PerfCase(setup, number)
+        return setup
+
+    return register
+
+
+def _calibration_loop() -> None:
+    """Fixed work of the kind the entry points do: small object churn, string parsing and small array math"""
+    values = {}
+    for index in range(5_000):
+        text = f"{index * 0.5:.3f}\\{index:d}"
+        values[text] = [float(part) for part in text.split("\\")]
+    matrix = np.identity(4)
+    for _ in range(500):
+        matrix = matrix @ np.identity(4)
+
+
+def calibration_seconds(repeat: int = REPEAT) -> float:
+    """Best time of the calibration loop on this machine, the unit of the normalized times"""
+    return min(timeit.repeat(_calibration_loop, number=1, repeat=repeat))
+
+
+def measure(call: Callable[[], object], number: int = 1, repeat: int = REPEAT) -> Measurement:
+    """Time per call normalized by the calibration loop, and peak traced memory of one call
+
+    Each timing of number calls directly follows a timing of the calibration loop and the normalized time is
+    the median of the repeat ratios, so a machine that slows down (or speeds up) during a run, or one
+    unlucky timing, does not move it.
+
+    Args:
+        call: what to measure, called once beforehand to warm up
+        number (int): calls per timing
+        repeat (int): paired timings
+
+    Returns:
+        Measurement: best raw time, normalized time and peak memory
+    """
+    seconds = []
+    ratios = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        call()
+        for _ in range(repeat):
+            unit_seconds = calibration_seconds(repeat=1)
+            seconds.append(timeit.timeit(call, number=number) / number)
+            ratios.append(seconds[-1] / unit_seconds)
+        tracemalloc.start()
+        try:
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return Measurement(min(seconds), statistics.median(ratios), peak / 1024)
+
+
+def run_case(name: str) -> Measurement:
+    """Set up and measure one registered case in a scratch directory"""
+    case = PERF_CASES[name]
+    with tempfile.TemporaryDirectory() as directory:
+        return measure(case.setup(Path(directory)), number=case.number)
+
+
+def load_baselines(path: Path = BASELINES_PATH) -> Dict[str, Dict[str, float]]:
+    """The stored baselines by case name, empty when none were recorded"""
+    if not Path(path).exists():
+        return {}
+    with open(path, encoding="utf-8") as baseline_file:
+        return json.load(baseline_file)["cases"]
+
+
+def save_baselines(measurements: Dict[str, Measurement], path: Path = BASELINES_PATH) -> None:
+    """Store measurements as the baselines, keeping those of the cases not measured"""
+    cases = load_baselines(path)
+    for name, measurement in measurements.items():
+        cases[name] = {
+            "normalized_time": round(measurement.normalized_time, 4),
+            "peak_kib": round(measurement.peak_kib, 1),
+        }
+    with open(path, "w", encoding="utf-8") as baseline_file:
+        json.dump({"cases": dict(sorted(cases.items()))}, baseline_file, indent=2)
+        baseline_file.write("\n")
+
+
+def regressions(
+    name: str,
+    measurement: Measurement,
+    baseline: Dict[str, float],
+    max_slowdown: float = DEFAULT_MAX_SLOWDOWN,
+    max_memory_growth: float = DEFAULT_MAX_MEMORY_GROWTH,
+) -> List[str]:
+    """Why a measurement fails its baseline, empty when it does not"""
+    problems = []
+    slowdown = measurement.normalized_time / baseline["normalized_time"]
+    if slowdown > max_slowdown:
+        problems.append(f"{name}: {slowdown:.2f}x slower than the baseline (limit {max_slowdown:.2f}x)")
+    memory_growth = measurement.peak_kib / baseline["peak_kib"]
+    if memory_growth > max_memory_growth:
+        problems.append(f"{name}: peak memory {memory_growth:.2f}x the baseline (limit {max_memory_growth:.2f}x)")
+    return problems
+
+
+def _fraction_paths(directory: Path, spec: CorpusSpec) -> tuple:
+    generate_corpus(directory, spec, workers=1)
+    patient_directory = directory / "patient_000"
+    fraction_directory = patient_directory / "fraction_000"
+    return fraction_directory / "RE.dcm", fraction_directory / "RS.dcm", patient_directory / "plan" / "RP.dcm"
+
+
+@perf_case("do_calculate", number=10)
+def case_do_calculate(directory: Path) -> Callable[[], object]:
+    """The command line calculation: reading the SRO, in room RTSS and plan (4 beams of 2000 spots) and calculating"""
+    sro_path, rtss_path, plan_path = _fraction_paths(directory, CORPUS_SPEC._replace(slices=0))
+    return lambda: c6.do_calculate(str(sro_path), str(rtss_path), str(plan_path))
+
+
+@perf_case("get_stack_center_from_path")
+def case_get_stack_center_from_path(directory: Path) -> Callable[[], object]:
+    """Center of a 200 slice CT directory"""
+    generate_corpus(directory, CORPUS_SPEC._replace(beams=0, spots=0), workers=1)
+    return lambda: gen_inroom_rtss.get_stack_center_from_path(directory / "patient_000" / "fraction_000" / "CT")
+
+
+_CONTOUR_DATA_TAG = Tag("ContourData")
+
+
+def make_large_rtss(roi_count: int = 50, contours_per_roi: int = 20, points_per_contour: int = 200) -> pydicom.Dataset:
+    """The synthetic in room RTSS with roi_count organs of contours_per_roi contours each before its Setup Isocenter"""
+    rtss_ds = make_inroom_rtss(CORPUS_SPEC._replace(contour_points=points_per_contour), 0, 0)
+    body_contour = rtss_ds.ROIContourSequence[0].ContourSequence[0]
+    setup_isocenter = (
+        rtss_ds.StructureSetROISequence.pop(),
+        rtss_ds.ROIContourSequence.pop(),
+        rtss_ds.RTROIObservationsSequence.pop(),
+    )
+    # encoded once and shared as a raw element, converting 200000 DS values per build would dominate the setup
+    contour_data = "\\".join(str(value) for value in body_contour.ContourData).encode("ascii")
+    contour_data += b" " * (len(contour_data) % 2)
+    rtss_ds.ROIContourSequence[0].ContourSequence = pydicom.Sequence()
+    for roi_number in range(2, roi_count + 1):
+        for sequence, item in zip(
+            (rtss_ds.StructureSetROISequence, rtss_ds.ROIContourSequence, rtss_ds.RTROIObservationsSequence),
+            (rtss_ds.StructureSetROISequence[0], rtss_ds.ROIContourSequence[0], rtss_ds.RTROIObservationsSequence[0]),
+        ):
+            sequence.append(copy.deepcopy(item))
+        rtss_ds.StructureSetROISequence[-1].ROINumber = roi_number
+        rtss_ds.StructureSetROISequence[-1].ROIName = f"ORGAN{roi_number}"
+        rtss_ds.ROIContourSequence[-1].ReferencedROINumber = roi_number
+        rtss_ds.RTROIObservationsSequence[-1].ObservationNumber = roi_number
+        rtss_ds.RTROIObservationsSequence[-1].ReferencedROINumber = roi_number
+    for roi_contour in rtss_ds.ROIContourSequence:
+        roi_contour.ContourSequence = pydicom.Sequence()
+        for _ in range(contours_per_roi):
+            contour = pydicom.Dataset()
+            contour.ContourGeometricType = body_contour.ContourGeometricType
+            contour.NumberOfContourPoints = body_contour.NumberOfContourPoints
+            contour[_CONTOUR_DATA_TAG] = RawDataElement(
+                _CONTOUR_DATA_TAG, "DS", len(contour_data), contour_data, 0, True, True
+            )
+            roi_contour.ContourSequence.append(contour)
+    setup_isocenter[0].ROINumber = setup_isocenter[1].ReferencedROINumber = roi_count + 1
+    setup_isocenter[2].ObservationNumber = setup_isocenter[2].ReferencedROINumber = roi_count + 1
+    for sequence, item in zip(
+        (rtss_ds.StructureSetROISequence, rtss_ds.ROIContourSequence, rtss_ds.RTROIObservationsSequence), setup_isocenter
+    ):
+        sequence.append(item)
+    return rtss_ds
+
+
+@perf_case("extract_rtss_setup_isocenter", number=5)
+def case_extract_rtss_setup_isocenter(directory: Path) -> Callable[[], object]:
+    """Reading a large RTSS (50 organs of 20 contours of 200 points before the Setup Isocenter) and extracting it"""
+    rtss_path = directory / "RS_large.dcm"
+    make_large_rtss().save_as(rtss_path, enforce_file_format=True)
+    return lambda: extract_rtss_setup_isocenter(pydicom.dcmread(rtss_path, force=True))
+
+
+@perf_case("populate_ifsseq0099_rtss_and_write", number=5)
+def case_populate_ifsseq0099_rtss_and_write(directory: Path) -> Callable[[], object]:
+    """Building the in room RTSS of a 200 slice stack (headers already read) and writing it"""
+    generate_corpus(directory, CORPUS_SPEC._replace(beams=0, spots=0), workers=1)
+    sorted_stack = gen_inroom_rtss.image_stack_sort(
+        gen_inroom_rtss.load_ct_headers_from_directory(directory / "patient_000" / "fraction_000" / "CT")
+    )
+    center = gen_inroom_rtss.get_stack_center(sorted_stack)
+    rtss_path = str(directory / "RS_inroom.dcm")
+
+    def run():
+        inroom_rtss_ds = gen_inroom_rtss.pre_populate_inroom_rtss_header(sorted_stack[0][1])
+        gen_inroom_rtss.populate_ifsseq0099_rtss(sorted_stack, center, inroom_rtss_ds)
+        pydicom.dcmwrite(rtss_path, inroom_rtss_ds, implicit_vr=True, little_endian=True)
+
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help="case names, all of them by default")
+    parser.add_argument("--record", action="store_true", help="store the measurements as the new baselines")
+    parser.add_argument("--baselines", type=Path, default=BASELINES_PATH)
+    parser.add_argument("--max-slowdown", type=float, default=DEFAULT_MAX_SLOWDOWN)
+    parser.add_argument("--max-memory-growth", type=float, default=DEFAULT_MAX_MEMORY_GROWTH)
+    args = parser.parse_args()
+
+    baselines = load_baselines(args.baselines)
+    measurements = {}
+    failures = []
+    for case_name in args.cases or list(PERF_CASES):
+        measurements[case_name] = run_case(case_name)
+        print(
+            f"{case_name}: {1e3 * measurements[case_name].seconds:.3f} ms, "
+            f"normalized {measurements[case_name].normalized_time:.3f}, peak {measurements[case_name].peak_kib:.1f} KiB"
+        )
+        if not args.record and case_name in baselines:
+            failures += regressions(
+                case_name, measurements[case_name], baselines[case_name], args.max_slowdown, args.max_memory_growth
+            )
+    if args.record:
+        save_baselines(measurements, args.baselines)
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,96 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background parsing of the DICOM files as soon as they are selected
+
+The GUI has one slot per input (SRO, in room RTSS, RT Ion Plan). Selecting a file
+starts reading it on an executor and replaces whatever the slot held before.
+Entries are keyed by path and modification time, so a file that changed since it
+was preloaded is read again rather than served stale.
+"""
+
+import os
+import threading
+from concurrent.futures import Executor, Future
+from typing import Dict, Tuple
+
+import pydicom
+
+
+def _file_key(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def read_dataset(path: str) -> pydicom.Dataset:
+    """How the calculation reads its inputs"""
+    return pydicom.dcmread(path, force=True)
+
+
+class PreloadCache:
+    """One preloaded dataset per named slot, read in the background"""
+
+    def __init__(self, executor: Executor):
+        """
+        Args:
+            executor (Executor): where the files are read
+        """
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._slots: Dict[str, Tuple[Tuple[str, int, int], Future]] = {}
+
+    def preload(self, slot: str, path: str) -> Future | None:
+        """Start reading path into slot, evicting the slot's previous entry
+
+        Paths that are not (yet) an existing file just empty the slot, so this can be called on every edit of an entry.
+
+        Returns:
+            Future | None: the read in progress (or already done), None if path is not a file
+        """
+        try:
+            key = _file_key(path) if os.path.isfile(path) else None
+        except OSError:
+            key = None
+        with self._lock:
+            current = self._slots.get(slot)
+            if key is None:
+                self._slots.pop(slot, None)
+                return None
+            if current is not None and current[0] == key:
+                return current[1]
+            future = self.executor.submit(read_dataset, path)
+            self._slots[slot] = (key, future)
+            return future
+
+    def get(self, path: str) -> pydicom.Dataset:
+        """The dataset for path, from a slot when it was preloaded and has not changed since, otherwise read now"""
+        key = _file_key(path)
+        with self._lock:
+            futures = [future for slot_key, future in self._slots.values() if slot_key == key]
+        for future in futures:
+            try:
+                return future.result()
+            except Exception:
+                break  # read again below, so the error is raised in the caller's context
+        return read_dataset(path)
+
+    def evict(self, slot: str) -> None:
+        """Forget the slot's entry"""
+        with self._lock:
+            self._slots.pop(slot, None)
+
+    def is_loaded(self, slot: str) -> bool:
+        """Whether the slot holds a finished, successful read"""
+        with self._lock:
+            entry = self._slots.get(slot)
+        return entry is not None and entry[1].done() and entry[1].exception() is None
@@ -0,0 +1,226 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memoization of compute_6dof_from_reg_rtss_plan results
+
+Results are keyed by a SHA-256 of the SRO, in room RTSS and RT Ion Plan file contents
+(and the tolerances), so a file replaced under the same path is a different key.
+The os.stat signature of the three files (path, size, inode, mtime and ctime in ns)
+is remembered for each content key, which lets a repeat of an unchanged triple skip
+reading the files at all.
+Datasets already in memory are keyed by their SOPInstanceUIDs instead.
+
+Results live in an in memory LRU and, optionally, in a directory of small JSON files
+capped in total size, the least recently used files being evicted first.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+
+DEFAULT_MAX_ENTRIES = 256
+
+DEFAULT_MAX_STORE_BYTES = 16 * 1024 * 1024
+
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_content_digest(path: str) -> str:
+    """SHA-256 of the file contents, as hex"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as dicom_file:
+        for chunk in iter(lambda: dicom_file.read(_HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat_signature(path: str) -> Tuple[str, int, int, int, int]:
+    """What changes when a file is rewritten or replaced: (real path, size, inode, mtime ns, ctime ns)"""
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_size, stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+class CorrectionCache:
+    """In memory LRU (plus optional on disk store) of 6DOF corrections"""
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        store_directory: str | None = None,
+        max_store_bytes: int = DEFAULT_MAX_STORE_BYTES,
+        tolerance_ortho_normality: float | None = None,
+        reorthonormalization_tolerance: float | None = None,
+    ):
+        """
+        Args:
+            max_entries (int): the number of results kept in memory
+            store_directory (str | None): directory for the on disk store, None for memory only
+            max_store_bytes (int): the size cap of the on disk store
+            tolerance_ortho_normality (float | None): tolerance passed on to the rotation matrix check
+            reorthonormalization_tolerance (float | None): wider bound within which the rotation is re-orthonormalized
+        """
+        if max_entries < 1:
+            raise ValueError("max_entries must be positive")
+        self.max_entries = max_entries
+        self.store_directory = store_directory
+        self.max_store_bytes = max_store_bytes
+        self.tolerance_ortho_normality = tolerance_ortho_normality
+        self.reorthonormalization_tolerance = reorthonormalization_tolerance
+        self.hits = 0
+        self.misses = 0
+        self._results: OrderedDict[str, Tuple[np.ndarray, np.ndarray]] = OrderedDict()
+        self._content_keys: OrderedDict[tuple, str] = OrderedDict()
+        if store_directory is not None:
+            os.makedirs(store_directory, exist_ok=True)
+
+    def _key(self, *parts: str) -> str:
+        tolerances = f"{self.tolerance_ortho_normality!r}|{self.reorthonormalization_tolerance!r}"
+        return hashlib.sha256("|".join([*parts, tolerances]).encode()).hexdigest()
+
+    def compute(self, sro_path: str, rtss_path: str, plan_path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """compute_6dof_from_reg_rtss_plan for the three files, reading and parsing them only on a miss
+
+        Returns:
+            The correction in IEC61217 Table Top, Yaw/Pitch/Roll and translation
+        """
+        paths = (sro_path, rtss_path, plan_path)
+        signature = tuple(file_stat_signature(path) for path in paths)
+        key = self._content_keys.get(signature)
+        if key is not None:
+            result = self.get(key)
+            if result is not None:
+                self._content_keys.move_to_end(signature)
+                return result
+
+        key = self._key("files", *(file_content_digest(path) for path in paths))
+        self._remember_signature(signature, key)
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        self.misses += 1
+        datasets = [pydicom.dcmread(path, force=True) for path in paths]
+        return self.put(key, *self._calculate(*datasets))
+
+    def compute_datasets(
+        self, reg_ds: pydicom.Dataset, rtss_ds: pydicom.Dataset, plan_ds: pydicom.Dataset
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """compute_6dof_from_reg_rtss_plan for datasets already in memory, keyed by their SOPInstanceUIDs
+
+        Datasets without a SOPInstanceUID are not cached.
+        """
+        uids = [str(ds.get("SOPInstanceUID", "")) for ds in (reg_ds, rtss_ds, plan_ds)]
+        if not all(uids):
+            self.misses += 1
+            return self._calculate(reg_ds, rtss_ds, plan_ds)
+        key = self._key("uids", *uids)
+        result = self.get(key)
+        if result is not None:
+            return result
+        self.misses += 1
+        return self.put(key, *self._calculate(reg_ds, rtss_ds, plan_ds))
+
+    def _calculate(self, reg_ds, rtss_ds, plan_ds) -> Tuple[np.ndarray, np.ndarray]:
+        return c6.compute_6dof_from_reg_rtss_plan(
+            reg_ds,
+            rtss_ds,
+            plan_ds,
+            tolerance_ortho_normality=self.tolerance_ortho_normality,
+            reorthonormalization_tolerance=self.reorthonormalization_tolerance,
+        )
+
+    def _remember_signature(self, signature: tuple, key: str) -> None:
+        self._content_keys[signature] = key
+        self._content_keys.move_to_end(signature)
+        while len(self._content_keys) > self.max_entries:
+            self._content_keys.popitem(last=False)
+
+    def get(self, key: str) -> Tuple[np.ndarray, np.ndarray] | None:
+        """The cached result for key from memory or the on disk store (counted as a hit), or None"""
+        result = self._results.get(key)
+        if result is None:
+            result = self._read_store(key)
+            if result is None:
+                return None
+            self._insert(key, result)
+        else:
+            self._results.move_to_end(key)
+        self.hits += 1
+        return result[0].copy(), result[1].copy()
+
+    def put(self, key: str, ypr: np.ndarray, translation: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Cache a result in memory and in the on disk store, returns the result"""
+        result = (np.array(ypr, dtype=np.float64), np.array(translation, dtype=np.float64))
+        self._insert(key, result)
+        self._write_store(key, result)
+        return result[0].copy(), result[1].copy()
+
+    def _insert(self, key: str, result: Tuple[np.ndarray, np.ndarray]) -> None:
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop the in memory results (the on disk store is kept)"""
+        self._results.clear()
+        self._content_keys.clear()
+
+    def _store_path(self, key: str) -> str:
+        return os.path.join(self.store_directory, f"{key}.json")
+
+    def _read_store(self, key: str) -> Tuple[np.ndarray, np.ndarray] | None:
+        if self.store_directory is None:
+            return None
+        store_path = self._store_path(key)
+        try:
+            with open(store_path, encoding="utf-8") as store_file:
+                stored: Dict[str, list] = json.load(store_file)
+            os.utime(store_path)  # the modification time orders the eviction
+        except (OSError, ValueError):
+            return None
+        return np.array(stored["ypr"], dtype=np.float64), np.array(stored["translation"], dtype=np.float64)
+
+    def _write_store(self, key: str, result: Tuple[np.ndarray, np.ndarray]) -> None:
+        if self.store_directory is None:
+            return
+        temporary_path = self._store_path(key) + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as store_file:
+            json.dump({"ypr": result[0].tolist(), "translation": result[1].tolist()}, store_file)
+        os.replace(temporary_path, self._store_path(key))
+        self._evict_store()
+
+    def _evict_store(self) -> None:
+        """Remove the least recently used files until the store is within max_store_bytes"""
+        entries = []
+        with os.scandir(self.store_directory) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_store_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
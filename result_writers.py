@@ -0,0 +1,264 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming output of 6DOF corrections, one record per correction
+
+Records carry the provenance UIDs (SRO, in room RTSS, RT Ion Plan), the raw float64
+IEC 61217 Table Top values and the rounded values as MOSAIQ displays them.
+Writers buffer at most max_records records or max_seconds of records before flushing (a timer flushes
+records that no later write follows), so memory stays constant however many corrections are written.
+
+Formats:
+    JSON Lines (.jsonl), CSV (.csv) and Arrow IPC stream (.arrow, requires pyarrow)
+"""
+
+import abc
+import csv
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no cover - depends on the environment
+    pyarrow = None
+
+RECORD_FIELDS = (
+    "sro_sop_instance_uid",
+    "rtss_sop_instance_uid",
+    "plan_sop_instance_uid",
+    "yaw_deg",
+    "pitch_deg",
+    "roll_deg",
+    "lateral_mm",
+    "longitudinal_mm",
+    "vertical_mm",
+    "lateral_cm",
+    "longitudinal_cm",
+    "vertical_cm",
+    "rotation_x_deg",
+    "rotation_y_deg",
+    "rotation_z_deg",
+)
+
+_UID_FIELDS = RECORD_FIELDS[0:3]
+
+DEFAULT_MAX_RECORDS = 1000
+
+DEFAULT_MAX_SECONDS = 1.0
+
+
+def correction_record(
+    ypr: np.ndarray,
+    translation: np.ndarray,
+    sro_sop_instance_uid: str = "",
+    rtss_sop_instance_uid: str = "",
+    plan_sop_instance_uid: str = "",
+) -> Dict[str, str | float]:
+    """One output record for a correction
+
+    Args:
+        ypr (np.ndarray): IEC Rotation [Yaw, Pitch, Roll] in degrees
+        translation (np.ndarray): IEC Translation in mm [Lateral, Longitudinal, Vertical]
+        sro_sop_instance_uid, rtss_sop_instance_uid, plan_sop_instance_uid (str): provenance of the correction
+
+    Returns:
+        Dict[str, str | float]: the values keyed by RECORD_FIELDS
+    """
+    record = {
+        "sro_sop_instance_uid": str(sro_sop_instance_uid),
+        "rtss_sop_instance_uid": str(rtss_sop_instance_uid),
+        "plan_sop_instance_uid": str(plan_sop_instance_uid),
+        "yaw_deg": float(ypr[0]),
+        "pitch_deg": float(ypr[1]),
+        "roll_deg": float(ypr[2]),
+        "lateral_mm": float(translation[0]),
+        "longitudinal_mm": float(translation[1]),
+        "vertical_mm": float(translation[2]),
+    }
+    record.update(c6.mosaiq_display_values(ypr, translation))
+    return record
+
+
+class ResultWriter(abc.ABC):
+    """Base class for the streaming writers, buffers records and flushes on a record or time budget
+    The time budget is also enforced between writes, by a timer started with the first buffered record.
+    Writers can be shared between threads."""
+
+    def __init__(self, path: str, max_records: int = DEFAULT_MAX_RECORDS, max_seconds: float = DEFAULT_MAX_SECONDS):
+        """
+        Args:
+            path (str): the output file, overwritten if it exists
+            max_records (int): flush when this many records are buffered
+            max_seconds (float): flush when the oldest buffered record is this old
+        """
+        if max_records < 1:
+            raise ValueError("max_records must be positive")
+        self.path = path
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.records_written = 0
+        self._buffer: List[Dict[str, str | float]] = []
+        self._buffer_started = 0.0
+        self._flush_timer: threading.Timer | None = None
+        self._lock = threading.RLock()
+        self._closed = False
+
+    def write(self, record: Dict[str, str | float]) -> None:
+        """Buffer one record (keyed by RECORD_FIELDS), flushing if the budget is exhausted"""
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"{self.path} is already closed")
+            if not self._buffer:
+                self._buffer_started = time.monotonic()
+            self._buffer.append(record)
+            if len(self._buffer) >= self.max_records or time.monotonic() - self._buffer_started >= self.max_seconds:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.max_seconds, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def write_correction(
+        self,
+        ypr: np.ndarray,
+        translation: np.ndarray,
+        reg_ds: pydicom.Dataset | None = None,
+        rtss_ds: pydicom.Dataset | None = None,
+        plan_ds: pydicom.Dataset | None = None,
+    ) -> None:
+        """Write the record for a correction, taking the provenance UIDs from the datasets it was computed from"""
+        self.write(
+            correction_record(
+                ypr,
+                translation,
+                *(str(ds.get("SOPInstanceUID", "")) if ds is not None else "" for ds in (reg_ds, rtss_ds, plan_ds)),
+            )
+        )
+
+    def flush(self) -> None:
+        """Write out the buffered records"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._buffer and not self._closed:
+                self._write_records(self._buffer)
+                self.records_written += len(self._buffer)
+                self._buffer = []
+
+    def close(self) -> None:
+        """Flush and close the output file"""
+        with self._lock:
+            if not self._closed:
+                self.flush()
+                self._close()
+                self._closed = True
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    @abc.abstractmethod
+    def _write_records(self, records: List[Dict[str, str | float]]) -> None:
+        """Write the records to the output file"""
+
+    @abc.abstractmethod
+    def _close(self) -> None:
+        """Close the output file"""
+
+
+class JsonLinesResultWriter(ResultWriter):
+    """One JSON object per line"""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _write_records(self, records: List[Dict[str, str | float]]) -> None:
+        self._file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._file.flush()
+
+    def _close(self) -> None:
+        self._file.close()
+
+
+class CsvResultWriter(ResultWriter):
+    """A header row of RECORD_FIELDS then one row per correction, floats written with full precision"""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=RECORD_FIELDS)
+        self._writer.writeheader()
+
+    def _write_records(self, records: List[Dict[str, str | float]]) -> None:
+        self._writer.writerows(records)
+        self._file.flush()
+
+    def _close(self) -> None:
+        self._file.close()
+
+
+class ArrowResultWriter(ResultWriter):
+    """Arrow IPC stream, one record batch per flush (requires pyarrow)"""
+
+    def __init__(self, path: str, **kwargs):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for Arrow IPC output")
+        super().__init__(path, **kwargs)
+        self._schema = pyarrow.schema(
+            [(field, pyarrow.string() if field in _UID_FIELDS else pyarrow.float64()) for field in RECORD_FIELDS]
+        )
+        self._sink = pyarrow.OSFile(path, "wb")
+        self._writer = pyarrow.ipc.new_stream(self._sink, self._schema)
+
+    def _write_records(self, records: List[Dict[str, str | float]]) -> None:
+        columns = {field: [record[field] for record in records] for field in RECORD_FIELDS}
+        self._writer.write_batch(pyarrow.record_batch(columns, schema=self._schema))
+
+    def _close(self) -> None:
+        self._writer.close()
+        self._sink.close()
+
+
+RESULT_WRITERS = {
+    ".jsonl": JsonLinesResultWriter,
+    ".csv": CsvResultWriter,
+    ".arrow": ArrowResultWriter,
+}
+
+
+def open_result_writer(path: str, **kwargs) -> ResultWriter:
+    """Open the writer matching the file extension of path (see RESULT_WRITERS)
+
+    Args:
+        path (str): the output file
+        **kwargs: max_records and max_seconds
+
+    Returns:
+        ResultWriter: the writer, usable as a context manager
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in RESULT_WRITERS:
+        raise ValueError(f"output format {extension} not supported, must be one of {tuple(RESULT_WRITERS)}")
+    return RESULT_WRITERS[extension](path, **kwargs)
@@ -0,0 +1,319 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""DICOM C-STORE receiver (Storage SCP) that calculates the correction as objects arrive
+
+Usage:
+    python store_scp.py [port] [ae_title]
+
+Requires pynetdicom (optional dependency, `pip install pynetdicom`).
+
+SROs, RTSSs, plans and CT images are received into memory, nothing is written to disk.
+CT headers are folded into a StackCenterAccumulator per Frame of Reference as they arrive,
+the slices themselves are not kept. A CT stack is complete when the association that
+sent it is released, and dropped when that association is aborted.
+An SRO is calculated as soon as a plan is present on one of its registered Frames of Reference,
+and either an in room RTSS or a complete CT stack on another (the RTSS taking precedence), with the
+registration selected for that in room and plan Frame of Reference. The calculation runs outside the
+lock shared by the associations. RTSSs, plans and CT stacks are kept, so that a re-exported SRO is
+calculated again, until a later one replaces them on the same Frame of Reference, and in room RTSSs
+and CT stacks at most retention_seconds after they were received, so memory does not grow with the
+objects received.
+"""
+
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Set, Tuple
+
+import numpy as np
+from pydicom import Dataset, uid
+
+import compute_6dof_from_reg_rtss_plan as c6
+import extract_plan_setupbeam_isocenter as ep
+import extract_reg_matrix as er
+import extract_rtss_setup_isocenter as ertss
+from gen_inroom_rtss import StackCenterAccumulator
+from uid_index import (
+    KIND_IMAGE,
+    KIND_PLAN,
+    KIND_RTSS,
+    KIND_SRO,
+    HeaderSummary,
+    UidIndex,
+    dataset_header_summary,
+)
+
+try:
+    import pynetdicom
+    from pynetdicom import evt
+except ImportError:  # pragma: no cover - depends on the environment
+    pynetdicom = None
+
+STORAGE_SOP_CLASSES = (
+    uid.SpatialRegistrationStorage,
+    uid.RTStructureSetStorage,
+    uid.RTIonPlanStorage,
+    uid.RTPlanStorage,
+    uid.CTImageStorage,
+)
+
+DEFAULT_AE_TITLE = "RTREGCALC"
+
+DEFAULT_PORT = 11112
+
+DEFAULT_RETENTION_SECONDS = 4 * 3600.0
+
+SOURCE_RTSS = "RTSS"
+SOURCE_CT = "CT"
+
+_SUCCESS = 0x0000
+
+
+def disable_nagle(event) -> None:
+    """EVT_CONN_OPEN handler setting TCP_NODELAY, without it a small C-STORE waits for the peer's delayed ACK"""
+    event.assoc.dul.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def print_result(sro: HeaderSummary, source: str, ypr: np.ndarray, translation: np.ndarray) -> None:
+    """Default result handler"""
+    print("=" * 30)
+    print(f"SRO {sro.sop_instance_uid} (Setup Isocenter from {source})")
+    c6.report_correction(ypr, translation)
+
+
+def print_error(sro: HeaderSummary, error: Exception) -> None:
+    """Default error handler"""
+    print(f"Unable to calculate SRO {sro.sop_instance_uid}: {error}")
+
+
+class CalculationSCP:
+    """Storage SCP that keeps the received objects in memory and calculates each SRO once its inputs are present"""
+
+    def __init__(
+        self,
+        ae_title: str = DEFAULT_AE_TITLE,
+        on_result: Callable[[HeaderSummary, str, np.ndarray, np.ndarray], None] = print_result,
+        on_error: Callable[[HeaderSummary, Exception], None] = print_error,
+        maximum_associations: int = 10,
+        tolerance_ortho_normality: float | None = None,
+        reorthonormalization_tolerance: float | None = None,
+        retention_seconds: float | None = DEFAULT_RETENTION_SECONDS,
+    ):
+        """
+        Args:
+            ae_title (str): the AE title of the receiver
+            on_result: called with the SRO summary, the source of the Setup Isocenter (SOURCE_RTSS or SOURCE_CT),
+            Yaw/Pitch/Roll and the translation
+            on_error: called with the SRO summary and the exception when the calculation fails
+            maximum_associations (int): concurrent associations accepted
+            tolerance_ortho_normality (float | None): tolerance passed on to the rotation matrix check
+            reorthonormalization_tolerance (float | None): wider bound within which the rotation is re-orthonormalized
+            retention_seconds (float | None): how long an in room RTSS or CT stack is kept for (re-exported) SROs
+            after it was received, None keeps it until a later one on its Frame of Reference replaces it
+        """
+        if pynetdicom is None:
+            raise ImportError("pynetdicom is required for the DICOM receiver")
+        self.on_result = on_result
+        self.on_error = on_error
+        self.tolerance_ortho_normality = tolerance_ortho_normality
+        self.reorthonormalization_tolerance = reorthonormalization_tolerance
+        self.retention_seconds = retention_seconds
+        self.ae = pynetdicom.AE(ae_title=ae_title)
+        self.ae.maximum_associations = maximum_associations
+        for sop_class in STORAGE_SOP_CLASSES:
+            self.ae.add_supported_context(sop_class)
+        self.index = UidIndex()
+        self._lock = threading.Lock()
+        self._datasets: Dict[str, Dataset] = {}
+        self._pending_sros: Dict[str, HeaderSummary] = {}
+        self._stacks: Dict[str, StackCenterAccumulator] = {}
+        self._complete_stacks: Dict[str, StackCenterAccumulator] = {}
+        self._stacks_by_association: Dict[int, Set[str]] = {}
+        self._received: Dict[str, float] = {}  # time.monotonic() an RTSS or CT stack arrived, by Frame of Reference
+        self._server = None
+
+    def start(self, address: str = "127.0.0.1", port: int = DEFAULT_PORT) -> int:
+        """Start listening in the background
+
+        Returns:
+            int: the port listened on (useful with port 0)
+        """
+        self._server = self.ae.start_server(
+            (address, port),
+            block=False,
+            evt_handlers=[
+                (evt.EVT_CONN_OPEN, disable_nagle),
+                (evt.EVT_C_STORE, self._handle_store),
+                (evt.EVT_RELEASED, self._handle_released),
+                (evt.EVT_ABORTED, self._handle_aborted),
+            ],
+        )
+        return self._server.server_address[1]
+
+    def stop(self) -> None:
+        """Stop listening"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    def _handle_store(self, event) -> int:
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        with self._lock:
+            self._expire()
+            calculations = self._add(ds, id(event.assoc))
+        self._calculate_and_report(calculations)
+        return _SUCCESS
+
+    def _handle_released(self, event) -> None:
+        with self._lock:
+            self._expire()
+            frames_of_reference = self._stacks_by_association.pop(id(event.assoc), set())
+            for frame_of_reference_uid in frames_of_reference:
+                stack = self._stacks.pop(frame_of_reference_uid, None)
+                if stack is not None:  # None when another association sending the same stack was released first
+                    self._complete_stacks[frame_of_reference_uid] = stack
+                    self._received[frame_of_reference_uid] = time.monotonic()
+            calculations = self._calculate_pending(frames_of_reference)
+        self._calculate_and_report(calculations)
+
+    def _handle_aborted(self, event) -> None:
+        """Drop the partial CT stacks of an aborted association, unless another association is still sending them"""
+        with self._lock:
+            frames_of_reference = self._stacks_by_association.pop(id(event.assoc), set())
+            for frame_of_reference_uid in frames_of_reference:
+                if not any(frame_of_reference_uid in others for others in self._stacks_by_association.values()):
+                    self._stacks.pop(frame_of_reference_uid, None)
+
+    def _add(self, ds: Dataset, association: int) -> List[tuple]:
+        summary = dataset_header_summary(ds)
+        if summary.kind == KIND_IMAGE:
+            frame_of_reference_uid = str(ds.get("FrameOfReferenceUID", ""))
+            self._stacks.setdefault(frame_of_reference_uid, StackCenterAccumulator()).add(ds)
+            self._stacks_by_association.setdefault(association, set()).add(frame_of_reference_uid)
+            return []
+        if summary.kind not in (KIND_SRO, KIND_RTSS, KIND_PLAN) or not summary.sop_instance_uid:
+            return []
+        self.index.add(summary)
+        self._datasets[summary.sop_instance_uid] = ds
+        if summary.kind == KIND_SRO:
+            self._pending_sros[summary.sop_instance_uid] = summary
+        else:
+            self._drop_replaced(summary)
+            if summary.kind == KIND_RTSS:
+                for frame_of_reference_uid in summary.frames_of_reference:
+                    self._received[frame_of_reference_uid] = time.monotonic()
+        return self._calculate_pending(summary.frames_of_reference)
+
+    def _is_latest(self, summary: HeaderSummary) -> bool:
+        for frame_of_reference_uid in summary.frames_of_reference:
+            latest = self.index.latest(summary.kind, frame_of_reference_uid)
+            if latest is not None and latest.sop_instance_uid == summary.sop_instance_uid:
+                return True
+        return False
+
+    def _drop_replaced(self, summary: HeaderSummary) -> None:
+        """Drop the RTSSs or plans that summary replaces on every Frame of Reference they are on"""
+        for frame_of_reference_uid in summary.frames_of_reference:
+            for earlier in self.index.on_frame_of_reference(frame_of_reference_uid, summary.kind):
+                if earlier.sop_instance_uid in self._datasets and not self._is_latest(earlier):
+                    del self._datasets[earlier.sop_instance_uid]
+
+    def _expire(self) -> None:
+        """Drop the RTSSs and CT stacks of the Frames of Reference received more than retention_seconds ago"""
+        if self.retention_seconds is None:
+            return
+        oldest = time.monotonic() - self.retention_seconds
+        expired = [frame_of_reference_uid for frame_of_reference_uid, received in self._received.items() if received < oldest]
+        for frame_of_reference_uid in expired:
+            del self._received[frame_of_reference_uid]
+            self._complete_stacks.pop(frame_of_reference_uid, None)
+            for rtss in self.index.on_frame_of_reference(frame_of_reference_uid, KIND_RTSS):
+                self._datasets.pop(rtss.sop_instance_uid, None)
+
+    def _calculate_pending(self, frames_of_reference) -> List[tuple]:
+        """Take the pending SROs registering any of the Frames of Reference whose inputs are present
+
+        Returns:
+            List[tuple]: the calculations to run (outside the lock) and report, see _calculate
+        """
+        calculations = []
+        for frame_of_reference_uid in frames_of_reference:
+            for sro in self.index.sros_registering(frame_of_reference_uid):
+                if sro.sop_instance_uid in self._pending_sros:
+                    calculation = self._calculate(sro)
+                    if calculation is not None:
+                        calculations.append(calculation)
+        return calculations
+
+    def _setup_isocenter(self, sro: HeaderSummary, plan_frame_of_reference: str) -> Tuple[str, str, np.ndarray] | None:
+        """The source, in room Frame of Reference and Setup Isocenter for an SRO, None while neither is present"""
+        for frame_of_reference_uid in sro.frames_of_reference:
+            if frame_of_reference_uid == plan_frame_of_reference:
+                continue
+            rtss = self.index.latest(KIND_RTSS, frame_of_reference_uid)
+            if rtss is not None and rtss.sop_instance_uid in self._datasets:
+                rtss_ds = self._datasets[rtss.sop_instance_uid]
+                return SOURCE_RTSS, frame_of_reference_uid, np.array(ertss.extract_rtss_setup_isocenter(rtss_ds))
+            stack = self._complete_stacks.get(frame_of_reference_uid)
+            if stack is not None:
+                return SOURCE_CT, frame_of_reference_uid, np.array(stack.center())
+        return None
+
+    def _calculate(self, sro: HeaderSummary) -> tuple | None:
+        """Take an SRO off the pending ones once its inputs are present (called with the lock held)
+
+        Returns:
+            tuple | None: (sro, source, in room and plan Frames of Reference, Setup Isocenter, SRO, plan) to calculate
+        """
+        for plan_frame_of_reference in sro.frames_of_reference:
+            plan = self.index.latest(KIND_PLAN, plan_frame_of_reference)
+            if plan is None or plan.sop_instance_uid not in self._datasets:
+                continue
+            setup = self._setup_isocenter(sro, plan_frame_of_reference)
+            if setup is None:
+                continue
+            source, frame_of_reference_uid, setup_isocenter = setup
+            del self._pending_sros[sro.sop_instance_uid]
+            reg_ds = self._datasets.pop(sro.sop_instance_uid)
+            plan_ds = self._datasets[plan.sop_instance_uid]
+            return sro, source, frame_of_reference_uid, plan_frame_of_reference, setup_isocenter, reg_ds, plan_ds
+        return None
+
+    def _calculate_and_report(self, calculations: List[tuple]) -> None:
+        for calculation in calculations:
+            sro, source, frame_of_reference_uid, plan_frame_of_reference, setup_isocenter, reg_ds, plan_ds = calculation
+            try:
+                ypr, translation = c6.compute_6dof_from_components(
+                    er.extract_4x4_matrix_for_calculation(reg_ds, frame_of_reference_uid, plan_frame_of_reference),
+                    setup_isocenter,
+                    np.array(ep.extract_plan_setupbeam_isocenter(plan_ds)),
+                    str(plan_ds.PatientSetupSequence[0].PatientPosition),
+                    tolerance_ortho_normality=self.tolerance_ortho_normality,
+                    reorthonormalization_tolerance=self.reorthonormalization_tolerance,
+                )
+            except Exception as e:
+                self.on_error(sro, e)
+                continue
+            self.on_result(sro, source, ypr, translation)
+
+
+if __name__ == "__main__":
+    scp = CalculationSCP(ae_title=sys.argv[2] if len(sys.argv) > 2 else DEFAULT_AE_TITLE)
+    print(f"Listening on port {scp.start('', int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        scp.stop()
@@ -0,0 +1,437 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Seeded synthetic DICOM corpus for load testing
+
+Usage:
+    python synthetic_corpus.py <output_directory> [--patients 1] [--fractions 5] [--slices 200] [--beams 4]
+        [--spots 2000] [--contour-points 1000] [--seed 0] [--workers N]
+
+For each patient: an RT Ion Plan with B beams of S spots each and the reference RTSS it refers to,
+and for each fraction a CBCT series of N slices, the in room RTSS (SetupIsocenter at the center of the
+CBCT, plus a body contour of C points) and an SRO registering the CBCT to the plan with a random rotation.
+
+Every value (UIDs and pixel data included) is derived from the seed and the position of the object in the
+corpus, so the same spec writes the same bytes whatever the number of writer processes, and each writer
+builds its own objects instead of receiving them.
+
+Layout:
+    patient_000/plan/RP.dcm, RS.dcm
+    patient_000/fraction_000/CT/CT_0000.dcm ...
+    patient_000/fraction_000/RS.dcm, RE.dcm
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+from pydicom import Dataset, Sequence, uid
+from pydicom.dataset import FileMetaDataset
+
+import convert_matrix_to_euler as cnv
+
+
+class CorpusSpec(NamedTuple):
+    """The size of a synthetic corpus"""
+
+    patients: int = 1
+    fractions: int = 5
+    slices: int = 200
+    """CBCT slices per fraction"""
+    rows: int = 512
+    columns: int = 512
+    beams: int = 4
+    spots: int = 2000
+    """spots per beam, spread over ENERGY_LAYERS control points"""
+    contour_points: int = 1000
+    """points of the body contour of each RTSS"""
+    seed: int = 0
+
+
+ENERGY_LAYERS = 10
+
+PIXEL_SPACING_MM = 0.5
+
+SLICE_THICKNESS_MM = 1.0
+
+MAX_ROTATION_DEGREES = 3.0
+
+MAX_TRANSLATION_MM = 10.0
+
+SLICES_PER_TASK = 16
+
+_STUDY_DATE = "20230101"
+
+_TIME = "120000"
+
+
+def _uid(spec: CorpusSpec, *parts) -> str:
+    """A UID that only depends on the seed and the parts naming the object"""
+    return uid.generate_uid(entropy_srcs=[str(spec.seed), *(str(part) for part in parts)])
+
+
+def _rng(spec: CorpusSpec, *parts: int) -> np.random.Generator:
+    return np.random.default_rng([spec.seed, *parts])
+
+
+def _patient_module(ds: Dataset, patient: int) -> None:
+    ds.PatientName = f"SYNTHETIC^PATIENT{patient:04d}"
+    ds.PatientID = f"SYNTH{patient:04d}"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+
+
+def _study_module(ds: Dataset, spec: CorpusSpec, patient: int, fraction: int | None) -> None:
+    """The planning study (fraction None) or the study of a fraction"""
+    ds.StudyInstanceUID = _uid(spec, "study", patient, fraction)
+    ds.StudyDate = _STUDY_DATE
+    ds.StudyTime = _TIME
+    ds.StudyID = "PLAN" if fraction is None else f"FX{fraction}"
+    ds.AccessionNumber = ""
+    ds.ReferringPhysicianName = ""
+
+
+def _sop_common(ds: Dataset, sop_class_uid: str, sop_instance_uid: str, modality: str) -> None:
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = sop_class_uid
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    ds.file_meta.TransferSyntaxUID = uid.ExplicitVRLittleEndian
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.Modality = modality
+    ds.Manufacturer = "SYNTHETIC"
+
+
+def plan_frame_of_reference_uid(spec: CorpusSpec, patient: int) -> str:
+    return _uid(spec, "plan frame of reference", patient)
+
+
+def cbct_frame_of_reference_uid(spec: CorpusSpec, patient: int, fraction: int) -> str:
+    return _uid(spec, "cbct frame of reference", patient, fraction)
+
+
+def plan_isocenter(spec: CorpusSpec, patient: int) -> np.ndarray:
+    """The isocenter of every beam of the plan, in the reference CT"""
+    return np.round(_rng(spec, patient).uniform(-50.0, 50.0, 3), 2)
+
+
+def cbct_first_position(spec: CorpusSpec, patient: int, fraction: int) -> np.ndarray:
+    """ImagePositionPatient of the first (most inferior) slice, the CBCT being centered near the machine isocenter"""
+    offset = np.round(_rng(spec, patient, fraction).uniform(-5.0, 5.0, 3), 2)
+    half_extent = 0.5 * np.array(
+        [(spec.columns - 1) * PIXEL_SPACING_MM, (spec.rows - 1) * PIXEL_SPACING_MM, (spec.slices - 1) * SLICE_THICKNESS_MM]
+    )
+    return offset - half_extent
+
+
+def cbct_center(spec: CorpusSpec, patient: int, fraction: int) -> np.ndarray:
+    """The center of the CBCT volume, the SetupIsocenter of the in room RTSS"""
+    first = cbct_first_position(spec, patient, fraction)
+    extent = np.array(
+        [(spec.columns - 1) * PIXEL_SPACING_MM, (spec.rows - 1) * PIXEL_SPACING_MM, (spec.slices - 1) * SLICE_THICKNESS_MM]
+    )
+    return first + 0.5 * extent
+
+
+def registration_matrix(spec: CorpusSpec, patient: int, fraction: int) -> np.ndarray:
+    """A random rigid 4x4 (rotation up to MAX_ROTATION_DEGREES about each axis, translation up to MAX_TRANSLATION_MM)"""
+    rng = _rng(spec, patient, fraction, 1)
+    four_by_four = np.identity(4)
+    four_by_four[0:3, 0:3] = cnv.euler_angles_to_rotation_matrix(
+        np.radians(rng.uniform(-MAX_ROTATION_DEGREES, MAX_ROTATION_DEGREES, 3))
+    )
+    four_by_four[0:3, 3] = np.round(rng.uniform(-MAX_TRANSLATION_MM, MAX_TRANSLATION_MM, 3), 2)
+    return four_by_four
+
+
+def make_ion_plan(spec: CorpusSpec, patient: int) -> Dataset:
+    """RT Ion Plan with spec.beams beams of spec.spots spots, all beams at plan_isocenter"""
+    ds = Dataset()
+    _sop_common(ds, uid.RTIonPlanStorage, _uid(spec, "plan", patient), "RTPLAN")
+    _patient_module(ds, patient)
+    _study_module(ds, spec, patient, None)
+    ds.SeriesInstanceUID = _uid(spec, "plan series", patient)
+    ds.FrameOfReferenceUID = plan_frame_of_reference_uid(spec, patient)
+    ds.RTPlanLabel = "SYNTHETIC"
+    ds.RTPlanDate = _STUDY_DATE
+    ds.RTPlanTime = _TIME
+    ds.RTPlanGeometry = "PATIENT"
+    referenced_rtss_item = Dataset()
+    referenced_rtss_item.ReferencedSOPClassUID = uid.RTStructureSetStorage
+    referenced_rtss_item.ReferencedSOPInstanceUID = _uid(spec, "reference rtss", patient)
+    ds.ReferencedStructureSetSequence = Sequence([referenced_rtss_item])
+    patient_setup_item = Dataset()
+    patient_setup_item.PatientSetupNumber = 1
+    patient_setup_item.PatientPosition = "HFS"
+    ds.PatientSetupSequence = Sequence([patient_setup_item])
+
+    rng = _rng(spec, patient, 2)
+    isocenter = [float(value) for value in plan_isocenter(spec, patient)]
+    spots_per_layer = np.diff(np.linspace(0, spec.spots, ENERGY_LAYERS + 1).astype(int))
+    ds.IonBeamSequence = Sequence()
+    for beam_index in range(spec.beams):
+        beam = Dataset()
+        beam.BeamNumber = beam_index + 1
+        beam.BeamName = "SETUP" if beam_index == 0 else f"FIELD{beam_index}"
+        beam.BeamType = "STATIC"
+        beam.RadiationType = "PROTON"
+        beam.ScanMode = "MODULATED"
+        beam.TreatmentDeliveryType = "TREATMENT"
+        beam.NumberOfControlPoints = ENERGY_LAYERS
+        beam.IonControlPointSequence = Sequence()
+        gantry_angle = float(round(360.0 * beam_index / max(spec.beams, 1), 1))
+        for layer, spot_count in enumerate(spots_per_layer):
+            control_point = Dataset()
+            control_point.ControlPointIndex = layer
+            control_point.NominalBeamEnergy = float(round(200.0 - 5.0 * layer, 1))
+            control_point.ScanSpotTuneID = "SPOT"
+            control_point.NumberOfScanSpotPositions = int(spot_count)
+            control_point.ScanSpotPositionMap = np.round(rng.uniform(-50.0, 50.0, 2 * spot_count), 1).tolist()
+            control_point.ScanSpotMetersetWeights = np.round(rng.uniform(0.01, 1.0, spot_count), 4).tolist()
+            if layer == 0:
+                control_point.GantryAngle = gantry_angle
+                control_point.PatientSupportAngle = 0.0
+                control_point.IsocenterPosition = isocenter
+            beam.IonControlPointSequence.append(control_point)
+        ds.IonBeamSequence.append(beam)
+    return ds
+
+
+def _body_contour(spec: CorpusSpec, center: np.ndarray, z: float, parts: Tuple[int, ...]) -> List[float]:
+    """A closed planar contour of spec.contour_points points, an ellipse with some noise around center"""
+    rng = _rng(spec, *parts)
+    angles = np.linspace(0.0, 2.0 * np.pi, spec.contour_points, endpoint=False)
+    radius = rng.normal(1.0, 0.01, spec.contour_points)
+    points = np.column_stack(
+        [
+            center[0] + 150.0 * radius * np.cos(angles),
+            center[1] + 100.0 * radius * np.sin(angles),
+            np.full(spec.contour_points, z),
+        ]
+    )
+    return np.round(points, 2).ravel().tolist()
+
+
+def _add_roi(ds: Dataset, number: int, name: str, interpreted_type: str, geometric_type: str, data: List[float]) -> None:
+    roi_item = Dataset()
+    roi_item.ROINumber = number
+    roi_item.ReferencedFrameOfReferenceUID = ds.ReferencedFrameOfReferenceSequence[0].FrameOfReferenceUID
+    roi_item.ROIName = name
+    roi_item.ROIGenerationAlgorithm = "AUTOMATIC"
+    ds.StructureSetROISequence.append(roi_item)
+    contour_item = Dataset()
+    contour_item.ContourGeometricType = geometric_type
+    contour_item.NumberOfContourPoints = len(data) // 3
+    contour_item.ContourData = data
+    roi_contour_item = Dataset()
+    roi_contour_item.ReferencedROINumber = number
+    roi_contour_item.ContourSequence = Sequence([contour_item])
+    ds.ROIContourSequence.append(roi_contour_item)
+    observation_item = Dataset()
+    observation_item.ObservationNumber = number
+    observation_item.ReferencedROINumber = number
+    observation_item.RTROIInterpretedType = interpreted_type
+    observation_item.ROIInterpreter = ""
+    ds.RTROIObservationsSequence.append(observation_item)
+
+
+def _structure_set(spec: CorpusSpec, sop_instance_uid: str, frame_of_reference_uid: str, label: str) -> Dataset:
+    ds = Dataset()
+    _sop_common(ds, uid.RTStructureSetStorage, sop_instance_uid, "RTSTRUCT")
+    ds.StructureSetLabel = label
+    ds.StructureSetDate = _STUDY_DATE
+    ds.StructureSetTime = _TIME
+    frame_item = Dataset()
+    frame_item.FrameOfReferenceUID = frame_of_reference_uid
+    ds.ReferencedFrameOfReferenceSequence = Sequence([frame_item])
+    ds.StructureSetROISequence = Sequence()
+    ds.ROIContourSequence = Sequence()
+    ds.RTROIObservationsSequence = Sequence()
+    return ds
+
+
+def make_reference_rtss(spec: CorpusSpec, patient: int) -> Dataset:
+    """The reference RTSS the plan refers to, a body contour and the plan isocenter on the plan's Frame of Reference"""
+    ds = _structure_set(spec, _uid(spec, "reference rtss", patient), plan_frame_of_reference_uid(spec, patient), "Reference")
+    _patient_module(ds, patient)
+    _study_module(ds, spec, patient, None)
+    ds.SeriesInstanceUID = _uid(spec, "reference rtss series", patient)
+    isocenter = plan_isocenter(spec, patient)
+    _add_roi(ds, 1, "BODY", "EXTERNAL", "CLOSED_PLANAR", _body_contour(spec, isocenter, float(isocenter[2]), (patient, 3)))
+    _add_roi(ds, 2, "PlanIsocenter", "ISOCENTER", "POINT", [float(value) for value in isocenter])
+    return ds
+
+
+def make_inroom_rtss(spec: CorpusSpec, patient: int, fraction: int) -> Dataset:
+    """The in room RTSS of a fraction, SetupIsocenter at the center of the CBCT and a body contour"""
+    ds = _structure_set(
+        spec, _uid(spec, "inroom rtss", patient, fraction), cbct_frame_of_reference_uid(spec, patient, fraction), "InRoom"
+    )
+    _patient_module(ds, patient)
+    _study_module(ds, spec, patient, fraction)
+    ds.SeriesInstanceUID = _uid(spec, "inroom rtss series", patient, fraction)
+    center = cbct_center(spec, patient, fraction)
+    _add_roi(ds, 1, "BODY", "EXTERNAL", "CLOSED_PLANAR", _body_contour(spec, center, float(center[2]), (patient, fraction, 3)))
+    _add_roi(ds, 2, "SetupIsocenter", "SETUPISOCENTER", "POINT", [float(value) for value in center])
+    return ds
+
+
+def make_sro(spec: CorpusSpec, patient: int, fraction: int) -> Dataset:
+    """SRO registering the CBCT of a fraction (first registration) to the plan's Frame of Reference (identity),
+    which is also the SRO's own Frame of Reference"""
+    ds = Dataset()
+    _sop_common(ds, uid.SpatialRegistrationStorage, _uid(spec, "sro", patient, fraction), "REG")
+    _patient_module(ds, patient)
+    _study_module(ds, spec, patient, fraction)
+    ds.SeriesInstanceUID = _uid(spec, "sro series", patient, fraction)
+    ds.FrameOfReferenceUID = plan_frame_of_reference_uid(spec, patient)
+    ds.ContentDate = _STUDY_DATE
+    ds.ContentTime = _TIME
+    ds.RegistrationSequence = Sequence()
+    for frame_of_reference_uid, four_by_four in [
+        (cbct_frame_of_reference_uid(spec, patient, fraction), registration_matrix(spec, patient, fraction)),
+        (plan_frame_of_reference_uid(spec, patient), np.identity(4)),
+    ]:
+        matrix_item = Dataset()
+        matrix_item.FrameOfReferenceTransformationMatrixType = "RIGID"
+        matrix_item.FrameOfReferenceTransformationMatrix = [float(value) for value in four_by_four.ravel()]
+        matrix_registration_item = Dataset()
+        matrix_registration_item.MatrixSequence = Sequence([matrix_item])
+        registration_item = Dataset()
+        registration_item.FrameOfReferenceUID = frame_of_reference_uid
+        registration_item.MatrixRegistrationSequence = Sequence([matrix_registration_item])
+        ds.RegistrationSequence.append(registration_item)
+    return ds
+
+
+def make_cbct_slice(spec: CorpusSpec, patient: int, fraction: int, index: int) -> Dataset:
+    """Slice index (0 most inferior) of the CBCT of a fraction, with seeded noise as 16 bit pixel data"""
+    ds = Dataset()
+    _sop_common(ds, uid.CTImageStorage, _uid(spec, "cbct", patient, fraction, index), "CT")
+    _patient_module(ds, patient)
+    _study_module(ds, spec, patient, fraction)
+    ds.SeriesInstanceUID = _uid(spec, "cbct series", patient, fraction)
+    ds.FrameOfReferenceUID = cbct_frame_of_reference_uid(spec, patient, fraction)
+    ds.InstanceNumber = index + 1
+    ds.PatientPosition = "HFS"
+    ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    position = cbct_first_position(spec, patient, fraction) + [0.0, 0.0, index * SLICE_THICKNESS_MM]
+    ds.ImagePositionPatient = [float(value) for value in np.round(position, 2)]
+    ds.SliceThickness = SLICE_THICKNESS_MM
+    ds.PixelSpacing = [PIXEL_SPACING_MM, PIXEL_SPACING_MM]
+    ds.Rows = spec.rows
+    ds.Columns = spec.columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.RescaleIntercept = 0.0
+    ds.RescaleSlope = 1.0
+    pixels = _rng(spec, patient, fraction, index, 4).integers(-1000, 2000, spec.rows * spec.columns, dtype=np.int16)
+    ds.PixelData = pixels.astype("<i2").tobytes()
+    return ds
+
+
+def _save(ds: Dataset, path: str) -> int:
+    ds.save_as(path, enforce_file_format=True)
+    return os.path.getsize(path)
+
+
+def _write_task(task: tuple) -> Tuple[int, int]:
+    """Build and write the objects of one task, returns (files, bytes)"""
+    kind, spec, directory, patient, fraction, first, last = task
+    if kind == "plan":
+        plan_directory = os.path.join(directory, f"patient_{patient:03d}", "plan")
+        written = [
+            _save(make_ion_plan(spec, patient), os.path.join(plan_directory, "RP.dcm")),
+            _save(make_reference_rtss(spec, patient), os.path.join(plan_directory, "RS.dcm")),
+        ]
+    elif kind == "fraction":
+        fraction_directory = os.path.join(directory, f"patient_{patient:03d}", f"fraction_{fraction:03d}")
+        written = [
+            _save(make_inroom_rtss(spec, patient, fraction), os.path.join(fraction_directory, "RS.dcm")),
+            _save(make_sro(spec, patient, fraction), os.path.join(fraction_directory, "RE.dcm")),
+        ]
+    else:
+        ct_directory = os.path.join(directory, f"patient_{patient:03d}", f"fraction_{fraction:03d}", "CT")
+        written = [
+            _save(make_cbct_slice(spec, patient, fraction, index), os.path.join(ct_directory, f"CT_{index:04d}.dcm"))
+            for index in range(first, last)
+        ]
+    return len(written), sum(written)
+
+
+def _tasks(directory: str, spec: CorpusSpec) -> List[tuple]:
+    tasks = []
+    for patient in range(spec.patients):
+        os.makedirs(os.path.join(directory, f"patient_{patient:03d}", "plan"), exist_ok=True)
+        tasks.append(("plan", spec, directory, patient, None, 0, 0))
+        for fraction in range(spec.fractions):
+            os.makedirs(os.path.join(directory, f"patient_{patient:03d}", f"fraction_{fraction:03d}", "CT"), exist_ok=True)
+            tasks.append(("fraction", spec, directory, patient, fraction, 0, 0))
+            for first in range(0, spec.slices, SLICES_PER_TASK):
+                tasks.append(("cbct", spec, directory, patient, fraction, first, min(first + SLICES_PER_TASK, spec.slices)))
+    return tasks
+
+
+def generate_corpus(directory: str, spec: CorpusSpec = CorpusSpec(), workers: int | None = None) -> Dict[str, int]:
+    """Write a synthetic corpus
+
+    Args:
+        directory (str): where to write it (created if needed)
+        spec (CorpusSpec): how many of everything, and the seed
+        workers (int | None): writer processes, None for os.cpu_count(), 1 writes in this process
+
+    Returns:
+        Dict[str, int]: the number of "files" and "bytes" written
+    """
+    tasks = _tasks(directory, spec)
+    if workers == 1:
+        results = [_write_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_write_task, tasks))
+    return {"files": sum(files for files, _ in results), "bytes": sum(size for _, size in results)}
+
+
+if __name__ == "__main__":
+    defaults = CorpusSpec()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output_directory")
+    parser.add_argument("--patients", type=int, default=defaults.patients)
+    parser.add_argument("--fractions", type=int, default=defaults.fractions)
+    parser.add_argument("--slices", type=int, default=defaults.slices)
+    parser.add_argument("--rows", type=int, default=defaults.rows)
+    parser.add_argument("--columns", type=int, default=defaults.columns)
+    parser.add_argument("--beams", type=int, default=defaults.beams)
+    parser.add_argument("--spots", type=int, default=defaults.spots, help="per beam")
+    parser.add_argument("--contour-points", type=int, default=defaults.contour_points)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    corpus_spec = CorpusSpec(
+        patients=args.patients,
+        fractions=args.fractions,
+        slices=args.slices,
+        rows=args.rows,
+        columns=args.columns,
+        beams=args.beams,
+        spots=args.spots,
+        contour_points=args.contour_points,
+        seed=args.seed,
+    )
+    print(generate_corpus(args.output_directory, corpus_spec, args.workers))
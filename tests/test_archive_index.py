@@ -0,0 +1,90 @@
+import logging
+import os
+
+import pytest
+
+from archive_index import ArchiveIndex
+from uid_index import KIND_RTSS, KIND_SRO
+
+
+@pytest.fixture
+def archive(tmp_path, create_mock_export_set):
+    """An archive tree with the mock export set in nested folders, and a file that is not DICOM"""
+    reg_ds, rtss_ds, plan_ds = create_mock_export_set
+    for folder, name, ds in (("reg", "sro.dcm", reg_ds), ("rt/cbct", "rtss", rtss_ds), ("rt", "plan.dcm", plan_ds)):
+        os.makedirs(tmp_path / "archive" / folder, exist_ok=True)
+        ds.save_as(str(tmp_path / "archive" / folder / name), implicit_vr=True, little_endian=True)
+    (tmp_path / "archive" / "README.txt").write_text("not DICOM")
+    return tmp_path / "archive"
+
+
+class TestArchiveIndex:
+    def test_update_and_queries(self, tmp_path, archive):
+        with ArchiveIndex(str(tmp_path / "index.sqlite")) as index:
+            assert index.update(str(archive), workers=1) == {"read": 4, "unchanged": 0, "removed": 0}
+
+            sros = index.sros_for_plan("1.2.3.4.5.6.7.8.9.4")
+            assert [sro.path for sro in sros] == [str(archive / "reg" / "sro.dcm")]
+            assert sros[0].frames_of_reference == ("1.2.3.4.5.6.7.8.9.2", "1.2.3.4.5.6.7.8.9.5")
+            rtss = index.on_frame_of_reference("1.2.3.4.5.6.7.8.9.2", KIND_RTSS)
+            assert [summary.sop_instance_uid for summary in rtss] == ["1.2.3.4.5.6.7.8.9.3"]
+            assert [plan.sop_instance_uid for plan in index.referencing("1.2.3.4.5.6.7.8.9.7")] == ["1.2.3.4.5.6.7.8.9.4"]
+
+    def test_update_is_incremental_and_persistent(self, tmp_path, archive, create_mock_registration_dataset):
+        """Test that a reopened index only reads new files and forgets removed ones."""
+        with ArchiveIndex(str(tmp_path / "index.sqlite")) as index:
+            index.update(str(archive), workers=1)
+
+        create_mock_registration_dataset.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.10"
+        create_mock_registration_dataset.save_as(str(archive / "reg" / "sro2.dcm"), implicit_vr=True, little_endian=True)
+        os.remove(archive / "rt" / "cbct" / "rtss")
+
+        with ArchiveIndex(str(tmp_path / "index.sqlite")) as index:
+            assert index.update(str(archive), workers=1) == {"read": 1, "unchanged": 3, "removed": 1}
+            assert index.get("1.2.3.4.5.6.7.8.9.3") is None
+            assert len(index.on_frame_of_reference("1.2.3.4.5.6.7.8.9.5", KIND_SRO)) == 2
+
+    def test_removed_copy_keeps_object(self, tmp_path, archive):
+        """Test that removing one of two files of the same instance keeps the object, on the remaining file."""
+        copy_path = archive / "rt" / "cbct" / "rtss_copy"
+        copy_path.write_bytes((archive / "rt" / "cbct" / "rtss").read_bytes())
+        with ArchiveIndex(":memory:") as index:
+            index.update(str(archive), workers=1)
+            removed_path = index.get("1.2.3.4.5.6.7.8.9.3").path
+            remaining_path = ({str(archive / "rt" / "cbct" / "rtss"), str(copy_path)} - {removed_path}).pop()
+            index.remove_files([removed_path])
+
+            assert index.get("1.2.3.4.5.6.7.8.9.3").path == remaining_path
+            assert len(index.on_frame_of_reference("1.2.3.4.5.6.7.8.9.2", KIND_RTSS)) == 1
+
+            index.remove_files([str(archive / "rt" / "cbct" / "rtss"), str(copy_path)])
+            assert index.get("1.2.3.4.5.6.7.8.9.3") is None
+            assert index.on_frame_of_reference("1.2.3.4.5.6.7.8.9.2", KIND_RTSS) == []
+
+    def test_update_skips_unreadable_subdirectory(self, archive, monkeypatch, caplog):
+        """Test that a subdirectory that cannot be listed is skipped with a warning instead of failing the update."""
+        unreadable = archive / "rt" / "cbct"
+        scandir = os.scandir
+
+        def failing_scandir(path):
+            if str(path) == str(unreadable):
+                raise PermissionError(13, "Permission denied", str(path))
+            return scandir(path)
+
+        monkeypatch.setattr(os, "scandir", failing_scandir)
+        with ArchiveIndex(":memory:") as index, caplog.at_level(logging.WARNING):
+            assert index.update(str(archive), workers=1) == {"read": 3, "unchanged": 0, "removed": 0}
+
+            assert index.get("1.2.3.4.5.6.7.8.9.3") is None
+            assert index.get("1.2.3.4.5.6.7.8.9.6").kind == KIND_SRO
+        assert str(unreadable) in caplog.text
+
+    def test_update_in_parallel(self, tmp_path, archive):
+        with ArchiveIndex(":memory:") as index:
+            index.update(str(archive), workers=2, chunk_size=1)
+            assert index.get("1.2.3.4.5.6.7.8.9.6").kind == KIND_SRO
+
+    def test_sros_for_unknown_plan(self):
+        with ArchiveIndex(":memory:") as index:
+            with pytest.raises(ValueError, match="No plan 1.2.3 in the index"):
+                index.sros_for_plan("1.2.3")
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from auto_watch import DirectoryWatcher
+from compute_6dof_from_reg_rtss_plan import compute_6dof_from_reg_rtss_plan
+
+TEST_TOLERANCE = 0.006  # the mock registration matrix is only roughly orthonormal
+
+
+def save(ds, path, mtime_ns):
+    ds.save_as(path, implicit_vr=True, little_endian=True)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def identity_registration_item(frame_of_reference_uid):
+    matrix_item = Dataset()
+    matrix_item.FrameOfReferenceTransformationMatrix = [float(value) for value in np.identity(4).ravel()]
+    matrix_registration_item = Dataset()
+    matrix_registration_item.MatrixSequence = Sequence([matrix_item])
+    registration_item = Dataset()
+    registration_item.FrameOfReferenceUID = frame_of_reference_uid
+    registration_item.MatrixRegistrationSequence = Sequence([matrix_registration_item])
+    return registration_item
+
+
+class TestDirectoryWatcher:
+    def test_calculates_when_set_completes(self, tmp_path, create_mock_export_set):
+        """Test that the SRO is calculated in the poll that brings its last missing object, and only once."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        expected_ypr, expected_translation = compute_6dof_from_reg_rtss_plan(
+            reg_ds, rtss_ds, plan_ds, tolerance_ortho_normality=TEST_TOLERANCE
+        )
+        results = []
+        watcher = DirectoryWatcher(
+            str(tmp_path),
+            on_result=lambda sro, rtss, plan, ypr, translation: results.append((sro, rtss, plan, ypr, translation)),
+            tolerance_ortho_normality=TEST_TOLERANCE,
+        )
+        save(plan_ds, str(tmp_path / "plan.dcm"), 1)
+        (tmp_path / "notes.txt").write_text("not DICOM")
+        save(reg_ds, str(tmp_path / "sro"), 2)
+        assert watcher.poll_once() == []
+
+        save(rtss_ds, str(tmp_path / "rtss.dcm"), 3)
+        calculated = watcher.poll_once()
+
+        assert [sro.path for sro in calculated] == [str(tmp_path / "sro")]
+        sro, rtss, plan, ypr, translation = results[0]
+        assert rtss.path == str(tmp_path / "rtss.dcm")
+        assert plan.path == str(tmp_path / "plan.dcm")
+        assert np.allclose(ypr, expected_ypr)
+        assert np.allclose(translation, expected_translation)
+        assert watcher.poll_once() == []
+        assert len(results) == 1
+
+    def test_unchanged_files_are_not_read_again(self, tmp_path, monkeypatch, create_mock_export_set):
+        reg_ds, _, plan_ds = create_mock_export_set
+        save(plan_ds, str(tmp_path / "plan.dcm"), 1)
+        save(reg_ds, str(tmp_path / "sro.dcm"), 2)
+        watcher = DirectoryWatcher(str(tmp_path))
+        read = []
+        add_file = watcher.add_file
+        monkeypatch.setattr(watcher, "add_file", lambda path: read.append(path) or add_file(path))
+
+        watcher.poll_once()
+        watcher.poll_once()
+        save(plan_ds, str(tmp_path / "plan.dcm"), 3)
+        watcher.poll_once()
+
+        assert read == [str(tmp_path / "plan.dcm"), str(tmp_path / "sro.dcm"), str(tmp_path / "plan.dcm")]
+
+    def test_calculates_with_registration_of_rtss_frame_of_reference(self, tmp_path, create_mock_export_set):
+        """Test that the identity registration of the plan's Frame of Reference, listed first, is not used."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        expected_ypr, expected_translation = compute_6dof_from_reg_rtss_plan(
+            reg_ds, rtss_ds, plan_ds, tolerance_ortho_normality=TEST_TOLERANCE
+        )
+        del reg_ds.RegistrationSequence[1]
+        reg_ds.RegistrationSequence.insert(0, identity_registration_item(plan_ds.FrameOfReferenceUID))
+        results = []
+        watcher = DirectoryWatcher(
+            str(tmp_path),
+            on_result=lambda sro, rtss, plan, ypr, translation: results.append((ypr, translation)),
+            tolerance_ortho_normality=TEST_TOLERANCE,
+        )
+        save(plan_ds, str(tmp_path / "plan.dcm"), 1)
+        save(rtss_ds, str(tmp_path / "rtss.dcm"), 2)
+        save(reg_ds, str(tmp_path / "sro.dcm"), 3)
+
+        assert len(watcher.poll_once()) == 1
+        ypr, translation = results[0]
+        assert np.allclose(ypr, expected_ypr)
+        assert np.allclose(translation, expected_translation)
+
+    def test_datasets_are_bounded(self, tmp_path, create_mock_export_set):
+        """Test that at most max_datasets datasets are kept and evicted ones are read again from their file."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        results = []
+        watcher = DirectoryWatcher(
+            str(tmp_path),
+            on_result=lambda sro, rtss, plan, ypr, translation: results.append(sro),
+            tolerance_ortho_normality=TEST_TOLERANCE,
+            max_datasets=1,
+        )
+        save(plan_ds, str(tmp_path / "plan.dcm"), 1)
+        save(rtss_ds, str(tmp_path / "rtss.dcm"), 2)
+        for index in range(3):
+            reg_ds.SOPInstanceUID = f"1.2.3.4.5.6.7.8.9.6.{index}"
+            save(reg_ds, str(tmp_path / f"sro{index}.dcm"), 3 + index)
+
+        assert len(watcher.poll_once()) == 3
+        assert [sro.sop_instance_uid for sro in results] == [f"1.2.3.4.5.6.7.8.9.6.{index}" for index in range(3)]
+        assert len(watcher._datasets) <= 1
+
+    def test_failed_sro_is_reported_once(self, tmp_path, create_mock_export_set):
+        """Test that an SRO whose calculation fails is dropped, not reported again when more objects arrive."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        errors = []
+        # the default orthonormality tolerance rejects the mock registration matrix
+        watcher = DirectoryWatcher(str(tmp_path), on_error=lambda sro, error: errors.append((sro, error)))
+        save(plan_ds, str(tmp_path / "plan.dcm"), 1)
+        save(rtss_ds, str(tmp_path / "rtss.dcm"), 2)
+        save(reg_ds, str(tmp_path / "sro.dcm"), 3)
+        assert watcher.poll_once() == []
+        assert len(errors) == 1
+        assert isinstance(errors[0][1], ValueError)
+
+        save(rtss_ds, str(tmp_path / "rtss.dcm"), 4)
+        save(plan_ds, str(tmp_path / "plan.dcm"), 5)
+        assert watcher.poll_once() == []
+
+        assert len(errors) == 1
+        assert watcher._pending_sros == {}
@@ -1,12 +1,29 @@
+import threading
+
 import pytest
 import numpy as np
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 
+from convert_matrix_to_euler import euler_angles_to_rotation_matrix_ordered
+
 from compute_6dof_from_reg_rtss_plan import (
     compute_6dof_from_reg_rtss_plan,
+    compute_6dof_from_components,
+    compute_6dof_from_components_batch,
+    compute_6dof_for_all_registrations,
+    compute_6dof_for_all_isocenters,
+    compute_6dof_per_beam,
+    express_at_patient_support_angles,
+    patient_support_rotation_matrices,
     convert_dicom_patient_ypr_to_iec_ypr,
-    convert_dicom_patient_to_iec
+    convert_dicom_patient_ypr_to_iec_ypr_batch,
+    convert_dicom_patient_to_iec,
+    convert_dicom_patient_to_iec_batch,
+    do_calculate,
+    CalculationCancelled,
+    CALCULATION_STAGES,
+    PATIENT_POSITION_CODES,
 )
 
 
@@ -151,6 +168,51 @@ class TestCompute6DOF:
         assert iec_translation_hfp[1] == dicom_translation[2]     # Y = Z(DICOM)
         assert iec_translation_hfp[2] == dicom_translation[1]     # Z = Y(DICOM)
 
+    def test_convert_dicom_patient_to_iec_decubitus(self):
+        """Test conversion of DICOM Patient translation to IEC coordinates for decubitus positions."""
+        dicom_translation = np.array([10.0, 20.0, 30.0])
+
+        # Lying on the right side, head towards the gantry: patient left is up
+        assert np.array_equal(convert_dicom_patient_to_iec(dicom_translation, "HFDR"), [20.0, 30.0, 10.0])
+        assert np.array_equal(convert_dicom_patient_to_iec(dicom_translation, "HFDL"), [-20.0, 30.0, -10.0])
+        assert np.array_equal(convert_dicom_patient_to_iec(dicom_translation, "FFDR"), [-20.0, -30.0, 10.0])
+        assert np.array_equal(convert_dicom_patient_to_iec(dicom_translation, "FFDL"), [20.0, -30.0, -10.0])
+
+    def test_convert_unsupported_patient_position(self):
+        """Test that an unknown Patient Position is rejected."""
+        with pytest.raises(ValueError, match="patient position XYZ not supported yet"):
+            convert_dicom_patient_to_iec(np.zeros(3), "XYZ")
+        with pytest.raises(ValueError, match="patient position XYZ not supported yet"):
+            convert_dicom_patient_ypr_to_iec_ypr_batch(np.zeros((2, 3)), ["HFS", "XYZ"])
+
+    def test_convert_batch_with_mixed_positions(self):
+        """Test that the batch conversions match the single conversions row by row."""
+        rng = np.random.default_rng(26)
+        vectors = rng.normal(size=(len(PATIENT_POSITION_CODES), 3))
+        positions = list(PATIENT_POSITION_CODES)
+
+        iec_translations = convert_dicom_patient_to_iec_batch(vectors, positions)
+        iec_ypr = convert_dicom_patient_ypr_to_iec_ypr_batch(vectors, positions)
+        for row, position in enumerate(positions):
+            assert np.allclose(iec_translations[row], convert_dicom_patient_to_iec(vectors[row], position))
+            assert np.allclose(iec_ypr[row], convert_dicom_patient_ypr_to_iec_ypr(vectors[row], position))
+
+        # a single position applies to every row
+        assert np.allclose(convert_dicom_patient_to_iec_batch(vectors, "HFS"), vectors[:, [0, 2, 1]] * [1, 1, -1])
+
+    @pytest.mark.parametrize("patient_position", [code for code in PATIENT_POSITION_CODES if code != "FFP"])
+    def test_ypr_table_consistent_with_translation_table(self, patient_position):
+        """The YPR conversion is the rotation (axial vector) counterpart of the translation conversion."""
+        to_iec = np.array([convert_dicom_patient_to_iec(axis, patient_position) for axis in np.identity(3)]).T
+        hfs_to_iec = np.array([convert_dicom_patient_to_iec(axis, "HFS") for axis in np.identity(3)]).T
+        hfs_iec_to_position_iec = to_iec @ hfs_to_iec.T
+        assert np.isclose(np.linalg.det(hfs_iec_to_position_iec), 1.0)
+
+        iec_axis_of_ypr = [2, 0, 1]  # Yaw is about Z, Pitch about X, Roll about Y
+        expected = hfs_iec_to_position_iec[np.ix_(iec_axis_of_ypr, iec_axis_of_ypr)]
+        actual = np.array([convert_dicom_patient_ypr_to_iec_ypr(axis, patient_position) for axis in np.identity(3)]).T
+        assert np.array_equal(actual, expected)
+
     def test_compute_6dof_from_reg_rtss_plan(self, mock_reg_ds, mock_rtss_ds, mock_plan_ds):
         """Test computation of 6DOF transformation from registration, RTSS, and plan."""
         # Compute 6DOF transformation
@@ -166,3 +228,193 @@ class TestCompute6DOF:
         assert isinstance(trans, np.ndarray)
         assert rot.shape == (3,)
         assert trans.shape == (3,)
+
+    def test_compute_6dof_from_components_does_not_print(self, capsys):
+        """Test that the calculation from extracted values matches the DICOM one and prints nothing."""
+        four_by_four = np.identity(4)
+        four_by_four[0:3, 3] = [10.0, -5.0, 2.5]
+        ypr, translation = compute_6dof_from_components(four_by_four, [100.0, 200.0, 300.0], [105.0, 195.0, 305.0], "HFS")
+        assert capsys.readouterr().out == ""
+        assert np.allclose(ypr, 0.0)
+        assert np.allclose(translation, [5.0, -2.5, 0.0])
+
+    def test_compute_6dof_from_components_batch(self):
+        """Test that the batch calculation matches the single calculation for mixed positions and broadcasting."""
+        rng = np.random.default_rng(31)
+        count = len(PATIENT_POSITION_CODES)
+        four_by_fours = np.tile(np.identity(4), (count, 1, 1))
+        angles = rng.normal(0.0, 0.05, (count, 3))
+        for row, (x, y, z) in enumerate(angles):
+            rot_x = np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+            rot_z = np.array([[np.cos(z), -np.sin(z), 0], [np.sin(z), np.cos(z), 0], [0, 0, 1]])
+            four_by_fours[row, 0:3, 0:3] = rot_z @ rot_x
+        four_by_fours[:, 0:3, 3] = rng.normal(0.0, 10.0, (count, 3))
+        setup_isos = rng.normal(0.0, 100.0, (count, 3))
+        plan_isos = rng.normal(0.0, 100.0, (count, 3))
+        positions = list(PATIENT_POSITION_CODES)
+
+        ypr, translation = compute_6dof_from_components_batch(four_by_fours, setup_isos, plan_isos, positions)
+        for row, position in enumerate(positions):
+            expected_ypr, expected_translation = compute_6dof_from_components(
+                four_by_fours[row], setup_isos[row], plan_isos[row], position
+            )
+            assert np.allclose(ypr[row], expected_ypr)
+            assert np.allclose(translation[row], expected_translation)
+
+        # one registration and setup isocenter against many plan isocenters
+        ypr, translation = compute_6dof_from_components_batch(four_by_fours[0], setup_isos[0], plan_isos, "FFP")
+        assert ypr.shape == translation.shape == (count, 3)
+        for row in range(count):
+            expected_ypr, expected_translation = compute_6dof_from_components(
+                four_by_fours[0], setup_isos[0], plan_isos[row], "FFP"
+            )
+            assert np.allclose(ypr[row], expected_ypr)
+            assert np.allclose(translation[row], expected_translation)
+
+    def test_compute_6dof_for_all_registrations(self, mock_reg_ds, mock_rtss_ds, mock_plan_ds):
+        """Test that every registration of a multi registration SRO is evaluated in one call."""
+        identity_matrix_item = Dataset()
+        identity_matrix_item.FrameOfReferenceTransformationMatrix = [float(v) for v in np.identity(4).ravel()]
+        identity_matrix_reg_item = Dataset()
+        identity_matrix_reg_item.MatrixSequence = Sequence([identity_matrix_item])
+        identity_item = Dataset()
+        identity_item.FrameOfReferenceUID = "1.2.3.1"
+        identity_item.MatrixRegistrationSequence = Sequence([identity_matrix_reg_item])
+        mock_reg_ds.RegistrationSequence[0].FrameOfReferenceUID = "1.2.3.2"
+        mock_reg_ds.RegistrationSequence.insert(0, identity_item)
+
+        index_of_frame_of_reference, ypr, trans = compute_6dof_for_all_registrations(
+            mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006
+        )
+
+        assert ypr.shape == trans.shape == (2, 3)
+        assert np.allclose(ypr[index_of_frame_of_reference["1.2.3.1"]], 0.0)
+        mock_plan_ds.FrameOfReferenceUID = "1.2.3.1"
+        expected_rot, expected_trans = compute_6dof_from_reg_rtss_plan(
+            mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006
+        )
+        # compute_6dof_from_reg_rtss_plan skips the identity registration of the plan's Frame of Reference
+        assert np.allclose(trans[index_of_frame_of_reference["1.2.3.2"]], expected_trans)
+        assert np.allclose(ypr[index_of_frame_of_reference["1.2.3.2"]], expected_rot)
+
+    def test_compute_6dof_selects_registration_of_rtss_frame_of_reference(self, mock_reg_ds, mock_rtss_ds, mock_plan_ds):
+        """Test that the registration of the RTSS's Frame of Reference is used when it is not the first item."""
+        expected_rot, expected_trans = compute_6dof_from_reg_rtss_plan(
+            mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006
+        )
+        identity_matrix_item = Dataset()
+        identity_matrix_item.FrameOfReferenceTransformationMatrix = [float(v) for v in np.identity(4).ravel()]
+        identity_matrix_reg_item = Dataset()
+        identity_matrix_reg_item.MatrixSequence = Sequence([identity_matrix_item])
+        identity_item = Dataset()
+        identity_item.FrameOfReferenceUID = "1.2.3.1"
+        identity_item.MatrixRegistrationSequence = Sequence([identity_matrix_reg_item])
+        mock_reg_ds.RegistrationSequence[0].FrameOfReferenceUID = "1.2.3.2"
+        mock_reg_ds.RegistrationSequence.insert(0, identity_item)
+        frame_item = Dataset()
+        frame_item.FrameOfReferenceUID = "1.2.3.2"
+        mock_rtss_ds.ReferencedFrameOfReferenceSequence = Sequence([frame_item])
+
+        rot, trans = compute_6dof_from_reg_rtss_plan(mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006)
+        table = compute_6dof_for_all_isocenters(mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006)
+
+        assert np.allclose(rot, expected_rot)
+        assert np.allclose(trans, expected_trans)
+        assert np.allclose(table["ypr_degrees"][0], expected_rot)
+        assert np.allclose(table["translation_iec_mm"][0], expected_trans)
+
+    def test_compute_6dof_for_all_isocenters(self, mock_reg_ds, mock_rtss_ds, mock_plan_ds):
+        """Test the correction table for a multi isocenter plan."""
+        second_beam = Dataset()
+        second_beam.BeamNumber = 2
+        control_point_item = Dataset()
+        control_point_item.IsocenterPosition = ["105.0", "195.0", "505.0"]
+        control_point_item.PatientSupportAngle = 0.0
+        second_beam.IonControlPointSequence = Sequence([control_point_item])
+        mock_plan_ds.IonBeamSequence.append(second_beam)
+
+        table = compute_6dof_for_all_isocenters(mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006)
+
+        assert table["isocenter"].shape == (2, 3)
+        assert table["translation_iec_mm"].shape == table["ypr_degrees"].shape == (2, 3)
+        expected_rot, expected_trans = compute_6dof_from_reg_rtss_plan(
+            mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006
+        )
+        assert np.allclose(table["translation_iec_mm"][0], expected_trans)
+        assert np.allclose(table["ypr_degrees"], expected_rot)
+        # same rotation, the isocenters differ by 200 mm along the DICOM Patient z axis
+        assert not np.allclose(table["translation_iec_mm"][1], expected_trans)
+
+    def test_express_at_patient_support_angles(self):
+        """Test that a couch rotation of 90 degrees turns Lateral into Longitudinal and Pitch into Roll."""
+        ypr = np.array([[0.0, 2.0, 0.0], [0.0, 0.0, 3.0], [1.0, 2.0, 3.0]])
+        translation = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 5.0], [1.0, 2.0, 3.0]])
+
+        ypr_fixed, translation_fixed = express_at_patient_support_angles(ypr, translation, [90.0, 90.0, 0.0])
+
+        assert np.allclose(translation_fixed, [[0.0, 1.0, 0.0], [-1.0, 0.0, 5.0], [1.0, 2.0, 3.0]])
+        assert np.allclose(ypr_fixed, [[0.0, 0.0, 2.0], [0.0, -3.0, 0.0], [1.0, 2.0, 3.0]])
+
+    def test_express_mixed_rotation_at_patient_support_angles(self):
+        """A registration rotating about all three axes is the conjugate P R P^T at a nonzero couch angle."""
+        four_by_four = np.identity(4)
+        # 3, -4, 5 degrees about DICOM Patient x, y, z: Yaw 4, Pitch 3, Roll 5 for HFS
+        four_by_four[0:3, 0:3] = euler_angles_to_rotation_matrix_ordered(np.radians([3.0, -4.0, 5.0]), "xyz")
+        ypr, translation = compute_6dof_from_components(four_by_four, np.zeros(3), np.zeros(3), "HFS")
+        assert np.allclose(ypr, [4.0, 3.0, 5.0])
+        # the same rotation in IEC 61217 Table Top axes (x lateral, y longitudinal, z vertical)
+        dicom_to_iec = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]])
+        rotation_iec = dicom_to_iec @ four_by_four[0:3, 0:3] @ dicom_to_iec.T
+
+        for couch_angle, expected in [(90.0, [3.717, -5.213, 3.344]), (30.0, [3.869, -0.007, 6.006])]:
+            ypr_fixed, _ = express_at_patient_support_angles([ypr], [translation], [couch_angle])
+
+            assert np.allclose(ypr_fixed[0], expected, atol=1e-3)
+            support = patient_support_rotation_matrices([couch_angle])[0]
+            pitch, yaw, roll = np.radians(ypr_fixed[0][[1, 0, 2]])
+            recomposed = euler_angles_to_rotation_matrix_ordered(np.array([pitch, yaw, roll]), "xzy")
+            assert np.allclose(recomposed, support @ rotation_iec @ support.T)
+
+    def test_compute_6dof_per_beam(self, mock_reg_ds, mock_rtss_ds, mock_plan_ds):
+        """Test the per beam table for a plan with non coplanar beams."""
+        for beam_number, couch_angle in [(3, 0.0), (2, 270.0)]:
+            beam = Dataset()
+            beam.BeamNumber = beam_number
+            control_point_item = Dataset()
+            control_point_item.IsocenterPosition = ["105.0", "195.0", "305.0"]
+            control_point_item.PatientSupportAngle = couch_angle
+            beam.IonControlPointSequence = Sequence([control_point_item])
+            mock_plan_ds.IonBeamSequence.append(beam)
+        mock_plan_ds.IonBeamSequence[0].BeamNumber = 1
+
+        table = compute_6dof_per_beam(mock_reg_ds, mock_rtss_ds, mock_plan_ds, tolerance_ortho_normality=0.006)
+
+        assert np.array_equal(table["beam_number"], [1, 2, 3])
+        assert np.array_equal(table["patient_support_angle"], [0.0, 270.0, 0.0])
+        # the Table Top correction does not depend on the couch angle
+        assert np.allclose(table["translation_iec_mm"], table["translation_iec_mm"][0])
+        assert np.allclose(table["translation_iec_mm_at_couch_angle"][[0, 2]], table["translation_iec_mm"][[0, 2]])
+        lateral, longitudinal, vertical = table["translation_iec_mm"][1]
+        assert np.allclose(table["translation_iec_mm_at_couch_angle"][1], [longitudinal, -lateral, vertical])
+        # yaw is about the axis of the couch rotation, it only changes through the (small) pitch and roll
+        assert np.isclose(table["ypr_degrees_at_couch_angle"][1][0], table["ypr_degrees"][1][0], atol=0.05)
+
+    def test_do_calculate_reports_progress(self, dicom_paths):
+        stages = []
+        do_calculate(*dicom_paths, reorthonormalization_tolerance=0.01, progress=stages.append)
+
+        assert tuple(stages) == CALCULATION_STAGES
+
+    def test_do_calculate_cancelled(self, dicom_paths):
+        """Test that setting the cancel event stops the calculation before the next stage."""
+        cancel_event = threading.Event()
+        stages = []
+
+        def progress(stage):
+            stages.append(stage)
+            if stage == CALCULATION_STAGES[1]:
+                cancel_event.set()
+
+        with pytest.raises(CalculationCancelled, match="before Reading RT Ion Plan"):
+            do_calculate(*dicom_paths, progress=progress, cancel_event=cancel_event)
+        assert stages == list(CALCULATION_STAGES[0:2])
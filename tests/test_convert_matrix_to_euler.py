@@ -4,10 +4,23 @@ import numpy as np
 
 from convert_matrix_to_euler import (
     is_rotation_matrix,
+    nearest_rotation_matrix,
+    orthonormality_error,
     rotation_matrix_to_euler_angles,
-    euler_angles_to_rotation_matrix
+    rotation_matrix_to_euler_angles_ordered,
+    euler_angles_to_rotation_matrix,
+    euler_angles_to_rotation_matrix_batch,
+    euler_angles_to_rotation_matrix_ordered,
+    EULER_ORDERS,
 )
 
+# registration rotation that has drifted from orthonormal (difference from identity ~0.0058)
+DRIFTED_MATRIX = np.array([
+    [0.999, 0.012, 0.008],
+    [-0.010, 0.998, 0.015],
+    [-0.009, -0.014, 0.999],
+])
+
 
 class TestConvertMatrixToEuler:
     def test_is_rotation_matrix_with_valid_matrix(self):
@@ -82,4 +95,106 @@ class TestConvertMatrixToEuler:
             recovered_angles = rotation_matrix_to_euler_angles(matrix)
 
             # Check that angles are recovered
-            assert np.allclose(random_angles, recovered_angles, atol=1e-4)
\ No newline at end of file
+            assert np.allclose(random_angles, recovered_angles, atol=1e-4)
+
+    def test_orthonormality_error_matches_matrix_computation(self):
+        expected = np.linalg.norm(np.identity(3) - DRIFTED_MATRIX.T @ DRIFTED_MATRIX)
+        assert math.isclose(orthonormality_error(DRIFTED_MATRIX), expected, rel_tol=1e-9)
+        assert orthonormality_error(np.identity(3)) == 0.0
+
+    def test_nearest_rotation_matrix(self):
+        rotation, correction = nearest_rotation_matrix(DRIFTED_MATRIX)
+
+        assert orthonormality_error(rotation) < 1e-12
+        assert np.isclose(np.linalg.det(rotation), 1.0)
+        assert math.isclose(correction, np.linalg.norm(rotation - DRIFTED_MATRIX))
+        assert 0.0 < correction < 0.01
+
+    def test_nearest_rotation_matrix_rejects_singular(self):
+        with pytest.raises(ValueError, match="Singular matrix"):
+            nearest_rotation_matrix(np.diag([1.0, 1.0, 0.0]))
+        with pytest.raises(ValueError, match="Singular matrix"):
+            nearest_rotation_matrix(np.array([np.identity(3), np.zeros((3, 3))]))
+
+    def test_nearest_rotation_matrix_stack(self):
+        stack = np.array([DRIFTED_MATRIX, np.identity(3)])
+        rotations, corrections = nearest_rotation_matrix(stack)
+
+        assert rotations.shape == (2, 3, 3)
+        assert np.allclose(rotations[1], np.identity(3))
+        assert corrections[1] == pytest.approx(0.0)
+
+    def test_rotation_matrix_to_euler_angles_rejects_drift(self):
+        with pytest.raises(ValueError, match="Matrix is not a rotation matrix"):
+            rotation_matrix_to_euler_angles(DRIFTED_MATRIX)
+
+        # re-orthonormalization bound that is still too tight
+        with pytest.raises(ValueError, match="Matrix is not a rotation matrix"):
+            rotation_matrix_to_euler_angles(DRIFTED_MATRIX, reorthonormalization_tolerance=1e-5)
+
+    def test_rotation_matrix_to_euler_angles_reorthonormalizes(self, caplog):
+        euler_angles = rotation_matrix_to_euler_angles(DRIFTED_MATRIX, reorthonormalization_tolerance=0.01)
+
+        rotation, correction = nearest_rotation_matrix(DRIFTED_MATRIX)
+        assert np.allclose(euler_angles_to_rotation_matrix(euler_angles), rotation)
+        (record,) = caplog.records
+        assert "Re-orthonormalized rotation matrix" in record.getMessage()
+        assert record.reorthonormalization_correction == pytest.approx(correction)
+        assert record.orthonormality_error == pytest.approx(orthonormality_error(DRIFTED_MATRIX))
+
+    def test_ordered_xyz_matches_rotation_matrix_to_euler_angles(self):
+        matrix = np.array([
+            [0.998984, 0.032327, 0.031397],
+            [-0.031397, 0.999067, -0.029666],
+            [-0.032327, 0.02865, 0.999067],
+        ])
+        assert np.allclose(rotation_matrix_to_euler_angles_ordered(matrix, "xyz"), rotation_matrix_to_euler_angles(matrix))
+
+        angles = np.array([0.073, 0.080, 0.002])
+        assert np.allclose(euler_angles_to_rotation_matrix_ordered(angles, "xyz"), euler_angles_to_rotation_matrix(angles))
+
+    @pytest.mark.parametrize("order", EULER_ORDERS)
+    def test_ordered_round_trip_stack(self, order):
+        rng = np.random.default_rng(29)
+        angles = rng.uniform(-math.pi, math.pi, (200, 3))
+        if order[0] == order[2]:
+            angles[:, 1] = rng.uniform(0.01, math.pi - 0.01, 200)  # proper Euler: middle angle in [0, pi]
+        else:
+            angles[:, 1] = rng.uniform(-math.pi / 2 + 0.01, math.pi / 2 - 0.01, 200)  # Tait-Bryan: [-pi/2, pi/2]
+
+        matrices = euler_angles_to_rotation_matrix_ordered(angles, order)
+        assert matrices.shape == (200, 3, 3)
+        recovered = rotation_matrix_to_euler_angles_ordered(matrices, order)
+        assert np.allclose(recovered, angles, atol=1e-9)
+
+        # single matrices take the same path
+        assert np.allclose(rotation_matrix_to_euler_angles_ordered(matrices[0], order), angles[0], atol=1e-9)
+
+    @pytest.mark.parametrize("order", EULER_ORDERS)
+    def test_ordered_singular(self, order):
+        middle = 0.0 if order[0] == order[2] else math.pi / 2
+        matrix = euler_angles_to_rotation_matrix_ordered(np.array([0.3, middle, 0.2]), order)
+
+        angles = rotation_matrix_to_euler_angles_ordered(matrix, order)
+
+        assert angles[2] == 0.0
+        assert np.allclose(euler_angles_to_rotation_matrix_ordered(angles, order), matrix)
+
+    def test_ordered_invalid_input(self):
+        with pytest.raises(ValueError, match="Euler order xxy not supported"):
+            rotation_matrix_to_euler_angles_ordered(np.identity(3), "xxy")
+        with pytest.raises(ValueError, match="1 matrices are not rotation matrices"):
+            rotation_matrix_to_euler_angles_ordered(np.array([np.identity(3), DRIFTED_MATRIX]), "zyz")
+
+    def test_euler_angles_to_rotation_matrix_batch(self):
+        angles = np.random.default_rng(30).uniform(-math.pi, math.pi, (50, 3))
+
+        matrices = euler_angles_to_rotation_matrix_batch(angles)
+
+        assert matrices.shape == (50, 3, 3)
+        for row in range(len(angles)):
+            assert np.allclose(matrices[row], euler_angles_to_rotation_matrix(angles[row]), atol=1e-15)
+
+    def test_euler_angles_to_rotation_matrix_batch_rejects_single_triple(self):
+        with pytest.raises(ValueError, match="Expected \\(N,3\\) euler angles"):
+            euler_angles_to_rotation_matrix_batch(np.array([0.1, 0.2, 0.3]))
@@ -0,0 +1,167 @@
+import io
+
+import numpy as np
+import pytest
+
+import compute_6dof_from_reg_rtss_plan as c6
+from correction_api import (
+    PlanSummary,
+    compute_correction,
+    compute_corrections,
+    summarize_plan,
+    summarize_registration,
+    summarize_rtss,
+)
+from synthetic_corpus import (
+    CorpusSpec,
+    cbct_frame_of_reference_uid,
+    make_inroom_rtss,
+    make_ion_plan,
+    make_sro,
+    plan_frame_of_reference_uid,
+)
+
+SPEC = CorpusSpec(patients=1, fractions=3, slices=0, beams=3, spots=20, contour_points=20)
+
+
+def encoded(ds):
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def fraction():
+    return make_sro(SPEC, 0, 0), make_inroom_rtss(SPEC, 0, 0), make_ion_plan(SPEC, 0)
+
+
+class TestCorrectionApi:
+    def test_same_as_datasets(self, fraction, capsys):
+        expected = c6.compute_6dof_from_reg_rtss_plan(*fraction)
+        capsys.readouterr()
+        ypr, translation = compute_correction(*fraction)
+        assert capsys.readouterr().out == ""
+        np.testing.assert_allclose(ypr, expected[0], atol=1e-9)
+        np.testing.assert_allclose(translation, expected[1], atol=1e-9)
+
+    def test_any_mix_of_sources(self, fraction, create_temp_directory):
+        reg_ds, rtss_ds, plan_ds = fraction
+        expected = compute_correction(reg_ds, rtss_ds, plan_ds)
+        plan_path = create_temp_directory / "RP.dcm"
+        plan_path.write_bytes(encoded(plan_ds))
+        for registration, rtss, plan in [
+            (encoded(reg_ds), bytearray(encoded(rtss_ds)), memoryview(encoded(plan_ds))),
+            (io.BytesIO(encoded(reg_ds)), rtss_ds, plan_path),
+            (summarize_registration(reg_ds), summarize_rtss(encoded(rtss_ds)), str(plan_path)),
+        ]:
+            ypr, translation = compute_correction(registration, rtss, plan)
+            np.testing.assert_allclose(ypr, expected[0], atol=1e-9)
+            np.testing.assert_allclose(translation, expected[1], atol=1e-9)
+
+    def test_summaries(self, fraction):
+        reg_ds, rtss_ds, plan_ds = fraction
+        plan = summarize_plan(encoded(plan_ds))
+        assert summarize_plan(plan) is plan
+        assert plan.sop_instance_uid == plan_ds.SOPInstanceUID
+        assert plan.patient_position == "HFS"
+        np.testing.assert_allclose(plan.isocenter, plan_ds.IonBeamSequence[0].IonControlPointSequence[0].IsocenterPosition)
+        registration = summarize_registration(reg_ds)
+        assert registration.four_by_four.shape == (4, 4)
+        assert summarize_registration(registration) is registration
+        np.testing.assert_allclose(
+            summarize_rtss(rtss_ds).setup_isocenter, rtss_ds.ROIContourSequence[1].ContourSequence[0].ContourData
+        )
+
+    def test_registration_by_frame_of_reference(self, fraction):
+        reg_ds = fraction[0]
+        np.testing.assert_allclose(
+            summarize_registration(reg_ds, cbct_frame_of_reference_uid(SPEC, 0, 0)).four_by_four,
+            summarize_registration(reg_ds).four_by_four,
+        )
+        np.testing.assert_allclose(
+            summarize_registration(reg_ds, plan_frame_of_reference_uid(SPEC, 0)).four_by_four, np.identity(4)
+        )
+        with pytest.raises(ValueError):
+            summarize_registration(reg_ds, "1.2.3")
+
+    def test_registration_selected_by_rtss_and_plan_frames_of_reference(self, fraction):
+        """Test that with the plan's identity registration listed first the in room registration is still used."""
+        reg_ds, rtss_ds, plan_ds = fraction
+        expected = c6.compute_6dof_from_reg_rtss_plan(reg_ds, rtss_ds, plan_ds)
+        reg_ds.RegistrationSequence.reverse()
+        assert reg_ds.RegistrationSequence[0].FrameOfReferenceUID == plan_frame_of_reference_uid(SPEC, 0)
+
+        ypr, translation = compute_correction(reg_ds, rtss_ds, plan_ds)
+
+        np.testing.assert_allclose(ypr, expected[0], atol=1e-9)
+        np.testing.assert_allclose(translation, expected[1], atol=1e-9)
+        assert summarize_rtss(rtss_ds).frame_of_reference_uid == cbct_frame_of_reference_uid(SPEC, 0, 0)
+        assert summarize_plan(plan_ds).frame_of_reference_uid == plan_frame_of_reference_uid(SPEC, 0)
+
+    def test_setup_beam_number(self, fraction):
+        plan_ds = fraction[2]
+        plan_ds.IonBeamSequence[2].IonControlPointSequence[0].IsocenterPosition = [1.0, 2.0, 3.0]
+        plan_ds.IonBeamSequence[2].IonControlPointSequence[0].PatientSupportAngle = 90.0
+        plan = summarize_plan(plan_ds, beam_number=3)
+        np.testing.assert_allclose(plan.isocenter, [1.0, 2.0, 3.0])
+        assert plan.patient_support_angle == 90.0
+        with pytest.raises(ValueError):
+            summarize_plan(plan_ds, beam_number=9)
+
+    def test_frame_of_reference_and_beam_number(self, fraction):
+        """Test that the registration and the setup beam can be chosen by compute_correction."""
+        reg_ds, rtss_ds, plan_ds = fraction
+        plan_ds.IonBeamSequence[2].IonControlPointSequence[0].IsocenterPosition = [1.0, 2.0, 3.0]
+        plan_frame_of_reference = plan_frame_of_reference_uid(SPEC, 0)
+
+        ypr, translation = compute_correction(
+            reg_ds, rtss_ds, plan_ds, frame_of_reference_uid=plan_frame_of_reference, beam_number=3
+        )
+
+        expected = compute_correction(
+            summarize_registration(reg_ds, plan_frame_of_reference), rtss_ds, summarize_plan(plan_ds, beam_number=3)
+        )
+        np.testing.assert_allclose(ypr, expected[0], atol=1e-9)
+        np.testing.assert_allclose(translation, expected[1], atol=1e-9)
+        np.testing.assert_allclose(ypr, 0.0, atol=1e-9)  # the identity registration of the plan's Frame of Reference
+        assert not np.allclose(translation, compute_correction(reg_ds, rtss_ds, plan_ds)[1])
+
+    def test_at_patient_support_angle(self, fraction):
+        """Test that the correction is expressed at the setup beam's Patient Support Angle."""
+        reg_ds, rtss_ds, plan_ds = fraction
+        plan_ds.IonBeamSequence[2].IonControlPointSequence[0].PatientSupportAngle = 90.0
+        ypr, translation = compute_correction(reg_ds, rtss_ds, plan_ds, beam_number=3)
+
+        ypr_at_angle, translation_at_angle = compute_correction(
+            reg_ds, rtss_ds, plan_ds, beam_number=3, at_patient_support_angle=True
+        )
+
+        expected = c6.express_at_patient_support_angles(ypr[np.newaxis], translation[np.newaxis], [90.0])
+        np.testing.assert_allclose(ypr_at_angle, expected[0][0], atol=1e-9)
+        np.testing.assert_allclose(translation_at_angle, expected[1][0], atol=1e-9)
+        np.testing.assert_allclose(translation_at_angle, [-translation[1], translation[0], translation[2]], atol=1e-9)
+
+    def test_not_a_source(self):
+        with pytest.raises(TypeError):
+            summarize_rtss(42)
+
+    def test_batch(self):
+        plan = summarize_plan(make_ion_plan(SPEC, 0))
+        registrations = [make_sro(SPEC, 0, fraction) for fraction in range(SPEC.fractions)]
+        rtsss = [summarize_rtss(make_inroom_rtss(SPEC, 0, fraction)) for fraction in range(SPEC.fractions)]
+        ypr, translation = compute_corrections(registrations, rtsss, plan)
+        assert ypr.shape == translation.shape == (SPEC.fractions, 3)
+        for index in range(SPEC.fractions):
+            expected = compute_correction(registrations[index], rtsss[index], plan)
+            np.testing.assert_allclose(ypr[index], expected[0], atol=1e-9)
+            np.testing.assert_allclose(translation[index], expected[1], atol=1e-9)
+        with pytest.raises(ValueError):
+            compute_corrections(registrations, rtsss[:1], plan)
+
+    def test_prone(self, fraction):
+        reg_ds, rtss_ds, plan_ds = fraction
+        plan_ds.PatientSetupSequence[0].PatientPosition = "HFP"
+        expected = c6.compute_6dof_from_reg_rtss_plan(reg_ds, rtss_ds, plan_ds)
+        ypr, translation = compute_correction(reg_ds, rtss_ds, PlanSummary(*summarize_plan(plan_ds)))
+        np.testing.assert_allclose(ypr, expected[0], atol=1e-9)
+        np.testing.assert_allclose(translation, expected[1], atol=1e-9)
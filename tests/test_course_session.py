@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from compute_6dof_from_reg_rtss_plan import (
+    compute_6dof_from_components,
+    compute_6dof_from_reg_rtss_plan,
+)
+from course_session import CourseSession
+from extract_reg_matrix import extract_4x4_matrix_as_np_array
+
+TEST_TOLERANCE = 0.006  # the mock registration matrix is only roughly orthonormal
+
+
+class TestCourseSession:
+    def test_course_session_precomputes_plan_terms(self, create_mock_ion_plan_dataset):
+        """Test that the plan side terms are extracted once as float64."""
+        session = CourseSession(create_mock_ion_plan_dataset)
+
+        assert session.patient_position == "HFS"
+        assert session.patient_support_angle == 0.0
+        assert session.frame_of_reference_uid == "1.2.3.4.5.6.7.8.9.5"
+        assert session.plan_isocenter.dtype == np.float64
+        assert np.array_equal(session.plan_isocenter, [105.0, 195.0, 305.0])
+
+    @pytest.mark.parametrize("patient_position", ["HFS", "HFP", "FFS", "FFP"])
+    def test_compute_fraction_matches_full_calculation(
+        self, create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset, patient_position
+    ):
+        """Test that a fraction computed by the session matches the original calculation."""
+        create_mock_ion_plan_dataset.PatientSetupSequence[0].PatientPosition = patient_position
+        expected_ypr, expected_translation = compute_6dof_from_reg_rtss_plan(
+            create_mock_registration_dataset,
+            create_mock_rtss_dataset,
+            create_mock_ion_plan_dataset,
+            tolerance_ortho_normality=TEST_TOLERANCE,
+        )
+
+        session = CourseSession(create_mock_ion_plan_dataset, tolerance_ortho_normality=TEST_TOLERANCE)
+        ypr, translation = session.compute_fraction(create_mock_registration_dataset, create_mock_rtss_dataset)
+
+        assert np.allclose(ypr, expected_ypr)
+        assert np.allclose(translation, expected_translation)
+
+    def test_compute_fraction_selects_registration_of_rtss_frame_of_reference(
+        self, create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset
+    ):
+        """Test that the identity registration of the plan's Frame of Reference, listed first, is not used."""
+        session = CourseSession(create_mock_ion_plan_dataset, tolerance_ortho_normality=TEST_TOLERANCE)
+        expected_ypr, expected_translation = session.compute_fraction(
+            create_mock_registration_dataset, create_mock_rtss_dataset
+        )
+        identity_matrix_item = Dataset()
+        identity_matrix_item.FrameOfReferenceTransformationMatrix = [float(v) for v in np.identity(4).ravel()]
+        identity_matrix_reg_item = Dataset()
+        identity_matrix_reg_item.MatrixSequence = Sequence([identity_matrix_item])
+        identity_item = Dataset()
+        identity_item.FrameOfReferenceUID = session.frame_of_reference_uid
+        identity_item.MatrixRegistrationSequence = Sequence([identity_matrix_reg_item])
+        create_mock_registration_dataset.RegistrationSequence.insert(0, identity_item)
+
+        ypr, translation = session.compute_fraction(create_mock_registration_dataset, create_mock_rtss_dataset)
+
+        assert np.allclose(ypr, expected_ypr)
+        assert np.allclose(translation, expected_translation)
+
+    def test_compute_6dof_from_components(self, create_mock_registration_dataset):
+        """Test the calculation from values that were already extracted."""
+        four_by_four = extract_4x4_matrix_as_np_array(create_mock_registration_dataset)
+        plan_iso = four_by_four[0:3, 3]  # plan isocenter at the registration translation
+
+        ypr, translation = compute_6dof_from_components(
+            four_by_four, [1.0, 2.0, 3.0], plan_iso, "HFS", tolerance_ortho_normality=TEST_TOLERANCE
+        )
+
+        assert ypr.shape == (3,)
+        assert np.allclose(translation, [1.0, 3.0, -2.0])
@@ -0,0 +1,82 @@
+import logging
+import os
+
+import pytest
+from pydicom.dataset import Dataset
+
+from dicom_files import is_dicom_file, iter_dicom_files, looks_like_dicom
+
+
+def make_dataset():
+    ds = Dataset()
+    ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.3"
+    ds.PatientID = "TEST123"
+    return ds
+
+
+def save_part10(path):
+    make_dataset().save_as(path, implicit_vr=True, little_endian=True, enforce_file_format=True)
+
+
+class TestDicomFiles:
+    def test_part10_file(self, create_temp_directory):
+        path = create_temp_directory / "IMG0001"
+        save_part10(path)
+        assert is_dicom_file(path)
+
+    @pytest.mark.parametrize("implicit_vr", [True, False])
+    def test_dataset_without_preamble(self, create_temp_directory, implicit_vr):
+        path = create_temp_directory / "CT.dcm"
+        make_dataset().save_as(path, implicit_vr=implicit_vr, little_endian=True)
+        assert path.read_bytes()[128:132] != b"DICM"
+        assert is_dicom_file(path)
+
+    @pytest.mark.parametrize(
+        "content",
+        [b"", b"DICM", b"%PDF-1.4\n" + bytes(200), b"\x89PNG\r\n\x1a\n" + bytes(200), b"Patient notes, not DICOM\n" * 10],
+    )
+    def test_not_dicom(self, content):
+        assert not looks_like_dicom(content[:132])
+
+    def test_missing_file(self, create_temp_directory):
+        assert not is_dicom_file(create_temp_directory / "missing")
+
+    def test_iter_dicom_files(self, create_temp_directory):
+        """Test that DICOM files are found whatever their extension, in subdirectories unless not recursive."""
+        series = create_temp_directory / "series" / "1"
+        series.mkdir(parents=True)
+        save_part10(create_temp_directory / "IMG0001")
+        make_dataset().save_as(series / "CT1.dcm", implicit_vr=True, little_endian=True)
+        (series / "report.txt").write_text("not DICOM")
+        (create_temp_directory / "thumbnail.dcm").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(200))
+
+        found = iter_dicom_files(create_temp_directory)
+
+        assert not isinstance(found, list)
+        assert sorted(found) == sorted([str(create_temp_directory / "IMG0001"), str(series / "CT1.dcm")])
+        assert list(iter_dicom_files(create_temp_directory, recursive=False)) == [str(create_temp_directory / "IMG0001")]
+
+    def test_iter_dicom_files_skips_unreadable_subdirectory(self, create_temp_directory, monkeypatch, caplog):
+        """Test that a subdirectory that cannot be listed is skipped, and the rest of the tree is still searched."""
+        unreadable = create_temp_directory / "a_unreadable"
+        readable = create_temp_directory / "b_readable"
+        unreadable.mkdir()
+        readable.mkdir()
+        save_part10(unreadable / "IMG0001")
+        save_part10(readable / "IMG0002")
+        scandir = os.scandir
+
+        def failing_scandir(path):
+            if str(path) == str(unreadable):
+                raise PermissionError(13, "Permission denied", str(path))
+            return scandir(path)
+
+        monkeypatch.setattr(os, "scandir", failing_scandir)
+        with caplog.at_level(logging.WARNING):
+            found = list(iter_dicom_files(create_temp_directory))
+
+        assert found == [str(readable / "IMG0002")]
+        assert str(unreadable) in caplog.text
+        with pytest.raises(FileNotFoundError):
+            list(iter_dicom_files(create_temp_directory / "missing"))
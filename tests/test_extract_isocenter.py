@@ -1,9 +1,20 @@
 import pytest
+import numpy as np
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 
 from extract_rtss_setup_isocenter import extract_rtss_setup_isocenter
-from extract_plan_setupbeam_isocenter import extract_plan_setupbeam_isocenter
+from extract_plan_setupbeam_isocenter import extract_plan_setupbeam_isocenter, extract_plan_isocenters_and_couch_angles
+
+
+def make_beam(beam_number, isocenter, couch_angle):
+    control_point_item = Dataset()
+    control_point_item.IsocenterPosition = isocenter
+    control_point_item.PatientSupportAngle = couch_angle
+    beam_item = Dataset()
+    beam_item.BeamNumber = beam_number
+    beam_item.IonControlPointSequence = Sequence([control_point_item])
+    return beam_item
 
 
 class TestExtractIsocenter:
@@ -109,4 +120,28 @@ class TestExtractIsocenter:
 
         # Create empty plan without beam sequence
         with pytest.raises(AttributeError, match="'Dataset' object has no attribute 'IonBeamSequence'"):
-            extract_plan_setupbeam_isocenter(plan)
\ No newline at end of file
+            extract_plan_setupbeam_isocenter(plan)
+
+    def test_extract_plan_isocenters_and_couch_angles(self):
+        """Test collection of the distinct isocenter and couch angle pairs over all beams."""
+        plan = Dataset()
+        plan.IonBeamSequence = Sequence([
+            make_beam(1, ["5.0", "15.0", "25.0"], 0.0),
+            make_beam(2, ["5.0", "15.0", "25.0"], 90.0),
+            make_beam(3, ["5.0", "15.0", "225.0"], 0.0),
+            make_beam(4, ["5.0", "15.0", "25.0"], 0.0),
+        ])
+
+        isocenters, couch_angles, beam_numbers = extract_plan_isocenters_and_couch_angles(plan)
+
+        assert np.array_equal(isocenters, [[5.0, 15.0, 25.0], [5.0, 15.0, 25.0], [5.0, 15.0, 225.0]])
+        assert np.array_equal(couch_angles, [0.0, 90.0, 0.0])
+        assert beam_numbers == [[1, 4], [2], [3]]
+
+    def test_extract_plan_isocenters_and_couch_angles_missing(self):
+        """Test behavior when a beam has no isocenter."""
+        plan = Dataset()
+        plan.IonBeamSequence = Sequence([make_beam(1, ["5.0", "15.0", "25.0"], 0.0), make_beam(2, [], 0.0)])
+
+        with pytest.raises(ValueError, match="No isocenter in beam 1 of plan"):
+            extract_plan_isocenters_and_couch_angles(plan)
@@ -8,10 +8,29 @@ from pydicom.sequence import Sequence
 from extract_reg_matrix import (
     extract_matrix_as_np_array,
     extract_4x4_matrix_as_np_array,
-    decompose_matrix_order_rpy_as_ypr_degrees
+    extract_4x4_matrix_for_frame_of_reference,
+    extract_4x4_matrix_for_calculation,
+    extract_registration_matrices,
+    decompose_matrix_order_rpy_as_ypr_degrees,
+    decompose_matrices_order_rpy_as_ypr_degrees,
 )
 
 
+def make_registration_item(frame_of_reference_uid, *matrices):
+    """Registration Sequence item with a (possibly chained) Matrix Sequence."""
+    matrix_items = []
+    for matrix in matrices:
+        matrix_item = Dataset()
+        matrix_item.FrameOfReferenceTransformationMatrix = [float(value) for value in np.ravel(matrix)]
+        matrix_items.append(matrix_item)
+    matrix_reg_item = Dataset()
+    matrix_reg_item.MatrixSequence = Sequence(matrix_items)
+    reg_item = Dataset()
+    reg_item.FrameOfReferenceUID = frame_of_reference_uid
+    reg_item.MatrixRegistrationSequence = Sequence([matrix_reg_item])
+    return reg_item
+
+
 class TestExtractRegMatrix:
     @pytest.fixture
     def mock_sro_ds(self):
@@ -103,3 +122,82 @@ class TestExtractRegMatrix:
         assert np.isclose(ypr_angles[0], expected_yaw, atol=0.2)  # Yaw
         assert np.isclose(ypr_angles[1], expected_pitch, atol=0.2)  # Pitch
         assert np.isclose(ypr_angles[2], expected_roll, atol=0.2)  # Roll
+
+    def test_decompose_matrices_logs_reorthonormalization(self, caplog):
+        """Test that the batch decomposition logs the correction of each drifted matrix."""
+        drifted = np.array([[0.999, 0.012, 0.008], [-0.010, 0.998, 0.015], [-0.009, -0.014, 0.999]])
+        ypr = decompose_matrices_order_rpy_as_ypr_degrees(
+            np.array([np.identity(3), drifted]), reorthonormalization_tolerance=0.01
+        )
+
+        assert np.allclose(ypr[0], 0.0)
+        (record,) = caplog.records
+        assert len(record.reorthonormalization_correction) == 1
+        assert 0.0 < record.reorthonormalization_correction[0] < 0.01
+
+    @pytest.fixture
+    def mock_multi_registration_sro_ds(self):
+        """SRO with the identity registration first, a deformable only item, and a chained registration."""
+        translation = np.identity(4)
+        translation[0:3, 3] = [10.0, -5.0, 2.5]
+        rotation = np.identity(4)
+        rotation[0:2, 0:2] = [[0.0, -1.0], [1.0, 0.0]]  # 90 degrees about z
+
+        deformable_item = Dataset()
+        deformable_item.FrameOfReferenceUID = "1.2.3.3"
+
+        ds = Dataset()
+        ds.RegistrationSequence = Sequence([
+            make_registration_item("1.2.3.1", np.identity(4)),
+            deformable_item,
+            make_registration_item("1.2.3.2", rotation, translation),
+        ])
+        return ds
+
+    def test_extract_registration_matrices(self, mock_multi_registration_sro_ds):
+        """Test that every matrix registration is extracted and indexed by Frame of Reference."""
+        matrices, index_of_frame_of_reference = extract_registration_matrices(mock_multi_registration_sro_ds)
+
+        assert matrices.shape == (2, 4, 4)
+        assert index_of_frame_of_reference == {"1.2.3.1": 0, "1.2.3.2": 1}
+        assert np.array_equal(matrices[0], np.identity(4))
+        # the rotation is applied first, then the translation
+        expected = np.array([
+            [0.0, -1.0, 0.0, 10.0],
+            [1.0, 0.0, 0.0, -5.0],
+            [0.0, 0.0, 1.0, 2.5],
+            [0.0, 0.0, 0.0, 1.0],
+        ])
+        assert np.allclose(matrices[1], expected)
+
+    def test_extract_4x4_matrix_for_frame_of_reference(self, mock_multi_registration_sro_ds, mock_sro_ds):
+        """Test selection of the registration by Frame of Reference."""
+        matrix = extract_4x4_matrix_for_frame_of_reference(mock_multi_registration_sro_ds, "1.2.3.2")
+        assert np.allclose(matrix[0:3, 3], [10.0, -5.0, 2.5])
+
+        with pytest.raises(ValueError, match="No registration for Frame of Reference 1.2.3.3 in SRO"):
+            extract_4x4_matrix_for_frame_of_reference(mock_multi_registration_sro_ds, "1.2.3.3")
+
+        # items without a Frame of Reference UID are extracted but not indexed
+        matrices, index_of_frame_of_reference = extract_registration_matrices(mock_sro_ds)
+        assert np.allclose(matrices[0], extract_4x4_matrix_as_np_array(mock_sro_ds))
+        assert index_of_frame_of_reference == {}
+
+    def test_extract_4x4_matrix_for_calculation(self, mock_multi_registration_sro_ds, mock_sro_ds):
+        """Test that the in room registration is selected even when it is not the first item."""
+        matrices, _ = extract_registration_matrices(mock_multi_registration_sro_ds)
+
+        # the in room Frame of Reference wins
+        assert np.array_equal(
+            extract_4x4_matrix_for_calculation(mock_multi_registration_sro_ds, "1.2.3.2", "1.2.3.9"), matrices[1]
+        )
+        # otherwise the registration of the plan's Frame of Reference is skipped
+        assert np.array_equal(extract_4x4_matrix_for_calculation(mock_multi_registration_sro_ds, "", "1.2.3.1"), matrices[1])
+        # otherwise the first registration
+        assert np.array_equal(extract_4x4_matrix_for_calculation(mock_multi_registration_sro_ds), matrices[0])
+        assert np.allclose(extract_4x4_matrix_for_calculation(mock_sro_ds), extract_4x4_matrix_as_np_array(mock_sro_ds))
+
+        deformable_only_ds = Dataset()
+        deformable_only_ds.RegistrationSequence = Sequence([Dataset()])
+        with pytest.raises(ValueError, match="No matrix registration in SRO"):
+            extract_4x4_matrix_for_calculation(deformable_only_ds)
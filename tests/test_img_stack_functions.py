@@ -1,16 +1,30 @@
-import pytest
-import numpy as np
 import os
-from pathlib import Path
 import tempfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pydicom import dcmread
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 
 from gen_inroom_rtss import (
-    img_stack_displacement,
+    StackCenterAccumulator,
+    accumulate_stack_geometry,
+    enhanced_ct_frame_geometry,
+    generate_inroom_rtss_per_series,
     get_dict_sort_on_displacement,
+    get_stack_center,
+    get_stack_center_from_path,
+    get_stack_center_from_path_streaming,
+    get_stack_geometry_center,
     image_stack_sort,
-    get_stack_center
+    img_stack_displacement,
+    read_ct_geometry_headers,
+    scan_stack_geometry,
+    split_stacks,
+    stack_geometry_problems,
+    validate_stack_geometry,
 )
 
 AXIAL_ORIENTATION = ["1.0", "0.0", "0.0", "0.0", "1.0", "0.0"]
@@ -125,3 +139,259 @@ class TestImgStackFunctions:
         assert np.isclose(center[0], expected_x)
         assert np.isclose(center[1], expected_y)
         assert np.isclose(center[2], expected_z)
+
+    def test_stack_center_accumulator_matches_sorted_stack(self):
+        """Test that slices added in any order give the center of the sorted stack."""
+        slices = {}
+        for index in np.random.default_rng(0).permutation(40):
+            ds = Dataset()
+            ds.ImageOrientationPatient = AXIAL_ORIENTATION
+            ds.ImagePositionPatient = ["-125.0", "-125.0", str(-50.0 + 2.5 * index)]
+            ds.PixelSpacing = [0.5, 0.5]
+            ds.Rows = 512
+            ds.Columns = 512
+            ds.PatientPosition = "HFS"
+            slices[f"{index}.dcm"] = ds
+
+        accumulator = StackCenterAccumulator()
+        for ds in slices.values():
+            accumulator.add(ds)
+
+        assert accumulator.count == 40
+        assert np.allclose(accumulator.center(), get_stack_center(image_stack_sort(slices)))
+
+    def test_stack_center_accumulator_empty(self):
+        with pytest.raises(ValueError, match="No slices in stack"):
+            StackCenterAccumulator().center()
+
+    def test_get_stack_center_from_path_streaming(self, create_temp_directory, create_mock_ct_dataset):
+        """Test that the streaming center of CT files matches the sorted stack, other objects are skipped."""
+        for index in [3, 0, 4, 1, 2]:
+            ds = create_mock_ct_dataset.copy()
+            ds.SOPInstanceUID = f"1.2.3.4.5.6.7.8.9.3.{index}"
+            ds.ImagePositionPatient = ["-256.0", "-256.0", str(-10.0 + 2.0 * index)]
+            ds.save_as(create_temp_directory / f"CT{index}.dcm", implicit_vr=True, little_endian=True)
+        other = Dataset()
+        other.SOPClassUID = "1.2.840.10008.5.1.4.1.1.481.3"  # RT Structure Set Storage
+        other.save_as(create_temp_directory / "RS.dcm", implicit_vr=True, little_endian=True)
+
+        center = get_stack_center_from_path_streaming(create_temp_directory)
+
+        assert np.allclose(center, get_stack_center_from_path(create_temp_directory))
+        assert np.allclose(center, [-0.5, -0.5, -6.0])
+
+
+def make_slices(series_instance_uid, z_positions, orientation=AXIAL_ORIENTATION):
+    """Axial slice headers of one series keyed by file name, in the order given."""
+    slices = {}
+    for index, z in enumerate(z_positions):
+        ds = Dataset()
+        ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.FrameOfReferenceUID = series_instance_uid + ".0"
+        ds.ImageOrientationPatient = orientation
+        ds.ImagePositionPatient = ["-125.0", "-125.0", str(z)]
+        ds.PixelSpacing = [0.5, 0.5]
+        ds.Rows = 512
+        ds.Columns = 512
+        ds.PatientPosition = "HFS"
+        slices[f"{series_instance_uid}_{index}.dcm"] = ds
+    return slices
+
+
+def make_enhanced_ct(series_instance_uid, z_positions, shared=True):
+    """Enhanced CT header with one frame per z position, orientation and pixel spacing shared or per frame."""
+    ds = Dataset()
+    ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.2.1"  # Enhanced CT Image Storage
+    ds.SOPInstanceUID = series_instance_uid + ".9"
+    ds.StudyInstanceUID = "1.2.3"
+    ds.PatientID = "TEST123"
+    ds.SeriesInstanceUID = series_instance_uid
+    ds.FrameOfReferenceUID = series_instance_uid + ".0"
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.NumberOfFrames = len(z_positions)
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = AXIAL_ORIENTATION
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = [0.5, 0.5]
+    pixel_measures.SliceThickness = 1.0
+    shared_groups = Dataset()
+    ds.PerFrameFunctionalGroupsSequence = Sequence()
+    for z in z_positions:
+        frame = Dataset()
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = ["-125.0", "-125.0", str(z)]
+        frame.PlanePositionSequence = Sequence([plane_position])
+        if not shared:
+            frame.PlaneOrientationSequence = Sequence([plane_orientation])
+            frame.PixelMeasuresSequence = Sequence([pixel_measures])
+        ds.PerFrameFunctionalGroupsSequence.append(frame)
+    if shared:
+        shared_groups.PlaneOrientationSequence = Sequence([plane_orientation])
+        shared_groups.PixelMeasuresSequence = Sequence([pixel_measures])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared_groups])
+    return ds
+
+
+class TestStackGeometry:
+
+    def test_split_stacks_mixed_series(self):
+        """Test that two interleaved series are split and each matches the sorted stack."""
+        cbct = make_slices("1.2.3.1", [2.0, -4.0, 0.0, -2.0, 4.0])
+        planning_ct = make_slices("1.2.3.2", [10.0, 13.0, 16.0])
+        headers = dict(list(cbct.items())[:3] + list(planning_ct.items()) + list(cbct.items())[3:])
+
+        stacks = split_stacks(headers)
+
+        assert [stack.series_instance_uid for stack in stacks] == ["1.2.3.1", "1.2.3.2"]
+        for stack, slices in zip(stacks, [cbct, planning_ct]):
+            sorted_stack = image_stack_sort(slices)
+            assert stack.keys == [key for key, _ in sorted_stack]
+            assert np.allclose(get_stack_geometry_center(stack), get_stack_center(sorted_stack))
+            assert stack_geometry_problems(stack) == []
+
+    def test_split_stacks_empty(self):
+        assert split_stacks({}) == []
+
+    def test_duplicates_and_gaps(self):
+        stack, = split_stacks(make_slices("1.2.3.1", [0.0, 2.0, 2.0, 4.0, 10.0, 12.0]))
+
+        problems = stack_geometry_problems(stack)
+
+        assert "1 duplicate slice positions" in problems
+        assert "1 gaps in the stack (slice spacing 2 mm)" in problems
+
+    def test_non_uniform_spacing(self):
+        stack, = split_stacks(make_slices("1.2.3.1", [0.0, 2.0, 4.5, 6.5]))
+        assert stack_geometry_problems(stack) == ["Slice spacing is not uniform (median 2 mm)"]
+
+    def test_mixed_orientation_and_size(self):
+        slices = make_slices("1.2.3.1", [0.0, 2.0, 4.0])
+        slices["1.2.3.1_2.dcm"].ImageOrientationPatient = ["1.0", "0.0", "0.0", "0.0", "0.99", "0.1"]
+        slices["1.2.3.1_1.dcm"].Rows = 256
+        stack, = split_stacks(slices)
+
+        with pytest.raises(ValueError, match="ImageOrientationPatient differs.*Rows/Columns differ"):
+            validate_stack_geometry(stack)
+
+    def test_scan_stack_geometry(self, create_temp_directory):
+        """Test that a directory with two series is split in one scan."""
+        for series_instance_uid, z_positions in [("1.2.3.1", [0.0, 2.0, 4.0]), ("1.2.3.2", [1.0, 4.0])]:
+            for name, ds in make_slices(series_instance_uid, z_positions).items():
+                ds.save_as(create_temp_directory / name, implicit_vr=True, little_endian=True)
+
+        stacks = scan_stack_geometry(create_temp_directory)
+
+        assert [len(stack.keys) for stack in stacks] == [3, 2]
+        assert np.allclose(stacks[0].displacement, [4.0, 2.0, 0.0])
+        assert stacks[1].frame_of_reference_uid == "1.2.3.2.0"
+
+    def test_accumulate_stack_geometry(self, create_temp_directory):
+        """Test that folding one header at a time gives the stacks, centers and problems of scan_stack_geometry."""
+        for series_instance_uid, z_positions in [("1.2.3.1", [4.0, 0.0, 2.0]), ("1.2.3.3", [0.0, 3.0, 3.0, 9.0])]:
+            for name, ds in make_slices(series_instance_uid, z_positions).items():
+                ds.save_as(create_temp_directory / name, implicit_vr=True, little_endian=True)
+        make_enhanced_ct("1.2.3.2", [0.0, -2.0, 2.0]).save_as(
+            create_temp_directory / "CBCT.dcm", implicit_vr=True, little_endian=True
+        )
+
+        accumulated = accumulate_stack_geometry(create_temp_directory)
+        scanned = scan_stack_geometry(create_temp_directory, workers=1)
+
+        assert [stack.series_instance_uid for stack in accumulated] == ["1.2.3.1", "1.2.3.2", "1.2.3.3"]
+        assert [(stack.series_instance_uid, stack.frame_of_reference_uid) for stack in accumulated] == [
+            (stack.series_instance_uid, stack.frame_of_reference_uid) for stack in scanned
+        ]
+        for stack, scanned_stack in zip(accumulated, scanned):
+            assert stack.count == len(scanned_stack.keys)
+            assert np.allclose(stack.center(), get_stack_geometry_center(scanned_stack))
+            assert stack.problems() == stack_geometry_problems(scanned_stack)
+        with pytest.raises(ValueError, match="Series 1.2.3.3 .*1 duplicate slice positions"):
+            accumulated[2].validate()
+
+    def test_read_ct_geometry_headers_in_parallel(self, create_temp_directory):
+        """Test that reading in worker processes gives the same headers, other files are left out."""
+        files = []
+        for name, ds in make_slices("1.2.3.1", range(10)).items():
+            ds.save_as(create_temp_directory / name, implicit_vr=True, little_endian=True)
+            files.append(str(create_temp_directory / name))
+        (create_temp_directory / "notes.dcm").write_bytes(b"not DICOM")
+        files.append(str(create_temp_directory / "notes.dcm"))
+
+        in_process = read_ct_geometry_headers(files, workers=1)
+        in_workers = read_ct_geometry_headers(files, workers=2, chunk_size=3)
+
+        assert list(in_workers) == list(in_process) == files[:10]
+        assert [ds.ImagePositionPatient for ds in in_workers.values()] == [
+            ds.ImagePositionPatient for ds in in_process.values()
+        ]
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_generate_inroom_rtss_per_series(self, create_temp_directory, workers):
+        """Test that each valid series of a mixed directory gets its own RTSS, an invalid one is reported."""
+        ct_directory = create_temp_directory / "ct"
+        ct_directory.mkdir()
+        for series_instance_uid, z_positions in [("1.2.3.1", [0.0, 2.0, 4.0]), ("1.2.3.2", [0.0, 3.0, 6.0, 9.0]),
+                                                 ("1.2.3.3", [0.0, 3.0, 3.0])]:
+            for index, (name, ds) in enumerate(make_slices(series_instance_uid, z_positions).items()):
+                ds.SOPInstanceUID = f"{series_instance_uid}.9.{index}"
+                ds.StudyInstanceUID = "1.2.3"
+                ds.PatientID = "TEST123"
+                ds.save_as(ct_directory / name, implicit_vr=True, little_endian=True)
+
+        results = generate_inroom_rtss_per_series(ct_directory, create_temp_directory, workers=workers)
+
+        assert [stack.series_instance_uid for stack, _ in results] == ["1.2.3.1", "1.2.3.2", "1.2.3.3"]
+        assert isinstance(results[2][1], ValueError)
+        for (stack, rtss_path), z_center in zip(results[:2], [2.0, 4.5]):
+            rtss = dcmread(rtss_path, force=True)
+            assert rtss.PatientID == "TEST123"
+            referenced_series = rtss.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0]
+            contour_images = referenced_series.ReferencedSeriesSequence[0].ContourImageSequence
+            assert [item.ReferencedSOPInstanceUID for item in contour_images] == [
+                f"{stack.series_instance_uid}.9.{index}" for index in reversed(range(len(stack.keys)))
+            ]
+            assert np.allclose(rtss.ROIContourSequence[0].ContourSequence[0].ContourData, [2.75, 2.75, z_center])
+
+    @pytest.mark.parametrize("shared", [True, False])
+    def test_enhanced_ct_frame_geometry(self, shared):
+        """Test that the frames of an enhanced CT give the stack of the equivalent single frame images."""
+        z_positions = [4.0, -2.0, 0.0, 2.0, -4.0]
+        frames = enhanced_ct_frame_geometry(make_enhanced_ct("1.2.3.1", z_positions, shared), "CBCT.dcm")
+
+        assert frames.keys == [("CBCT.dcm", frame_number) for frame_number in range(1, 6)]
+        assert frames.position.shape == (5, 3)
+        assert frames.orientation.shape == (5, 6)
+
+        stack, = split_stacks({"CBCT.dcm": make_enhanced_ct("1.2.3.1", z_positions, shared)})
+        single_frame_stack, = split_stacks(make_slices("1.2.3.1", z_positions))
+        assert stack.keys == [("CBCT.dcm", 1), ("CBCT.dcm", 4), ("CBCT.dcm", 3), ("CBCT.dcm", 2), ("CBCT.dcm", 5)]
+        assert np.allclose(get_stack_geometry_center(stack), get_stack_geometry_center(single_frame_stack))
+        assert stack_geometry_problems(stack) == []
+
+    def test_enhanced_ct_missing_position(self):
+        ds = make_enhanced_ct("1.2.3.1", [0.0, 2.0])
+        del ds.PerFrameFunctionalGroupsSequence[1].PlanePositionSequence
+        with pytest.raises(ValueError, match="ImagePositionPatient"):
+            enhanced_ct_frame_geometry(ds, "CBCT.dcm")
+
+    def test_generate_inroom_rtss_for_enhanced_ct(self, create_temp_directory):
+        """Test that a one file enhanced CT is scanned and its RTSS references each frame."""
+        ct_directory = create_temp_directory / "ct"
+        ct_directory.mkdir()
+        make_enhanced_ct("1.2.3.1", [0.0, 2.0, 4.0]).save_as(
+            ct_directory / "CBCT.dcm", implicit_vr=True, little_endian=True
+        )
+
+        stack, = scan_stack_geometry(ct_directory)
+        assert [frame_number for _, frame_number in stack.keys] == [3, 2, 1]
+
+        (stack, rtss_path), = generate_inroom_rtss_per_series(ct_directory, create_temp_directory, workers=1)
+        rtss = dcmread(rtss_path, force=True)
+        referenced_series = rtss.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0]
+        contour_images = referenced_series.ReferencedSeriesSequence[0].ContourImageSequence
+        assert [(item.ReferencedSOPInstanceUID, item.ReferencedFrameNumber) for item in contour_images] == [
+            ("1.2.3.1.9", 3), ("1.2.3.1.9", 2), ("1.2.3.1.9", 1)
+        ]
+        assert np.allclose(rtss.ROIContourSequence[0].ContourSequence[0].ContourData, [2.75, 2.75, 2.0])
@@ -0,0 +1,128 @@
+import json
+import tracemalloc
+
+import pytest
+
+import compute_6dof_from_reg_rtss_plan as c6
+from gen_inroom_rtss import INROOM_RTSS_STAGES, generate_inroom_rtss_per_series
+from memory_profile import (
+    MemoryProfiler,
+    current_rss_kib,
+    pop_memory_profile_argument,
+    profiled,
+)
+from synthetic_corpus import CorpusSpec, generate_corpus
+
+SPEC = CorpusSpec(patients=1, fractions=1, slices=10, rows=16, columns=16, beams=2, spots=20, contour_points=20)
+
+
+def allocate(size):
+    return bytearray(size)
+
+
+class TestMemoryProfiler:
+    def test_stages(self):
+        profiler = MemoryProfiler()
+        with profiler.stage("transient"):
+            allocate(2 * 1024 * 1024)
+        kept = []
+        with profiler.stage("retained"):
+            kept.append(allocate(1024 * 1024))
+        transient, retained = profiler.stages
+        assert transient.stage == "transient"
+        assert transient.peak_kib >= 2 * 1024
+        assert transient.retained_kib < 1024
+        assert retained.retained_kib >= 1024
+        assert retained.top_allocations[0]["kib"] >= 1024
+        assert retained.top_allocations[0]["site"].startswith(__file__)
+        assert not tracemalloc.is_tracing()
+
+    def test_start_ends_the_current_stage(self):
+        profiler = MemoryProfiler()
+        profiler.start("first")
+        profiler.start("second")
+        profiler.stop()
+        profiler.stop()
+        assert [stage.stage for stage in profiler.stages] == ["first", "second"]
+
+    def test_tracing_left_running(self):
+        tracemalloc.start()
+        try:
+            with MemoryProfiler().stage("inside"):
+                pass
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
+
+    def test_rss(self):
+        rss = current_rss_kib()
+        assert rss is None or rss > 0
+
+    def test_profiled_without_profiler(self):
+        with profiled(None, "nothing"):
+            pass
+
+    def test_write(self, create_temp_directory):
+        profiler = MemoryProfiler(top_allocations=2)
+        with profiler.stage("only"):
+            allocate(1024)
+        path = create_temp_directory / "profile.json"
+        profiler.write(str(path))
+        (stage,) = json.loads(path.read_text())["stages"]
+        assert stage["stage"] == "only"
+        assert len(stage["top_allocations"]) <= 2
+        assert set(stage) == {"stage", "seconds", "peak_kib", "retained_kib", "rss_kib", "rss_delta_kib", "top_allocations"}
+
+    def test_write_dash_goes_to_stderr(self, capsys):
+        """Test that "-" writes the report to stderr, leaving stdout to the results."""
+        profiler = MemoryProfiler()
+        with profiler.stage("only"):
+            allocate(1024)
+        profiler.write("-")
+        captured = capsys.readouterr()
+        assert captured.out == ""
+        assert json.loads(captured.err)["stages"][0]["stage"] == "only"
+
+    def test_pop_memory_profile_argument(self):
+        argv = ["prog", "a", "--memory-profile", "out.json", "b"]
+        assert pop_memory_profile_argument(argv) == "out.json"
+        assert argv == ["prog", "a", "b"]
+        assert pop_memory_profile_argument(argv) is None
+        with pytest.raises(ValueError):
+            pop_memory_profile_argument(["prog", "--memory-profile"])
+
+
+class TestProfiledPipelines:
+    def test_do_calculate(self, create_temp_directory, capsys):
+        generate_corpus(create_temp_directory, SPEC, workers=1)
+        fraction_directory = create_temp_directory / "patient_000" / "fraction_000"
+        profiler = MemoryProfiler()
+        c6.do_calculate(
+            str(fraction_directory / "RE.dcm"),
+            str(fraction_directory / "RS.dcm"),
+            str(create_temp_directory / "patient_000" / "plan" / "RP.dcm"),
+            memory_profiler=profiler,
+        )
+        assert [stage.stage for stage in profiler.stages] == list(c6.CALCULATION_STAGES)
+        assert all(stage.peak_kib > 0 for stage in profiler.stages)
+        assert not tracemalloc.is_tracing()
+
+    def test_do_calculate_failure_ends_the_stage(self, create_temp_directory, capsys):
+        profiler = MemoryProfiler()
+        with pytest.raises(Exception):
+            c6.do_calculate(str(create_temp_directory / "missing.dcm"), "", "", memory_profiler=profiler)
+        assert [stage.stage for stage in profiler.stages] == [c6.CALCULATION_STAGES[0]]
+        assert not tracemalloc.is_tracing()
+
+    def test_inroom_rtss_per_series(self, create_temp_directory):
+        generate_corpus(create_temp_directory / "corpus", SPEC, workers=1)
+        output_directory = create_temp_directory / "output"
+        output_directory.mkdir()
+        profiler = MemoryProfiler()
+        ((_, rtss_path),) = generate_inroom_rtss_per_series(
+            create_temp_directory / "corpus" / "patient_000" / "fraction_000" / "CT",
+            output_directory,
+            memory_profiler=profiler,
+        )
+        assert str(rtss_path).startswith(str(output_directory))
+        assert [stage.stage for stage in profiler.stages] == list(INROOM_RTSS_STAGES)
@@ -0,0 +1,164 @@
+import numpy as np
+import pytest
+
+from compute_6dof_from_reg_rtss_plan import compute_6dof_from_components
+from monte_carlo_setup_uncertainty import (
+    _StreamingStatistics,
+    simulate_setup_uncertainty,
+    simulate_setup_uncertainty_from_datasets,
+)
+
+FOUR_BY_FOUR = np.array(
+    [
+        [np.cos(0.02), -np.sin(0.02), 0.0, 10.0],
+        [np.sin(0.02), np.cos(0.02), 0.0, -5.0],
+        [0.0, 0.0, 1.0, 2.5],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+SETUP_ISO = np.array([100.0, 200.0, 300.0])
+PLAN_ISO = np.array([105.0, 195.0, 305.0])
+
+
+class TestMonteCarloSetupUncertainty:
+    def test_simulate_without_noise_reproduces_calculation(self):
+        """Without noise every percentile is the deterministic correction."""
+        expected_ypr, expected_translation = compute_6dof_from_components(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFP")
+
+        result = simulate_setup_uncertainty(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFP", 1000, seed=1, chunk_size=300)
+
+        assert result["ypr_degrees"].shape == (len(result["percentiles"]), 3)
+        assert np.allclose(result["ypr_degrees"], expected_ypr)
+        assert np.allclose(result["translation_iec_mm"], expected_translation)
+
+    def test_simulate_is_reproducible_across_workers(self):
+        """The same seed and chunk size give the same result in process and in a process pool."""
+        kwargs = dict(
+            rotation_sigma_degrees=0.5,
+            translation_sigma_mm=1.0,
+            setup_isocenter_sigma_mm=[0.5, 0.5, 1.0],
+            seed=31,
+            chunk_size=2500,
+        )
+        in_process = simulate_setup_uncertainty(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFS", 10_000, workers=1, **kwargs)
+        pooled = simulate_setup_uncertainty(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFS", 10_000, workers=2, **kwargs)
+
+        assert np.array_equal(in_process["ypr_degrees"], pooled["ypr_degrees"])
+        assert np.array_equal(in_process["translation_iec_mm"], pooled["translation_iec_mm"])
+
+    def test_simulate_spread_follows_noise(self):
+        """Pure Setup Isocenter noise shows up as the translation spread, with the rotation unchanged."""
+        result = simulate_setup_uncertainty(
+            FOUR_BY_FOUR,
+            SETUP_ISO,
+            PLAN_ISO,
+            "HFS",
+            200_000,
+            setup_isocenter_sigma_mm=2.0,
+            percentiles=[15.865, 84.135],
+            seed=7,
+        )
+
+        spread = 0.5 * (result["translation_iec_mm"][1] - result["translation_iec_mm"][0])
+        assert np.allclose(spread, 2.0, rtol=0.02)
+        assert np.allclose(result["ypr_degrees"][0], result["ypr_degrees"][1])
+
+        uniform = simulate_setup_uncertainty(
+            FOUR_BY_FOUR,
+            SETUP_ISO,
+            PLAN_ISO,
+            "HFS",
+            10_000,
+            setup_isocenter_sigma_mm=2.0,
+            setup_isocenter_noise_model="uniform",
+            percentiles=[0.0, 100.0],
+            seed=7,
+        )
+        expected = compute_6dof_from_components(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFS")[1]
+        assert np.all(np.abs(uniform["translation_iec_mm"] - expected) <= 2.0)
+
+    def test_streaming_statistics_match_all_samples(self):
+        """Chunks whose range grows in both directions give the percentiles and moments of all samples.
+
+        A percentile lies between the order statistics numpy interpolates, to within a bin width.
+        """
+        rng = np.random.default_rng(11)
+        chunks = [rng.normal(0.0, 0.1, (500, 2)), rng.normal(5.0, 2.0, (500, 2)), rng.normal(-40.0, 3.0, (500, 2))]
+        statistics = _StreamingStatistics(2)
+        for chunk in chunks:
+            statistics.add(chunk)
+
+        samples = np.concatenate(chunks)
+        percentiles = [0.0, 2.5, 50.0, 97.5, 100.0]
+        tolerance = (samples.max() - samples.min()) / statistics.bins
+        ranks = np.asarray(percentiles) / 100.0 * (len(samples) - 1)
+        ordered = np.sort(samples, axis=0)
+        result = statistics.percentiles(percentiles)
+        assert np.all(result >= ordered[np.floor(ranks).astype(int)] - tolerance)
+        assert np.all(result <= ordered[np.ceil(ranks).astype(int)] + tolerance)
+        assert np.array_equal(result[[0, -1]], [samples.min(axis=0), samples.max(axis=0)])
+        assert np.allclose(statistics.mean, samples.mean(axis=0))
+        assert np.allclose(statistics.standard_deviation(), samples.std(axis=0, ddof=1))
+        assert statistics.counts.sum() == samples.size
+
+    def test_simulate_reports_moments(self):
+        result = simulate_setup_uncertainty(
+            FOUR_BY_FOUR,
+            SETUP_ISO,
+            PLAN_ISO,
+            "HFS",
+            50_000,
+            setup_isocenter_sigma_mm=2.0,
+            seed=7,
+            chunk_size=4096,
+        )
+
+        expected = compute_6dof_from_components(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFS")[1]
+        assert np.allclose(result["translation_mean_iec_mm"], expected, atol=0.05)
+        assert np.allclose(result["translation_std_iec_mm"], 2.0, rtol=0.02)
+        assert np.allclose(result["ypr_std_degrees"], 0.0, atol=1e-9)
+
+    def test_simulate_rejects_unknown_noise_model(self):
+        with pytest.raises(ValueError, match="noise model cauchy not supported"):
+            simulate_setup_uncertainty(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFS", 10, rotation_noise_model="cauchy")
+
+    def test_simulate_from_datasets(
+        self, create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset
+    ):
+        result = simulate_setup_uncertainty_from_datasets(
+            create_mock_registration_dataset,
+            create_mock_rtss_dataset,
+            create_mock_ion_plan_dataset,
+            100,
+            rotation_sigma_degrees=0.2,
+            seed=3,
+            tolerance_ortho_normality=0.006,
+        )
+
+        assert int(result["sample_count"]) == 100
+        assert result["translation_iec_mm"].shape == (5, 3)
+
+    def test_simulate_reorthonormalizes_drifted_registration(self, caplog):
+        """A drifting registration rotation is projected once, in process and in a process pool."""
+        drifted = FOUR_BY_FOUR.copy()
+        drifted[0:3, 0:3] *= 1.001
+        with pytest.raises(ValueError, match="not rotation matrices"):
+            simulate_setup_uncertainty(drifted, SETUP_ISO, PLAN_ISO, "HFS", 100, seed=5)
+
+        expected_ypr, expected_translation = compute_6dof_from_components(FOUR_BY_FOUR, SETUP_ISO, PLAN_ISO, "HFS")
+        for workers in (1, 2):
+            caplog.clear()
+            result = simulate_setup_uncertainty(
+                drifted,
+                SETUP_ISO,
+                PLAN_ISO,
+                "HFS",
+                100,
+                seed=5,
+                chunk_size=30,
+                workers=workers,
+                reorthonormalization_tolerance=0.01,
+            )
+            assert np.allclose(result["ypr_degrees"], expected_ypr)
+            assert np.allclose(result["translation_iec_mm"], expected_translation)
+            assert len(caplog.records) == 1
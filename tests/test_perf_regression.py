@@ -0,0 +1,75 @@
+import math
+
+import numpy as np
+import pytest
+
+import perf_regression
+from extract_rtss_setup_isocenter import extract_rtss_setup_isocenter
+from perf_regression import (
+    DEFAULT_MAX_MEMORY_GROWTH,
+    PERF_CASES,
+    Measurement,
+    load_baselines,
+    make_large_rtss,
+    measure,
+    regressions,
+    run_case,
+    save_baselines,
+)
+from synthetic_corpus import cbct_center
+
+BASELINE = {"normalized_time": 2.0, "peak_kib": 1000.0}
+
+
+class TestRegressions:
+    def test_within_limits(self):
+        assert regressions("case", Measurement(0.1, 2.9, 1200.0), BASELINE, max_slowdown=1.5, max_memory_growth=1.25) == []
+
+    def test_slower(self):
+        (problem,) = regressions("case", Measurement(0.1, 3.1, 1000.0), BASELINE, max_slowdown=1.5)
+        assert "case" in problem and "slower" in problem
+
+    def test_more_memory(self):
+        (problem,) = regressions("case", Measurement(0.1, 2.0, 1300.0), BASELINE, max_memory_growth=1.25)
+        assert "memory" in problem
+
+    def test_baselines_round_trip(self, create_temp_directory):
+        path = create_temp_directory / "baselines.json"
+        assert load_baselines(path) == {}
+        save_baselines({"first": Measurement(0.1, 2.0, 100.0)}, path)
+        save_baselines({"second": Measurement(0.2, 4.0, 200.0)}, path)
+        assert load_baselines(path) == {
+            "first": {"normalized_time": 2.0, "peak_kib": 100.0},
+            "second": {"normalized_time": 4.0, "peak_kib": 200.0},
+        }
+
+
+class TestMeasure:
+    def test_peak_memory(self):
+        measurement = measure(lambda: bytearray(4 * 1024 * 1024), repeat=2)
+        assert measurement.peak_kib >= 4 * 1024
+        assert measurement.seconds > 0
+        assert measurement.normalized_time > 0
+
+    def test_large_rtss_setup_isocenter(self):
+        rtss_ds = make_large_rtss(roi_count=5, contours_per_roi=3, points_per_contour=10)
+        assert len(rtss_ds.StructureSetROISequence) == 6
+        assert len(rtss_ds.ROIContourSequence[0].ContourSequence) == 3
+        setup_isocenter = [float(value) for value in extract_rtss_setup_isocenter(rtss_ds)]
+        np.testing.assert_allclose(setup_isocenter, cbct_center(perf_regression.CORPUS_SPEC, 0, 0), atol=0.01)
+
+
+BASELINES = load_baselines()
+
+
+@pytest.mark.parametrize("name", list(PERF_CASES))
+def test_no_regression(name, request):
+    """The gate: each entry point against perf_baselines.json (python perf_regression.py --record to update it)
+
+    The peak memory is always checked, the time only with --max-slowdown, as wall-clock time depends on the machine load.
+    """
+    if name not in BASELINES:
+        pytest.skip(f"No baseline recorded for {name}")
+    max_slowdown = request.config.getoption("--max-slowdown") or math.inf
+    max_memory_growth = request.config.getoption("--max-memory-growth") or DEFAULT_MAX_MEMORY_GROWTH
+    assert regressions(name, run_case(name), BASELINES[name], max_slowdown, max_memory_growth) == []
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import preload_cache
+from preload_cache import PreloadCache
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        yield pool
+
+
+@pytest.fixture
+def plan_path(dicom_paths):
+    return dicom_paths[2]
+
+
+class TestPreloadCache:
+    def test_get_serves_preloaded_dataset(self, executor, plan_path, monkeypatch):
+        """Test that a preloaded file is not read again by get."""
+        cache = PreloadCache(executor)
+        cache.preload("IonPlan", plan_path).result()
+        assert cache.is_loaded("IonPlan")
+
+        monkeypatch.setattr(preload_cache, "read_dataset", lambda path: pytest.fail("file was read again"))
+        assert cache.get(plan_path).SOPInstanceUID == "1.2.3.4.5.6.7.8.9.4"
+        assert cache.preload("IonPlan", plan_path).done()  # same file, same entry
+
+    def test_changed_file_is_read_again(self, executor, plan_path, create_mock_ion_plan_dataset):
+        cache = PreloadCache(executor)
+        cache.preload("IonPlan", plan_path).result()
+
+        create_mock_ion_plan_dataset.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.40"
+        create_mock_ion_plan_dataset.save_as(plan_path, implicit_vr=True, little_endian=True)
+        os.utime(plan_path, ns=(1, 1))
+
+        assert cache.get(plan_path).SOPInstanceUID == "1.2.3.4.5.6.7.8.9.40"
+
+    def test_selecting_another_file_evicts_slot(self, executor, plan_path, tmp_path):
+        cache = PreloadCache(executor)
+        cache.preload("IonPlan", plan_path).result()
+
+        assert cache.preload("IonPlan", str(tmp_path / "not_there.dcm")) is None
+        assert not cache.is_loaded("IonPlan")
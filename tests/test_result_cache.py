@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+
+from compute_6dof_from_reg_rtss_plan import compute_6dof_from_reg_rtss_plan
+from result_cache import CorrectionCache
+
+TEST_TOLERANCE = 0.006  # the mock registration matrix is only roughly orthonormal
+
+
+class TestCorrectionCache:
+    def test_compute_repeat_is_a_hit(self, dicom_paths, monkeypatch):
+        """Test that a repeated triple is served from memory without reading the files."""
+        cache = CorrectionCache(tolerance_ortho_normality=TEST_TOLERANCE)
+        ypr, translation = cache.compute(*dicom_paths)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        monkeypatch.setattr("result_cache.file_content_digest", lambda path: pytest.fail("file was read"))
+        cached_ypr, cached_translation = cache.compute(*dicom_paths)
+
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert np.array_equal(cached_ypr, ypr)
+        assert np.array_equal(cached_translation, translation)
+
+    def test_compute_invalidates_replaced_file(self, dicom_paths, create_mock_rtss_dataset):
+        """Test that a file replaced under the same path gives a fresh result."""
+        cache = CorrectionCache(tolerance_ortho_normality=TEST_TOLERANCE)
+        _, translation = cache.compute(*dicom_paths)
+
+        create_mock_rtss_dataset.ROIContourSequence[0].ContourSequence[0].ContourData = [110.0, 200.0, 300.0]
+        create_mock_rtss_dataset.save_as(dicom_paths[1] + ".new", implicit_vr=True, little_endian=True)
+        os.replace(dicom_paths[1] + ".new", dicom_paths[1])
+        _, replaced_translation = cache.compute(*dicom_paths)
+
+        assert cache.misses == 2
+        assert np.allclose(replaced_translation - translation, [10.0, 0.0, 0.0])
+
+    def test_compute_matches_direct_calculation(
+        self, dicom_paths, create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset
+    ):
+        expected_ypr, expected_translation = compute_6dof_from_reg_rtss_plan(
+            create_mock_registration_dataset,
+            create_mock_rtss_dataset,
+            create_mock_ion_plan_dataset,
+            tolerance_ortho_normality=TEST_TOLERANCE,
+        )
+        cache = CorrectionCache(tolerance_ortho_normality=TEST_TOLERANCE)
+
+        for ypr, translation in (
+            cache.compute(*dicom_paths),
+            cache.compute_datasets(create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset),
+        ):
+            assert np.allclose(ypr, expected_ypr)
+            assert np.allclose(translation, expected_translation)
+
+    def test_compute_datasets_keyed_by_uids(
+        self, create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset
+    ):
+        """Test that datasets are keyed by SOPInstanceUID and that a changed tolerance is a different key."""
+        create_mock_registration_dataset.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.6"
+        datasets = (create_mock_registration_dataset, create_mock_rtss_dataset, create_mock_ion_plan_dataset)
+        cache = CorrectionCache(tolerance_ortho_normality=TEST_TOLERANCE)
+        cache.compute_datasets(*datasets)
+        cache.compute_datasets(*datasets)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        cache.tolerance_ortho_normality = 0.007
+        cache.compute_datasets(*datasets)
+        assert cache.misses == 2
+
+    def test_lru_eviction(self):
+        cache = CorrectionCache(max_entries=2)
+        for index in range(3):
+            cache.put(f"key{index}", np.zeros(3), np.full(3, index))
+        assert cache.get("key0") is None
+        assert np.array_equal(cache.get("key2")[1], [2.0, 2.0, 2.0])
+
+    def test_store_persists_and_is_capped(self, tmp_path):
+        """Test that a new cache finds results on disk and that the store stays within its size cap."""
+        store_directory = str(tmp_path / "store")
+        cache = CorrectionCache(store_directory=store_directory, max_store_bytes=400)
+        for index in range(10):
+            cache.put(f"key{index}", np.full(3, index), np.full(3, -index))
+            os.utime(os.path.join(store_directory, f"key{index}.json"), ns=(index, index))
+
+        stored = os.listdir(store_directory)
+        assert sum(os.path.getsize(os.path.join(store_directory, name)) for name in stored) <= 400
+        assert "key9.json" in stored
+        assert "key0.json" not in stored
+
+        reopened = CorrectionCache(store_directory=store_directory)
+        ypr, translation = reopened.get("key9")
+        assert reopened.hits == 1
+        assert np.array_equal(ypr, [9.0, 9.0, 9.0])
+        assert np.array_equal(translation, [-9.0, -9.0, -9.0])
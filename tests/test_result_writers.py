@@ -0,0 +1,100 @@
+import csv
+import json
+import time
+
+import numpy as np
+import pytest
+
+from compute_6dof_from_reg_rtss_plan import do_calculate, mosaiq_display_values
+from result_writers import (
+    RECORD_FIELDS,
+    ResultWriter,
+    correction_record,
+    open_result_writer,
+)
+
+YPR = np.array([1.04, -0.26, 0.55])
+TRANSLATION = np.array([12.34, -5.06, 0.04])
+
+
+class TestResultWriters:
+    def test_correction_record(self):
+        """Test that a record carries the raw values, the display values and the provenance."""
+        record = correction_record(YPR, TRANSLATION, "1.2.3", "1.2.4", "1.2.5")
+
+        assert tuple(record) == RECORD_FIELDS
+        assert record["sro_sop_instance_uid"] == "1.2.3"
+        assert record["lateral_mm"] == 12.34
+        assert record["lateral_cm"] == 1.2
+        assert record["rotation_z_deg"] == 1.0
+        assert mosaiq_display_values(YPR, TRANSLATION)["rotation_x_deg"] == -0.3
+
+    @pytest.mark.parametrize("extension", [".jsonl", ".csv"])
+    def test_writer_flushes_on_record_budget(self, tmp_path, extension):
+        """Test that records reach the file every max_records records, before the writer is closed."""
+        path = str(tmp_path / f"corrections{extension}")
+        with open_result_writer(path, max_records=2, max_seconds=3600.0) as writer:
+            for index in range(5):
+                writer.write(correction_record(YPR + index, TRANSLATION, f"1.2.{index}"))
+            assert writer.records_written == 4
+        assert writer.records_written == 5
+
+        with open(path, encoding="utf-8") as result_file:
+            if extension == ".jsonl":
+                records = [json.loads(line) for line in result_file]
+            else:
+                records = list(csv.DictReader(result_file))
+        assert [record["sro_sop_instance_uid"] for record in records] == [f"1.2.{index}" for index in range(5)]
+        assert float(records[4]["yaw_deg"]) == YPR[0] + 4
+
+    def test_writer_flushes_on_time_budget(self, tmp_path):
+        """Test that a zero time budget writes every record as it arrives."""
+        with open_result_writer(str(tmp_path / "corrections.jsonl"), max_seconds=0.0) as writer:
+            writer.write(correction_record(YPR, TRANSLATION))
+            assert writer.records_written == 1
+
+    def test_writer_flushes_on_timer(self, tmp_path):
+        """Test that a buffered record is flushed after max_seconds without a further write."""
+        path = tmp_path / "corrections.jsonl"
+        with open_result_writer(str(path), max_seconds=0.05) as writer:
+            writer.write(correction_record(YPR, TRANSLATION, "1.2.3"))
+            assert writer.records_written == 0
+            deadline = time.monotonic() + 5.0
+            while writer.records_written == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert writer.records_written == 1
+            assert json.loads(path.read_text(encoding="utf-8"))["sro_sop_instance_uid"] == "1.2.3"
+
+    def test_result_writer_is_abstract(self, tmp_path):
+        """Test that a writer must implement the output of the records."""
+        with pytest.raises(TypeError):
+            ResultWriter(str(tmp_path / "corrections"))
+
+    def test_arrow_writer(self, tmp_path):
+        pyarrow = pytest.importorskip("pyarrow")
+        path = str(tmp_path / "corrections.arrow")
+        with open_result_writer(path, max_records=3) as writer:
+            for index in range(7):
+                writer.write(correction_record(YPR, TRANSLATION + index, f"1.2.{index}"))
+
+        with pyarrow.OSFile(path, "rb") as source:
+            table = pyarrow.ipc.open_stream(source).read_all()
+        assert table.num_rows == 7
+        assert table.schema.field("vertical_mm").type == pyarrow.float64()
+        assert table.column("vertical_mm").to_pylist() == [TRANSLATION[2] + index for index in range(7)]
+
+    def test_open_result_writer_rejects_unknown_format(self, tmp_path):
+        with pytest.raises(ValueError, match="output format .txt not supported"):
+            open_result_writer(str(tmp_path / "corrections.txt"))
+
+    def test_do_calculate_writes_record(self, tmp_path, dicom_paths, create_mock_rtss_dataset, create_mock_ion_plan_dataset):
+        """Test that do_calculate returns the correction and streams it with the provenance UIDs."""
+        with open_result_writer(str(tmp_path / "corrections.jsonl")) as writer:
+            ypr, translation = do_calculate(*dicom_paths, reorthonormalization_tolerance=0.01, result_writer=writer)
+
+        with open(tmp_path / "corrections.jsonl", encoding="utf-8") as result_file:
+            record = json.loads(result_file.readline())
+        assert record["rtss_sop_instance_uid"] == create_mock_rtss_dataset.SOPInstanceUID
+        assert record["plan_sop_instance_uid"] == create_mock_ion_plan_dataset.SOPInstanceUID
+        assert record["vertical_mm"] == translation[2]
+        assert record["yaw_deg"] == ypr[0]
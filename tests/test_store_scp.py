@@ -0,0 +1,236 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from pydicom import uid
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+
+from compute_6dof_from_reg_rtss_plan import compute_6dof_from_components
+from gen_inroom_rtss import StackCenterAccumulator
+
+pynetdicom = pytest.importorskip("pynetdicom")
+
+from store_scp import (  # noqa: E402
+    SOURCE_CT,
+    SOURCE_RTSS,
+    STORAGE_SOP_CLASSES,
+    CalculationSCP,
+)
+
+TEST_TOLERANCE = 0.006  # the mock registration matrix is only roughly orthonormal
+
+
+def with_file_meta(ds):
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = uid.ImplicitVRLittleEndian
+    return ds
+
+
+def send(port, datasets):
+    """Send the datasets over one association from a local SCU"""
+    ae = pynetdicom.AE()
+    for sop_class in STORAGE_SOP_CLASSES:
+        ae.add_requested_context(sop_class, uid.ImplicitVRLittleEndian)
+    assoc = ae.associate("127.0.0.1", port)
+    assert assoc.is_established
+    statuses = [assoc.send_c_store(with_file_meta(ds)).Status for ds in datasets]
+    assoc.release()
+    return statuses
+
+
+def make_ct_slices(create_mock_ct_dataset, count=5):
+    slices = []
+    for index in range(count):
+        ds = create_mock_ct_dataset.copy()
+        ds.SOPInstanceUID = f"1.2.3.4.5.6.7.8.9.2.{index}"
+        ds.ImagePositionPatient = ["-256.0", "-256.0", str(10.0 * index)]
+        slices.append(ds)
+    return slices
+
+
+@pytest.fixture
+def scp():
+    results = []
+    done = threading.Event()
+
+    def on_result(*result):
+        results.append(result)
+        done.set()
+
+    receiver = CalculationSCP(on_result=on_result, tolerance_ortho_normality=TEST_TOLERANCE)
+    port = receiver.start(port=0)
+    yield receiver, port, results, done
+    receiver.stop()
+
+
+class TestCalculationSCP:
+    def test_calculates_from_rtss(self, scp, create_mock_export_set):
+        receiver, port, results, done = scp
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+
+        assert send(port, [plan_ds, reg_ds, rtss_ds]) == [0, 0, 0]
+        assert done.wait(5)
+
+        sro, source, ypr, translation = results[0]
+        expected_ypr, expected_translation = compute_6dof_from_components(
+            np.array(
+                reg_ds.RegistrationSequence[0]
+                .MatrixRegistrationSequence[0]
+                .MatrixSequence[0]
+                .FrameOfReferenceTransformationMatrix
+            ).reshape(4, 4),
+            [100.0, 200.0, 300.0],
+            [105.0, 195.0, 305.0],
+            "HFS",
+            tolerance_ortho_normality=TEST_TOLERANCE,
+        )
+        assert sro.sop_instance_uid == reg_ds.SOPInstanceUID
+        assert source == SOURCE_RTSS
+        assert np.allclose(ypr, expected_ypr)
+        assert np.allclose(translation, expected_translation)
+
+    def test_calculates_from_ct_stack_when_association_released(self, scp, create_mock_export_set, create_mock_ct_dataset):
+        """Test that without an in room RTSS the center of the received CT stack is the Setup Isocenter."""
+        receiver, port, results, done = scp
+        reg_ds, _, plan_ds = create_mock_export_set
+        send(port, [plan_ds, reg_ds])
+        slices = make_ct_slices(create_mock_ct_dataset)
+
+        send(port, slices)
+        assert done.wait(5)
+
+        stack = StackCenterAccumulator()
+        for ds in slices:
+            stack.add(ds)
+        sro, source, ypr, translation = results[0]
+        expected_translation = compute_6dof_from_components(
+            np.array(
+                reg_ds.RegistrationSequence[0]
+                .MatrixRegistrationSequence[0]
+                .MatrixSequence[0]
+                .FrameOfReferenceTransformationMatrix
+            ).reshape(4, 4),
+            stack.center(),
+            [105.0, 195.0, 305.0],
+            "HFS",
+            tolerance_ortho_normality=TEST_TOLERANCE,
+        )[1]
+        assert source == SOURCE_CT
+        assert np.allclose(translation, expected_translation)
+
+        # the stack is kept for a re-exported SRO
+        done.clear()
+        send(port, [reg_ds])
+        assert done.wait(5)
+        assert results[1][1] == SOURCE_CT
+        assert np.allclose(results[1][3], expected_translation)
+
+    def test_calculates_with_registration_of_in_room_frame_of_reference(self, scp, create_mock_export_set):
+        """Test that the identity registration of the plan's Frame of Reference, listed first, is not used."""
+        receiver, port, results, done = scp
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        matrix = np.array(
+            reg_ds.RegistrationSequence[0].MatrixRegistrationSequence[0].MatrixSequence[0].FrameOfReferenceTransformationMatrix
+        ).reshape(4, 4)
+        identity_matrix_item = Dataset()
+        identity_matrix_item.FrameOfReferenceTransformationMatrix = [float(v) for v in np.identity(4).ravel()]
+        identity_matrix_reg_item = Dataset()
+        identity_matrix_reg_item.MatrixSequence = Sequence([identity_matrix_item])
+        identity_item = Dataset()
+        identity_item.FrameOfReferenceUID = plan_ds.FrameOfReferenceUID
+        identity_item.MatrixRegistrationSequence = Sequence([identity_matrix_reg_item])
+        del reg_ds.RegistrationSequence[1]
+        reg_ds.RegistrationSequence.insert(0, identity_item)
+
+        send(port, [plan_ds, rtss_ds, reg_ds])
+        assert done.wait(5)
+
+        _, source, ypr, translation = results[0]
+        expected_ypr, expected_translation = compute_6dof_from_components(
+            matrix, [100.0, 200.0, 300.0], [105.0, 195.0, 305.0], "HFS", tolerance_ortho_normality=TEST_TOLERANCE
+        )
+        assert source == SOURCE_RTSS
+        assert np.allclose(ypr, expected_ypr)
+        assert np.allclose(translation, expected_translation)
+
+    def test_calculates_outside_lock_and_drops_replaced_inputs(self, create_mock_export_set):
+        """Test that the result is reported without the lock held, and only the latest RTSS and plan are kept."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        lock_free = []
+        done = threading.Event()
+
+        def on_result(*result):
+            lock_free.append(receiver._lock.acquire(blocking=False))
+            if lock_free[-1]:
+                receiver._lock.release()
+            done.set()
+
+        receiver = CalculationSCP(on_result=on_result, tolerance_ortho_normality=TEST_TOLERANCE)
+        port = receiver.start(port=0)
+        try:
+            rtss_ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.30"
+            replaced_rtss = rtss_ds.copy()
+            rtss_ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.31"
+            send(port, [plan_ds, replaced_rtss, rtss_ds, reg_ds])
+            assert done.wait(5)
+        finally:
+            receiver.stop()
+
+        assert lock_free == [True]
+        assert sorted(receiver._datasets) == sorted([plan_ds.SOPInstanceUID, rtss_ds.SOPInstanceUID])
+
+    def test_recalculates_re_exported_sro(self, scp, create_mock_export_set):
+        """Test that the in room RTSS is kept after the first calculation, so the same SRO sent again is calculated."""
+        receiver, port, results, done = scp
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        send(port, [plan_ds, rtss_ds, reg_ds])
+        assert done.wait(5)
+
+        done.clear()
+        send(port, [reg_ds])
+        assert done.wait(5)
+
+        assert [result[0].sop_instance_uid for result in results] == [reg_ds.SOPInstanceUID] * 2
+        assert np.allclose(results[1][2], results[0][2])
+        assert np.allclose(results[1][3], results[0][3])
+
+    def test_in_room_inputs_expire(self, create_mock_export_set):
+        """Test that the in room RTSS is dropped retention_seconds after it was received."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        results = []
+        receiver = CalculationSCP(
+            on_result=lambda *result: results.append(result), tolerance_ortho_normality=TEST_TOLERANCE, retention_seconds=0.0
+        )
+        port = receiver.start(port=0)
+        try:
+            send(port, [plan_ds, rtss_ds])
+            send(port, [reg_ds])
+        finally:
+            receiver.stop()
+
+        assert results == []
+        assert rtss_ds.SOPInstanceUID not in receiver._datasets
+        assert reg_ds.SOPInstanceUID in receiver._pending_sros
+
+    def test_aborted_association_drops_partial_stack(self, scp, create_mock_export_set, create_mock_ct_dataset):
+        """Test that the slices of an aborted association are not used as a complete CT stack."""
+        receiver, port, results, done = scp
+        reg_ds, _, plan_ds = create_mock_export_set
+        send(port, [plan_ds, reg_ds])
+
+        ae = pynetdicom.AE()
+        ae.add_requested_context(uid.CTImageStorage, uid.ImplicitVRLittleEndian)
+        assoc = ae.associate("127.0.0.1", port)
+        for ds in make_ct_slices(create_mock_ct_dataset, count=2):
+            assoc.send_c_store(with_file_meta(ds))
+        assoc.abort()
+        deadline = time.monotonic() + 5
+        while receiver._stacks_by_association and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert receiver._stacks_by_association == {}
+        assert receiver._stacks == {}
+        assert receiver._complete_stacks == {}
+        assert results == []
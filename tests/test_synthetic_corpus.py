@@ -0,0 +1,79 @@
+import hashlib
+
+import numpy as np
+import pydicom
+
+import compute_6dof_from_reg_rtss_plan as c6
+from gen_inroom_rtss import get_stack_geometry_center, scan_stack_geometry
+from synthetic_corpus import (
+    CorpusSpec,
+    cbct_center,
+    generate_corpus,
+    registration_matrix,
+)
+
+SPEC = CorpusSpec(patients=2, fractions=2, slices=20, rows=16, columns=16, beams=3, spots=50, contour_points=40, seed=7)
+
+
+def digests(directory):
+    return {
+        str(path.relative_to(directory)): hashlib.sha256(path.read_bytes()).hexdigest()
+        for path in sorted(directory.rglob("*.dcm"))
+    }
+
+
+class TestSyntheticCorpus:
+    def test_counts(self, create_temp_directory):
+        totals = generate_corpus(create_temp_directory, SPEC, workers=1)
+        expected_files = SPEC.patients * (2 + SPEC.fractions * (2 + SPEC.slices))
+        assert totals["files"] == expected_files
+        assert len(list(create_temp_directory.rglob("*.dcm"))) == expected_files
+        assert totals["bytes"] == sum(path.stat().st_size for path in create_temp_directory.rglob("*.dcm"))
+
+        plan = pydicom.dcmread(create_temp_directory / "patient_000" / "plan" / "RP.dcm")
+        assert len(plan.IonBeamSequence) == SPEC.beams
+        for beam in plan.IonBeamSequence:
+            assert sum(int(cp.NumberOfScanSpotPositions) for cp in beam.IonControlPointSequence) == SPEC.spots
+            assert sum(len(cp.ScanSpotMetersetWeights) for cp in beam.IonControlPointSequence) == SPEC.spots
+        rtss = pydicom.dcmread(create_temp_directory / "patient_000" / "fraction_000" / "RS.dcm")
+        assert rtss.ROIContourSequence[0].ContourSequence[0].NumberOfContourPoints == SPEC.contour_points
+        sro = pydicom.dcmread(create_temp_directory / "patient_000" / "fraction_000" / "RE.dcm")
+        assert sro.FrameOfReferenceUID == plan.FrameOfReferenceUID
+        assert sro.RegistrationSequence[1].FrameOfReferenceUID == plan.FrameOfReferenceUID
+
+    def test_reproducible_whatever_the_workers(self, tmp_path):
+        generate_corpus(tmp_path / "serial", SPEC, workers=1)
+        generate_corpus(tmp_path / "parallel", SPEC, workers=2)
+        assert digests(tmp_path / "serial") == digests(tmp_path / "parallel")
+
+    def test_seed_changes_the_corpus(self, tmp_path):
+        generate_corpus(tmp_path / "a", SPEC._replace(patients=1, fractions=1), workers=1)
+        generate_corpus(tmp_path / "b", SPEC._replace(patients=1, fractions=1, seed=8), workers=1)
+        assert set(digests(tmp_path / "a").values()).isdisjoint(digests(tmp_path / "b").values())
+
+    def test_rotations_are_valid(self):
+        for fraction in range(10):
+            rotation = registration_matrix(SPEC, 0, fraction)[0:3, 0:3]
+            np.testing.assert_allclose(rotation.T @ rotation, np.identity(3), atol=1e-12)
+            assert np.isclose(np.linalg.det(rotation), 1.0)
+
+    def test_fraction_calculates(self, create_temp_directory):
+        generate_corpus(create_temp_directory, SPEC, workers=1)
+        fraction_directory = create_temp_directory / "patient_001" / "fraction_001"
+        ypr, translation = c6.compute_6dof_from_reg_rtss_plan(
+            pydicom.dcmread(fraction_directory / "RE.dcm"),
+            pydicom.dcmread(fraction_directory / "RS.dcm"),
+            pydicom.dcmread(create_temp_directory / "patient_001" / "plan" / "RP.dcm"),
+        )
+        assert np.all(np.abs(ypr) <= 3.0 + 1e-6)
+        assert np.all(np.isfinite(translation))
+
+    def test_setup_isocenter_is_the_cbct_center(self, create_temp_directory):
+        generate_corpus(create_temp_directory, SPEC, workers=1)
+        stacks = scan_stack_geometry(create_temp_directory / "patient_000" / "fraction_001" / "CT", workers=1)
+        assert len(stacks) == 1
+        assert len(stacks[0].keys) == SPEC.slices
+        np.testing.assert_allclose(get_stack_geometry_center(stacks[0]), cbct_center(SPEC, 0, 1), atol=0.01)
+        rtss = pydicom.dcmread(create_temp_directory / "patient_000" / "fraction_001" / "RS.dcm")
+        setup_isocenter = [float(value) for value in rtss.ROIContourSequence[1].ContourSequence[0].ContourData]
+        np.testing.assert_allclose(setup_isocenter, cbct_center(SPEC, 0, 1), atol=0.01)
@@ -0,0 +1,52 @@
+from uid_index import KIND_PLAN, KIND_RTSS, KIND_SRO, UidIndex, dataset_header_summary
+
+CBCT_FOR = "1.2.3.4.5.6.7.8.9.2"
+PLAN_FOR = "1.2.3.4.5.6.7.8.9.5"
+
+
+class TestUidIndex:
+    def test_dataset_header_summary(self, create_mock_export_set):
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        sro, rtss, plan = (dataset_header_summary(ds) for ds in (reg_ds, rtss_ds, plan_ds))
+
+        assert (sro.kind, rtss.kind, plan.kind) == (KIND_SRO, KIND_RTSS, KIND_PLAN)
+        assert sro.frames_of_reference == (CBCT_FOR, PLAN_FOR)
+        assert rtss.frames_of_reference == (CBCT_FOR,)
+        assert plan.frames_of_reference == (PLAN_FOR,)
+        assert plan.referenced_sop_instance_uids == ("1.2.3.4.5.6.7.8.9.7",)
+
+    def test_match_waits_for_rtss_and_plan(self, create_mock_export_set):
+        """Test that an SRO matches once the latest RTSS and plan on its Frames of Reference are indexed."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        index = UidIndex()
+        sro = dataset_header_summary(reg_ds)
+        index.add(sro)
+        index.add(dataset_header_summary(plan_ds))
+        assert index.match(sro) is None
+
+        index.add(dataset_header_summary(rtss_ds))
+        rtss_ds.SOPInstanceUID = "1.2.3.4.5.6.7.8.9.8"
+        newer_rtss = dataset_header_summary(rtss_ds)
+        index.add(newer_rtss)
+
+        rtss, plan = index.match(sro)
+        assert rtss == newer_rtss
+        assert plan.sop_instance_uid == plan_ds.SOPInstanceUID
+        assert index.sros_registering(PLAN_FOR) == [sro]
+
+    def test_sro_frame_of_reference_is_indexed(self, create_mock_export_set):
+        """Test that the SRO's own Frame of Reference (the plan's) matches without a registration item for it."""
+        reg_ds, rtss_ds, plan_ds = create_mock_export_set
+        del reg_ds.RegistrationSequence[1]
+        reg_ds.FrameOfReferenceUID = PLAN_FOR
+        index = UidIndex()
+        sro = dataset_header_summary(reg_ds)
+        for ds in (reg_ds, rtss_ds, plan_ds):
+            index.add(dataset_header_summary(ds))
+
+        assert sro.frames_of_reference == (CBCT_FOR, PLAN_FOR)
+        assert index.match_frames_of_reference(sro) == (CBCT_FOR, PLAN_FOR)
+        assert [summary.sop_instance_uid for summary in index.match(sro)] == [
+            rtss_ds.SOPInstanceUID,
+            plan_ds.SOPInstanceUID,
+        ]
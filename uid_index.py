@@ -0,0 +1,174 @@
+# Copyright (C) 2023 Stuart Swerdloff
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Header summaries of DICOM objects and an in memory index of their UID relationships
+
+An SRO registers the Frame of Reference of the RT Ion Plan (the reference CT) with the
+Frame of Reference of the in room image volume, which the in room RTSS refers to.
+So a complete set for the calculation is an SRO, the latest in room RTSS on one of its
+registered Frames of Reference and the latest plan on another.
+"""
+
+from typing import Dict, List, NamedTuple, Tuple
+
+import pydicom
+from pydicom import Dataset, uid
+
+KIND_SRO = "REG"
+KIND_RTSS = "RTSTRUCT"
+KIND_PLAN = "RTPLAN"
+KIND_IMAGE = "IMAGE"
+KIND_OTHER = "OTHER"
+
+_KIND_BY_SOP_CLASS = {
+    uid.SpatialRegistrationStorage: KIND_SRO,
+    uid.RTStructureSetStorage: KIND_RTSS,
+    uid.RTIonPlanStorage: KIND_PLAN,
+    uid.RTPlanStorage: KIND_PLAN,
+    uid.CTImageStorage: KIND_IMAGE,
+    uid.EnhancedCTImageStorage: KIND_IMAGE,
+}
+
+_KIND_BY_MODALITY = {"REG": KIND_SRO, "RTSTRUCT": KIND_RTSS, "RTPLAN": KIND_PLAN, "CT": KIND_IMAGE}
+
+
+class HeaderSummary(NamedTuple):
+    """What the index needs to know about one DICOM object"""
+
+    path: str
+    kind: str
+    sop_class_uid: str
+    sop_instance_uid: str
+    series_instance_uid: str
+    frames_of_reference: Tuple[str, ...]
+    """Plan and images: their Frame of Reference, RTSS: the referenced ones, SRO: the registered ones and its own"""
+    referenced_sop_instance_uids: Tuple[str, ...]
+    """Plan: the referenced RTSS, SRO: the referenced images"""
+
+
+def _unique(values) -> Tuple[str, ...]:
+    return tuple(dict.fromkeys(str(value) for value in values if value))
+
+
+def _referenced_instances(series_sequence) -> List[str]:
+    return [
+        instance.get("ReferencedSOPInstanceUID", "")
+        for series in series_sequence
+        for instance in series.get("ReferencedInstanceSequence", [])
+    ]
+
+
+def dataset_header_summary(ds: Dataset, path: str = "") -> HeaderSummary:
+    """Summarize a dataset (read with or without its pixel data)
+
+    Args:
+        ds (Dataset): the DICOM object
+        path (str): where it was read from
+
+    Returns:
+        HeaderSummary: the kind of object and the UIDs it carries and references
+    """
+    sop_class_uid = str(ds.get("SOPClassUID", ""))
+    kind = _KIND_BY_SOP_CLASS.get(sop_class_uid) or _KIND_BY_MODALITY.get(str(ds.get("Modality", "")), KIND_OTHER)
+
+    frames_of_reference = [ds.get("FrameOfReferenceUID", "")]
+    referenced = []
+    if kind == KIND_SRO:
+        frames_of_reference = [item.get("FrameOfReferenceUID", "") for item in ds.get("RegistrationSequence", [])] + [
+            ds.get("FrameOfReferenceUID", "")
+        ]
+        referenced = _referenced_instances(ds.get("ReferencedSeriesSequence", []))
+        for study in ds.get("StudiesContainingOtherReferencedInstancesSequence", []):
+            referenced += _referenced_instances(study.get("ReferencedSeriesSequence", []))
+    elif kind == KIND_RTSS:
+        frames_of_reference = [
+            item.get("FrameOfReferenceUID", "") for item in ds.get("ReferencedFrameOfReferenceSequence", [])
+        ] + [item.get("ReferencedFrameOfReferenceUID", "") for item in ds.get("StructureSetROISequence", [])]
+    elif kind == KIND_PLAN:
+        referenced = [item.get("ReferencedSOPInstanceUID", "") for item in ds.get("ReferencedStructureSetSequence", [])]
+
+    return HeaderSummary(
+        path=str(path),
+        kind=kind,
+        sop_class_uid=sop_class_uid,
+        sop_instance_uid=str(ds.get("SOPInstanceUID", "")),
+        series_instance_uid=str(ds.get("SeriesInstanceUID", "")),
+        frames_of_reference=_unique(frames_of_reference),
+        referenced_sop_instance_uids=_unique(referenced),
+    )
+
+
+def dicom_header_summary(path: str) -> HeaderSummary:
+    """Read the header of a DICOM file (no pixel data) and summarize it"""
+    return dataset_header_summary(pydicom.dcmread(path, force=True, stop_before_pixels=True), path)
+
+
+class UidIndex:
+    """In memory index of the SROs, in room RTSSs and plans seen so far, by SOP Instance UID and Frame of Reference"""
+
+    def __init__(self):
+        self.by_sop_instance_uid: Dict[str, HeaderSummary] = {}
+        self._by_frame_of_reference: Dict[str, Dict[str, List[HeaderSummary]]] = {KIND_SRO: {}, KIND_RTSS: {}, KIND_PLAN: {}}
+
+    def add(self, summary: HeaderSummary) -> None:
+        """Index an object, a later object on the same Frame of Reference takes precedence"""
+        if not summary.sop_instance_uid:
+            return
+        self.by_sop_instance_uid[summary.sop_instance_uid] = summary
+        by_frame = self._by_frame_of_reference.get(summary.kind)
+        if by_frame is None:
+            return
+        for frame_of_reference_uid in summary.frames_of_reference:
+            entries = by_frame.setdefault(frame_of_reference_uid, [])
+            entries[:] = [entry for entry in entries if entry.sop_instance_uid != summary.sop_instance_uid]
+            entries.append(summary)
+
+    def latest(self, kind: str, frame_of_reference_uid: str) -> HeaderSummary | None:
+        """The most recently indexed SRO, RTSS or plan on a Frame of Reference"""
+        entries = self._by_frame_of_reference[kind].get(frame_of_reference_uid)
+        return entries[-1] if entries else None
+
+    def on_frame_of_reference(self, frame_of_reference_uid: str, kind: str) -> List[HeaderSummary]:
+        """The SROs, RTSSs or plans on a Frame of Reference, in the order they were indexed"""
+        return list(self._by_frame_of_reference[kind].get(frame_of_reference_uid, []))
+
+    def sros_registering(self, frame_of_reference_uid: str) -> List[HeaderSummary]:
+        """The SROs that register a Frame of Reference, in the order they were indexed"""
+        return self.on_frame_of_reference(frame_of_reference_uid, KIND_SRO)
+
+    def match_frames_of_reference(self, sro: HeaderSummary) -> Tuple[str, str] | None:
+        """The (in room, plan) Frames of Reference to calculate an SRO on, or None while the RTSS or plan is missing
+
+        The plan Frame of Reference is a registered one with a plan, and the in room one another registered one
+        with an RTSS (an RTSS on the plan's Frame of Reference is the reference RTSS).
+        """
+        for plan_frame_of_reference in sro.frames_of_reference:
+            if self.latest(KIND_PLAN, plan_frame_of_reference) is None:
+                continue
+            for rtss_frame_of_reference in sro.frames_of_reference:
+                if rtss_frame_of_reference == plan_frame_of_reference:
+                    continue
+                if self.latest(KIND_RTSS, rtss_frame_of_reference) is not None:
+                    return rtss_frame_of_reference, plan_frame_of_reference
+        return None
+
+    def match(self, sro: HeaderSummary) -> Tuple[HeaderSummary, HeaderSummary] | None:
+        """The (in room RTSS, plan) to calculate an SRO with, or None while either is missing
+
+        They are the latest RTSS and plan on the Frames of Reference of match_frames_of_reference.
+        """
+        frames_of_reference = self.match_frames_of_reference(sro)
+        if frames_of_reference is None:
+            return None
+        rtss_frame_of_reference, plan_frame_of_reference = frames_of_reference
+        return self.latest(KIND_RTSS, rtss_frame_of_reference), self.latest(KIND_PLAN, plan_frame_of_reference)